@@ -5,7 +5,7 @@ Obsługuje zarówno Claude (Anthropic) jak i Gemini (Google) API.
 API keys są ładowane z pliku .env - NIGDY nie hardkodujemy! 🔐
 """
 
-from http.server import BaseHTTPRequestHandler, HTTPServer
+from http.server import BaseHTTPRequestHandler, HTTPServer, ThreadingHTTPServer
 import os
 import json
 import subprocess
@@ -14,50 +14,152 @@ import datetime
 import sys
 import traceback
 import time
-from typing import Optional, Dict, Any, Callable, TypeVar, Any as AnyType
+import queue
+import threading
+import re
+import math
+import heapq
+import signal
+import socket
+import select
+import sqlite3
+import mmap
+import io
+import multiprocessing
+import mimetypes
+import stat
+import email.utils
+import base64
+import codecs
+import hashlib
+import uuid
+import urllib.parse
+import importlib
+import importlib.util
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
+from dataclasses import dataclass, field
+from typing import Optional, Dict, Any, Callable, Iterator, List, TypeVar, Any as AnyType
+
+# Punkt odniesienia dla raportu startowego (STARTUP_TIMINGS)
+_STARTUP_T0 = time.perf_counter()
+
+# Zmienne procesu sprzed .env - mają pierwszeństwo także po przeładowaniu
+_PROCESS_ENV = dict(os.environ)
 
 # Próba importu python-dotenv
+DOTENV_AVAILABLE = False
+ENV_FILE: Optional[str] = None
+# Nazwy, które ostatnie wczytanie wzięło z .env (nie z procesu) - przy
+# przeładowaniu ignorujemy je w os.environ, żeby usunięty klucz znikał
+_DOTENV_KEYS: frozenset = frozenset()
 try:
-    from dotenv import load_dotenv
-    load_dotenv()
-    print("[OK] python-dotenv loaded successfully")
+    from dotenv import load_dotenv, find_dotenv, dotenv_values
+    ENV_FILE = find_dotenv() or None
+    load_dotenv(ENV_FILE)
+    DOTENV_AVAILABLE = True
+    if ENV_FILE:
+        _DOTENV_KEYS = frozenset(k for k in dotenv_values(ENV_FILE) if k not in _PROCESS_ENV)
 except ImportError:
     print("[WARN] python-dotenv not installed. Using os.environ only.")
     print("[TIP] Run: pip install python-dotenv --break-system-packages")
 
-# Próba importu anthropic SDK
-ANTHROPIC_AVAILABLE = False
-try:
-    import anthropic
-    ANTHROPIC_AVAILABLE = True
-    print("[OK] Anthropic SDK available")
-except ImportError:
-    print("[WARN] Anthropic SDK not installed.")
-    print("[TIP] Run: pip install anthropic --break-system-packages")
+# =============================================================================
+# Lazy SDK - importy dostawców dopiero przy pierwszym użyciu
+# =============================================================================
+# google.generativeai ciągnie gRPC/protobuf i potrafi dodać sekundy do zimnego
+# startu (Electron, Vercel). Dostępność sprawdzamy tanio przez import spec.
 
-# Próba importu Google Generative AI SDK
-GOOGLE_AI_AVAILABLE = False
-try:
-    import google.generativeai as genai
-    GOOGLE_AI_AVAILABLE = True
-    print("[OK] Google Generative AI SDK available")
-except ImportError:
-    print("[WARN] Google Generative AI SDK not installed.")
-    print("[TIP] Run: pip install google-generativeai --break-system-packages")
+STARTUP_TIMINGS: Dict[str, Any] = {
+    "imports": {},
+    "module_ready_ms": None,
+    "listening_ms": None,
+    "first_response_ms": None,
+}
+
+
+def _mark_startup(stage: str) -> None:
+    """Zapisuje (raz) czas od startu modułu do danego etapu."""
+    if STARTUP_TIMINGS.get(stage) is None:
+        STARTUP_TIMINGS[stage] = round((time.perf_counter() - _STARTUP_T0) * 1000, 1)
+
+
+def module_available(name: str) -> bool:
+    """Sprawdza, czy moduł jest zainstalowany - bez jego importowania."""
+    try:
+        return importlib.util.find_spec(name) is not None
+    except (ImportError, ValueError):
+        return False
+
+
+class LazySDK:
+    """Moduł SDK importowany przy pierwszym dostępie do atrybutu (np. anthropic.Anthropic)."""
+
+    def __init__(self, name: str) -> None:
+        self._name = name
+        self._module = None
+        self._lock = threading.Lock()
+
+    def load(self):
+        if self._module is None:
+            with self._lock:
+                if self._module is None:
+                    started = time.perf_counter()
+                    module = importlib.import_module(self._name)
+                    elapsed = round((time.perf_counter() - started) * 1000, 1)
+                    STARTUP_TIMINGS["imports"][self._name] = elapsed
+                    log(f"STARTUP: imported {self._name} in {elapsed} ms")
+                    self._module = module
+        return self._module
+
+    @property
+    def loaded(self) -> bool:
+        return self._module is not None
+
+    def __getattr__(self, attr: str):
+        return getattr(self.load(), attr)
+
+
+anthropic = LazySDK("anthropic")
+genai = LazySDK("google.generativeai")
+openai = LazySDK("openai")  # Grok (xAI używa API kompatybilnego z OpenAI)
+
+ANTHROPIC_AVAILABLE = module_available("anthropic")
+GOOGLE_AI_AVAILABLE = module_available("google.generativeai")
+OPENAI_AVAILABLE = module_available("openai")
+
+for _sdk, _package, _available in (
+    ("Anthropic SDK", "anthropic", ANTHROPIC_AVAILABLE),
+    ("Google Generative AI SDK", "google-generativeai", GOOGLE_AI_AVAILABLE),
+    ("OpenAI SDK (needed for Grok)", "openai", OPENAI_AVAILABLE),
+):
+    if not _available:
+        print(f"[WARN] {_sdk} not installed.")
+        print(f"[TIP] Run: pip install {_package} --break-system-packages")
+
+
+def preload_sdks() -> None:
+    """Importuje zainstalowane SDK z góry (np. przed fork, by dzielić pamięć)."""
+    for sdk, available in ((anthropic, ANTHROPIC_AVAILABLE), (genai, GOOGLE_AI_AVAILABLE), (openai, OPENAI_AVAILABLE)):
+        if available:
+            try:
+                sdk.load()
+            except Exception as e:
+                log(f"STARTUP: preload of {sdk._name} failed: {e}")
+
+
+def startup_report() -> Dict[str, Any]:
+    """Raport czasu startu: importy SDK oraz czas do nasłuchu i pierwszej odpowiedzi."""
+    return {
+        "pid": os.getpid(),
+        "imports_ms": dict(STARTUP_TIMINGS["imports"]),
+        "module_ready_ms": STARTUP_TIMINGS["module_ready_ms"],
+        "listening_ms": STARTUP_TIMINGS["listening_ms"],
+        "first_response_ms": STARTUP_TIMINGS["first_response_ms"],
+    }
 
-# OpenAI SDK for Grok (xAI uses OpenAI-compatible API)
-OPENAI_AVAILABLE = False
-try:
-    from openai import OpenAI
-    OPENAI_AVAILABLE = True
-    print("[OK] OpenAI SDK available (for Grok/xAI)")
-except ImportError:
-    print("[WARN] OpenAI SDK not installed (needed for Grok).")
-    print("[TIP] Run: pip install openai --break-system-packages")
 
 LOG_DIR = "logs"
 LOG_FILE = os.path.join(LOG_DIR, "server_log.txt")
-CHAT_LOG = os.path.join(LOG_DIR, "chat.log")
 AI_COMMAND_LOG = os.path.join(LOG_DIR, "ai-commands.log")
 
 # Ensure logs directory exists
@@ -66,7 +168,7 @@ os.makedirs(LOG_DIR, exist_ok=True)
 
 def log(msg: str) -> None:
     """Zapisuje wiadomość do logu z timestampem (opcjonalne)."""
-    if os.environ.get("ENABLE_LOGGING", "true").lower() != "true":
+    if not CONFIG.enable_logging:
         return
     try:
         with open(LOG_FILE, "a", encoding="utf-8") as f:
@@ -76,166 +178,3348 @@ def log(msg: str) -> None:
         pass
 
 
-def log_chat(role: str, content: str) -> None:
-    """Zapisuje interakcję czatu do pliku logu (opcjonalne)."""
-    if os.environ.get("ENABLE_LOGGING", "true").lower() != "true":
+def log_ai_command(command: str, result: str, exit_code: int = 0) -> None:
+    """Zapisuje komendy wykonywane przez AI (opcjonalne)."""
+    if not CONFIG.enable_logging:
         return
     try:
-        with open(CHAT_LOG, "a", encoding="utf-8") as f:
+        with open(AI_COMMAND_LOG, "a", encoding="utf-8") as f:
             ts = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-            f.write(f"[{ts}] [{role.upper()}] {content}\n")
+            f.write(f"[{ts}]\n")
+            f.write(f"Command: {command}\n")
+            f.write(f"Exit Code: {exit_code}\n")
+            f.write(f"Result: {result}\n")
+            f.write(f"{'='*80}\n\n")
     except Exception:
         pass
 
 
-def log_ai_command(command: str, result: str, exit_code: int = 0) -> None:
-    """Zapisuje komendy wykonywane przez AI (opcjonalne)."""
-    if os.environ.get("ENABLE_LOGGING", "true").lower() != "true":
-        return
-    try:
-        with open(AI_COMMAND_LOG, "a", encoding="utf-8") as f:
-            ts = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-            f.write(f"[{ts}]\n")
-            f.write(f"Command: {command}\n")
-            f.write(f"Exit Code: {exit_code}\n")
-            f.write(f"Result: {result}\n")
-            f.write(f"{'='*80}\n\n")
-    except Exception:
-        pass
+DANGEROUS_COMMAND_PATTERNS = ["rm -rf", "del /f", "format ", "mkfs", "dd if="]
+
+
+def command_allowed(cmd: str) -> bool:
+    """Sprawdza komendę względem SAFE_MODE (bez SAFE_MODE tylko ostrzeżenie w logu)."""
+    if any(pattern in cmd.lower() for pattern in DANGEROUS_COMMAND_PATTERNS):
+        if get_config().safe_mode:
+            log(f"WARNING: Potentially dangerous command blocked: {cmd}")
+            return False
+        log(f"WARNING: Executing potentially dangerous command: {cmd}")
+    return True
+
+
+def translate_command(cmd: str) -> str:
+    """Windows command translation (ls -> dir)."""
+    if platform.system() == "Windows":
+        if cmd.strip() == "ls":
+            cmd = "dir"
+        if cmd.startswith("ls "):
+            cmd = cmd.replace("ls ", "dir ", 1)
+    return cmd
+
+
+def validate_api_key(key: Optional[str], provider: str) -> tuple[bool, Optional[str]]:
+    """
+    Validates API key format and returns (is_valid, error_message).
+    Relaxed validation - only checks if non-empty.
+
+    Args:
+        key: The API key to validate
+        provider: Provider name ('claude' or 'gemini')
+
+    Returns:
+        Tuple of (is_valid, error_message)
+    """
+    if not key:
+        return False, None
+
+    if not isinstance(key, str):
+        return False, f"{provider} API key must be a string"
+
+    key = key.strip()
+
+    if len(key) == 0:
+        return False, f"{provider} API key is empty"
+
+    # Relaxed validation - just check minimum length (no strict format checking)
+    if len(key) < 10:
+        return False, f"{provider} API key is too short (minimum 10 characters)"
+
+    return True, None
+
+
+# =============================================================================
+# Config - niezmienny snapshot konfiguracji z hot reloadem
+# =============================================================================
+# Budowany raz (walidacja kluczy raz na przeładowanie), współdzielony przez
+# wszystkie handlery i podmieniany atomowo, gdy zmieni się mtime pliku .env
+# albo po SIGHUP. Gorąca ścieżka czyta tylko zamrożony obiekt.
+
+# Jak często (s) sprawdzamy mtime pliku .env
+CONFIG_CHECK_INTERVAL = float(os.environ.get("CONFIG_CHECK_INTERVAL", "2"))
+
+
+@dataclass(frozen=True)
+class AdmissionSettings:
+    """Limity kontroli dopuszczenia dla całego serwera (prefork dzieli je między workery)."""
+    client_rpm: int = 120
+    client_tpm: int = 1_000_000
+    # (provider, rpm, tpm, max_concurrency)
+    provider_limits: tuple = ()
+    queue_size: int = 32
+    max_wait: float = 10.0
+    aging_seconds: float = 5.0
+
+
+@dataclass(frozen=True)
+class AppConfig:
+    """Zamrożony snapshot konfiguracji (klucze API i ustawienia runtime)."""
+    claude_key: Optional[str] = None
+    gemini_key: Optional[str] = None
+    grok_key: Optional[str] = None
+    default_provider: str = "claude"
+    enable_logging: bool = True
+    safe_mode: bool = False
+    command_timeout: int = 300
+    # Gateway czatu: hedging po tylu sekundach bez pierwszego tokenu, limit przerwy w streamie
+    hedge_after: float = 2.5
+    stream_idle_timeout: float = 120.0
+    chat_fallback_order: tuple = ("claude", "gemini", "grok")
+    admission: AdmissionSettings = field(default_factory=AdmissionSettings)
+    # Ile sekund czekamy na dokończenie aktywnych żądań przy zatrzymaniu
+    drain_timeout: float = 60.0
+    version: int = 1
+    loaded_at: float = 0.0
+    env_mtime: Optional[float] = None
+    warnings: tuple = field(default=(), compare=False)
+
+    def api_key(self, provider: str) -> Optional[str]:
+        return {"claude": self.claude_key, "gemini": self.gemini_key, "grok": self.grok_key}.get(provider)
+
+
+def _env_file_mtime() -> Optional[float]:
+    if not ENV_FILE:
+        return None
+    try:
+        return os.stat(ENV_FILE).st_mtime
+    except OSError:
+        return None
+
+
+def build_config(env: Dict[str, str], version: int = 1, env_mtime: Optional[float] = None) -> AppConfig:
+    """Buduje i waliduje snapshot konfiguracji ze słownika zmiennych."""
+    warnings = []
+    keys: Dict[str, Optional[str]] = {}
+    for provider, name in (("claude", "ANTHROPIC_API_KEY"), ("gemini", "GOOGLE_API_KEY"), ("grok", "XAI_API_KEY")):
+        value = env.get(name)
+        if value:
+            is_valid, error = validate_api_key(value, provider)
+            if not is_valid and error:
+                warnings.append(error)
+        keys[provider] = value.strip() if value and value.strip() else None
+
+    try:
+        command_timeout = int(env.get("COMMAND_TIMEOUT", "300"))
+    except ValueError:
+        warnings.append("COMMAND_TIMEOUT must be an integer, using 300")
+        command_timeout = 300
+
+    def number(name: str, default: Any, cast: Callable[[Any], Any] = float) -> Any:
+        try:
+            return cast(env.get(name, default))
+        except (TypeError, ValueError):
+            warnings.append(f"{name} must be a number, using {default}")
+            return cast(default)
+
+    providers = ("claude", "gemini", "grok")
+    provider_limits = []
+    for provider in providers:
+        prefix = f"RATE_LIMIT_{provider.upper()}"
+        provider_limits.append((
+            provider,
+            number(f"{prefix}_RPM", number("RATE_LIMIT_PROVIDER_RPM", 50, int), int),
+            number(f"{prefix}_TPM", number("RATE_LIMIT_PROVIDER_TPM", 400_000, int), int),
+            number(f"{provider.upper()}_MAX_CONCURRENCY", number("PROVIDER_MAX_CONCURRENCY", 8, int), int),
+        ))
+    admission = AdmissionSettings(
+        client_rpm=number("RATE_LIMIT_CLIENT_RPM", 120, int),
+        client_tpm=number("RATE_LIMIT_CLIENT_TPM", 1_000_000, int),
+        provider_limits=tuple(provider_limits),
+        queue_size=number("ADMISSION_QUEUE_SIZE", 32, int),
+        max_wait=number("ADMISSION_MAX_WAIT", 10),
+        aging_seconds=number("SCHEDULER_AGING_SECONDS", 5),
+    )
+
+    return AppConfig(
+        claude_key=keys["claude"],
+        gemini_key=keys["gemini"],
+        grok_key=keys["grok"],
+        default_provider=env.get("DEFAULT_AI_PROVIDER", "claude").lower(),
+        enable_logging=env.get("ENABLE_LOGGING", "true").lower() == "true",
+        safe_mode=env.get("SAFE_MODE", "false").lower() == "true",
+        command_timeout=command_timeout,
+        hedge_after=number("HEDGE_AFTER_MS", 2500) / 1000.0,
+        stream_idle_timeout=number("STREAM_IDLE_TIMEOUT", 120),
+        chat_fallback_order=tuple(
+            p.strip() for p in env.get("CHAT_FALLBACK_ORDER", ",".join(providers)).split(",")
+            if p.strip() in providers
+        ),
+        admission=admission,
+        drain_timeout=number("DRAIN_TIMEOUT", 60),
+        version=version,
+        loaded_at=time.time(),
+        env_mtime=env_mtime,
+        warnings=tuple(warnings),
+    )
+
+
+CONFIG = build_config(dict(os.environ), env_mtime=_env_file_mtime())
+_CONFIG_LOCK = threading.Lock()
+_CONFIG_NEXT_CHECK = 0.0
+_CONFIG_RELOAD_REQUESTED = False
+
+
+def reload_config() -> AppConfig:
+    """
+    Wczytuje ponownie .env i atomowo podmienia CONFIG.
+
+    Snapshot to os.environ bez wartości wziętych wcześniej z .env, nadpisany
+    bieżącą zawartością .env - os.environ nie jest modyfikowany, a klucz
+    usunięty z pliku (np. unieważniony ANTHROPIC_API_KEY) przestaje działać.
+
+    Zmiana limitów dopuszczenia podmienia ADMISSION na nowy kontroler -
+    wydane już zgody zwalniają sloty w starym, a buckety klientów startują pełne.
+    """
+    global CONFIG, _DOTENV_KEYS, ADMISSION
+    with _CONFIG_LOCK:
+        previous = CONFIG
+        mtime = _env_file_mtime()
+        env = {k: v for k, v in os.environ.items() if k not in _DOTENV_KEYS}
+        file_values: Dict[str, str] = {}
+        if DOTENV_AVAILABLE and ENV_FILE and mtime is not None:
+            # Zmienne procesu wygrywają z .env - tak jak przy starcie (load_dotenv)
+            file_values = {
+                k: v for k, v in dotenv_values(ENV_FILE).items()
+                if v is not None and k not in _PROCESS_ENV
+            }
+        env.update(file_values)
+        _DOTENV_KEYS = frozenset(file_values)
+        CONFIG = build_config(env, version=CONFIG.version + 1, env_mtime=mtime)
+        config = CONFIG
+        if config.admission != previous.admission:
+            ADMISSION = AdmissionController.from_config(config.admission, workers=WORKER_COUNT)
+    log(f"CONFIG: reloaded (version {config.version})")
+    if config.admission != previous.admission:
+        log("CONFIG: admission limits changed, admission controller rebuilt")
+    for warning in config.warnings:
+        log(f"WARNING: {warning}")
+    return config
+
+
+def request_config_reload(signum=None, frame=None) -> None:
+    """Zleca przeładowanie przy najbliższym get_config() (bezpieczne w signal handlerze)."""
+    global _CONFIG_RELOAD_REQUESTED
+    _CONFIG_RELOAD_REQUESTED = True
+
+
+def get_config() -> AppConfig:
+    """Zwraca bieżący snapshot; co CONFIG_CHECK_INTERVAL s sprawdza mtime .env."""
+    global _CONFIG_NEXT_CHECK, _CONFIG_RELOAD_REQUESTED
+    now = time.monotonic()
+    if _CONFIG_RELOAD_REQUESTED or now >= _CONFIG_NEXT_CHECK:
+        _CONFIG_NEXT_CHECK = now + CONFIG_CHECK_INTERVAL
+        if _CONFIG_RELOAD_REQUESTED or _env_file_mtime() != CONFIG.env_mtime:
+            _CONFIG_RELOAD_REQUESTED = False
+            return reload_config()
+    return CONFIG
+
+
+def get_api_keys() -> Dict[str, Optional[str]]:
+    """Zwraca klucze API z bieżącego snapshotu konfiguracji."""
+    config = get_config()
+    return {
+        "claude": config.claude_key,
+        "gemini": config.gemini_key,
+        "grok": config.grok_key,
+        "default_provider": config.default_provider,
+    }
+
+
+T = TypeVar('T')
+
+
+def upstream_status(error: BaseException) -> Optional[int]:
+    """Kod HTTP błędu SDK (anthropic/openai: status_code, google: code) albo None."""
+    for candidate in (getattr(error, "status_code", None), getattr(error, "code", None),
+                      getattr(getattr(error, "response", None), "status_code", None)):
+        if isinstance(candidate, int) and 100 <= candidate < 600:
+            return candidate
+    return None
+
+
+def upstream_retry_after(error: BaseException) -> Optional[float]:
+    """Retry-After (sekundy lub data HTTP, także retry-after-ms) z odpowiedzi upstream."""
+    headers = getattr(getattr(error, "response", None), "headers", None)
+    if not headers:
+        return None
+    try:
+        value = headers.get("retry-after-ms")
+        if value:
+            return max(0.0, float(value) / 1000.0)
+        value = headers.get("retry-after")
+        if not value:
+            return None
+        try:
+            return max(0.0, float(value))
+        except ValueError:
+            when = email.utils.parsedate_to_datetime(value)
+            return max(0.0, when.timestamp() - time.time())
+    except (TypeError, ValueError, AttributeError):
+        return None
+
+
+def retry_with_backoff(
+    func: Callable[[], T],
+    max_retries: int = 3,
+    initial_delay: float = 1.0,
+    max_delay: float = 10.0,
+    backoff_factor: float = 2.0,
+    retryable_exceptions: tuple = (Exception,)
+) -> T:
+    """
+    Retry a function with exponential backoff.
+
+    Rate limits are never retried here: callers hold an admission permit for a
+    single upstream request, so a 429 is raised as AdmissionRejected carrying
+    the provider's Retry-After, and other 4xx errors are raised immediately.
+
+    Args:
+        func: Function to retry
+        max_retries: Maximum number of retry attempts
+        initial_delay: Initial delay between retries (seconds)
+        max_delay: Maximum delay between retries (seconds)
+        backoff_factor: Multiplier for delay after each retry
+        retryable_exceptions: Tuple of exceptions that should trigger a retry
+
+    Returns:
+        Result of the function call
+
+    Raises:
+        AdmissionRejected: upstream answered 429 / rate limit
+        The last exception if all retries fail
+    """
+    delay = initial_delay
+    last_exception = None
+
+    for attempt in range(max_retries + 1):
+        try:
+            return func()
+        except retryable_exceptions as e:
+            last_exception = e
+            if isinstance(e, AdmissionRejected):
+                raise
+
+            error_str = str(e).lower()
+            status = upstream_status(e)
+            if status == 429 or (status is None and ('rate limit' in error_str or '429' in error_str)):
+                retry_after = upstream_retry_after(e)
+                raise AdmissionRejected(delay if retry_after is None else retry_after, "upstream_rate_limit") from e
+            if status is not None and 400 <= status < 500:
+                raise
+
+            # Don't retry on last attempt
+            if attempt == max_retries:
+                break
+
+            # Check if it's a retryable error
+            is_retryable = any(keyword in error_str for keyword in [
+                'timeout',
+                'connection',
+                'network',
+                '503',
+                '504',
+                'overloaded'
+            ])
+
+            if not is_retryable:
+                # Non-retryable error, raise immediately
+                raise
+
+            log(f"RETRY: Attempt {attempt + 1}/{max_retries} failed: {str(e)[:100]}")
+            log(f"RETRY: Waiting {delay:.1f}s before next attempt...")
+
+            time.sleep(delay)
+            delay = min(delay * backoff_factor, max_delay)
+
+    # All retries exhausted
+    log(f"RETRY: All {max_retries} retries exhausted")
+    raise last_exception
+
+
+# Limity okna kontekstu (tokeny wejścia + wyjścia) per rodzina modeli.
+# Dopasowanie po prefiksie - najdłuższy pasujący prefiks wygrywa.
+MODEL_CONTEXT_LIMITS: Dict[str, int] = {
+    "claude-": 200_000,
+    "gemini-1.5-pro": 2_097_152,
+    "gemini-": 1_048_576,
+    "grok-2": 131_072,
+    "grok-": 131_072,
+}
+DEFAULT_CONTEXT_LIMIT = 128_000
+DEFAULT_MAX_OUTPUT_TOKENS = 4096
+MIN_OUTPUT_TOKENS = 256
+
+# Stały narzut na wiadomość (rola, separatory) oraz szacunek dla obrazka
+MESSAGE_OVERHEAD_TOKENS = 4
+IMAGE_BLOCK_TOKENS = 1600
+
+
+def get_context_limit(model: str) -> int:
+    """Zwraca limit okna kontekstu dla modelu (najdłuższy pasujący prefiks)."""
+    best_prefix = ""
+    for prefix in MODEL_CONTEXT_LIMITS:
+        if model.startswith(prefix) and len(prefix) > len(best_prefix):
+            best_prefix = prefix
+    return MODEL_CONTEXT_LIMITS[best_prefix] if best_prefix else DEFAULT_CONTEXT_LIMIT
+
+
+def estimate_tokens(text: str) -> int:
+    """
+    Szybki lokalny szacunek liczby tokenów.
+
+    Liczy ~4 bajty UTF-8 na token, więc tekst nie-ASCII (polskie znaki, CJK)
+    jest automatycznie ważony mocniej. Celowo zawyża wynik zamiast go zaniżać -
+    lepiej przyciąć o jedną wiadomość za dużo niż dostać 400 od API.
+    """
+    if not text:
+        return 0
+    return (len(text.encode("utf-8")) + 3) // 4
+
+
+def estimate_message_tokens(message: Dict[str, Any]) -> int:
+    """Szacuje tokeny pojedynczej wiadomości (string lub lista bloków)."""
+    content = message.get("content", "")
+    tokens = MESSAGE_OVERHEAD_TOKENS
+
+    if isinstance(content, str):
+        return tokens + estimate_tokens(content)
+
+    if isinstance(content, list):
+        return tokens + _estimate_blocks_tokens(content)
+
+    return tokens + estimate_tokens(str(content))
+
+
+def _estimate_blocks_tokens(blocks: list) -> int:
+    tokens = 0
+    for block in blocks:
+        if not isinstance(block, dict):
+            tokens += estimate_tokens(str(block))
+        elif block.get("type") == "image":
+            tokens += IMAGE_BLOCK_TOKENS
+        elif "text" in block:
+            tokens += estimate_tokens(str(block.get("text", "")))
+        else:
+            tokens += estimate_tokens(json.dumps(block, ensure_ascii=False))
+    return tokens
+
+
+def validate_system_prompt(system: Any) -> Optional[str]:
+    """Zwraca komunikat błędu, gdy `system` nie jest stringiem ani listą bloków tekstowych."""
+    if system is None or isinstance(system, str):
+        return None
+    if isinstance(system, list) and all(
+        isinstance(block, dict) and isinstance(block.get("text"), str) for block in system
+    ):
+        return None
+    return "Invalid request: 'system' must be a string or an array of text blocks"
+
+
+def system_prompt_text(system: Any) -> str:
+    """Spłaszcza system prompt w formie listy bloków do tekstu (dla providerów bez bloków)."""
+    if isinstance(system, list):
+        return "\n\n".join(block["text"] for block in system)
+    return system or ""
+
+
+def estimate_system_tokens(system: Any) -> int:
+    """Szacuje tokeny system promptu (string lub lista bloków jak w Anthropic API)."""
+    if isinstance(system, list):
+        return _estimate_blocks_tokens(system)
+    return estimate_tokens(system) if isinstance(system, str) else 0
+
+
+def estimate_messages_tokens(messages: list, system: Any = "") -> int:
+    """Szacuje łączną liczbę tokenów wejścia dla system promptu i historii."""
+    total = estimate_system_tokens(system)
+    for message in messages:
+        if isinstance(message, dict):
+            total += estimate_message_tokens(message)
+    return total
+
+
+class ContextLengthError(ValueError):
+    """Żądanie nie zmieści się w oknie kontekstu nawet po przycięciu."""
+
+
+def fit_messages_to_context(
+    messages: list,
+    system: Any,
+    model: str,
+    max_tokens: int = DEFAULT_MAX_OUTPUT_TOKENS,
+) -> tuple[list, str, int, Dict[str, Any]]:
+    """
+    Przycina historię tak, żeby żądanie zmieściło się w oknie kontekstu.
+
+    Polityka:
+    - system prompt i wiadomości oznaczone "pinned": true są zawsze zachowane,
+    - ostatnia wiadomość (bieżąca tura użytkownika) jest zawsze zachowana,
+    - najstarsze niepinowane tury są usuwane jako pierwsze,
+    - historia po przycięciu zaczyna się od wiadomości użytkownika,
+    - w miejsce usuniętych tur do system promptu trafia krótka adnotacja,
+    - jeśli nadal brakuje miejsca, max_tokens jest zmniejszane (min. MIN_OUTPUT_TOKENS).
+
+    Returns:
+        Tuple of (messages, system, max_tokens, info)
+
+    Raises:
+        ContextLengthError: gdy nie da się zmieścić nawet minimalnego żądania
+    """
+    limit = get_context_limit(model)
+    # Klucz "pinned" jest tylko dla nas - API go nie akceptuje
+    pinned = [bool(m.get("pinned")) if isinstance(m, dict) else False for m in messages]
+    cleaned = [
+        {k: v for k, v in m.items() if k != "pinned"} if isinstance(m, dict) else m
+        for m in messages
+    ]
+    costs = [estimate_message_tokens(m) if isinstance(m, dict) else 0 for m in cleaned]
+
+    input_tokens = estimate_system_tokens(system) + sum(costs)
+    info: Dict[str, Any] = {
+        "context_limit": limit,
+        "estimated_input_tokens": input_tokens,
+        "dropped_messages": 0,
+        "max_tokens": max_tokens,
+    }
+
+    if input_tokens + max_tokens <= limit:
+        return cleaned, system, max_tokens, info
+
+    keep = [True] * len(cleaned)
+    last = len(cleaned) - 1
+    dropped = 0
+    note_tokens = estimate_tokens(" [NNNNNN earlier messages omitted to fit the context window]")
+
+    def first_kept_index() -> int:
+        return next((i for i, k in enumerate(keep) if k), -1)
+
+    for i in range(last):
+        if input_tokens + note_tokens + max_tokens <= limit:
+            break
+        if pinned[i]:
+            continue
+        keep[i] = False
+        input_tokens -= costs[i]
+        dropped += 1
+
+    # Historia musi zaczynać się od tury użytkownika
+    first = first_kept_index()
+    while 0 <= first < last and not pinned[first] and \
+            isinstance(cleaned[first], dict) and cleaned[first].get("role") != "user":
+        keep[first] = False
+        input_tokens -= costs[first]
+        dropped += 1
+        first = first_kept_index()
+
+    if dropped:
+        input_tokens += note_tokens
+        note = f"[{dropped} earlier messages omitted to fit the context window]"
+        if isinstance(system, list):
+            system = system + [{"type": "text", "text": note}]
+        else:
+            system = f"{system}\n\n{note}"
+
+    available = limit - input_tokens
+    if available < max_tokens:
+        if available < MIN_OUTPUT_TOKENS:
+            raise ContextLengthError(
+                f"Request needs ~{input_tokens} input tokens but {model} allows {limit} "
+                f"(including at least {MIN_OUTPUT_TOKENS} output tokens)"
+            )
+        max_tokens = available
+
+    trimmed = [m for m, k in zip(cleaned, keep) if k]
+    info.update({
+        "estimated_input_tokens": input_tokens,
+        "dropped_messages": dropped,
+        "max_tokens": max_tokens,
+    })
+    log(f"CONTEXT TRIM: model={model}, dropped={dropped}, input~{input_tokens}, max_tokens={max_tokens}")
+    return trimmed, system, max_tokens, info
+
+
+
+# =============================================================================
+# Stream cancellation - przerwanie generowania po rozłączeniu klienta lub na żądanie
+# =============================================================================
+# Każdy stream czatu ma request_id (nagłówek X-Request-ID, pole "request_id" albo
+# nowy uuid). Wątek-strażnik co STREAM_WATCH_INTERVAL sprawdza gniazda aktywnych
+# streamów (FIN/RST od klienta) i znaczniki anulowania od innych workerów prefork.
+# Handler przerywa pętlę przy najbliższym chunku - wyjście z pętli zamyka
+# połączenie upstream, więc model przestaje generować (i naliczać) tokeny.
+
+STREAM_WATCH_INTERVAL = float(os.environ.get("STREAM_WATCH_MS", "250")) / 1000.0
+# Znaczniki anulowania dla streamów obsługiwanych przez inny worker prefork
+STREAM_CANCEL_DIR = os.environ.get("STREAM_CANCEL_DIR", os.path.join(LOG_DIR, "cancel"))
+STREAM_CANCEL_MARKER_TTL = 600.0
+# Tolerancja rozdzielczości mtime - znacznik starszy niż start streamu dotyczy poprzedniego
+STREAM_CANCEL_MARKER_SKEW = 0.1
+REQUEST_ID_PATTERN = re.compile(r"^[A-Za-z0-9_-][A-Za-z0-9._-]{0,127}$")
+
+
+class StreamCancelled(Exception):
+    """Stream przerwany - klient się rozłączył albo wywołano POST /api/chat/cancel."""
+
+    def __init__(self, reason: str):
+        super().__init__(reason)
+        self.reason = reason
+
+
+class ActiveStream:
+    """
+    Jeden aktywny stream czatu: zdarzenie anulowania, powód i budżet tokenów.
+
+    Stream upstream zarejestrowany przez track() jest zamykany przy cancel(),
+    więc anulowanie ze strażnika albo /api/chat/cancel przerywa wiszący odczyt
+    zamiast czekać na kolejny token.
+    """
+
+    def __init__(self, request_id: str, max_tokens: int, sock: Optional[socket.socket] = None) -> None:
+        self.request_id = request_id
+        self.max_tokens = max_tokens
+        self.sock = sock
+        self.reason: Optional[str] = None
+        self.event = threading.Event()
+        # Czas ścienny - porównywany z mtime znaczników anulowania
+        self.started_at = time.time()
+        self._lock = threading.Lock()
+        self._upstreams: List[Any] = []
+
+    @property
+    def cancelled(self) -> bool:
+        return self.event.is_set()
+
+    def track(self, resource: Any) -> Any:
+        """Rejestruje otwarty stream upstream do zamknięcia przy anulowaniu."""
+        with self._lock:
+            self._upstreams.append(resource)
+            cancelled = self.event.is_set()
+        if cancelled:
+            _close_upstream(resource)
+        return resource
+
+    def cancel(self, reason: str) -> None:
+        with self._lock:
+            if self.reason is None:
+                self.reason = reason
+            self.event.set()
+            upstreams, self._upstreams = self._upstreams, []
+        for resource in upstreams:
+            _close_upstream(resource)
+
+
+def client_disconnected(sock: Optional[socket.socket]) -> bool:
+    """Sprawdza bez blokowania, czy klient zamknął połączenie (odczyt zwraca EOF)."""
+    if sock is None:
+        return False
+    try:
+        readable, _, _ = select.select([sock], [], [], 0)
+        if not readable:
+            return False
+        # Gniazdo czytelne w trakcie odpowiedzi: EOF = klient zamknął połączenie
+        return sock.recv(1, socket.MSG_PEEK) == b""
+    except (BlockingIOError, InterruptedError, socket.timeout):
+        return False
+    except (OSError, ValueError):
+        return True
+
+
+class StreamRegistry:
+    """Rejestr aktywnych streamów (per proces) ze statystyką anulowań i zaoszczędzonych tokenów."""
+
+    def __init__(self, watch_interval: float = STREAM_WATCH_INTERVAL,
+                 cancel_dir: str = STREAM_CANCEL_DIR) -> None:
+        self.watch_interval = watch_interval
+        self.cancel_dir = cancel_dir
+        self._lock = threading.Lock()
+        self._streams: Dict[str, ActiveStream] = {}
+        self._watcher: Optional[threading.Thread] = None
+        self._watcher_pid: Optional[int] = None
+        self._stats: Dict[str, Any] = {
+            "started": 0,
+            "completed": 0,
+            "cancelled": 0,
+            "reasons": {},
+            "output_tokens_at_cancel": 0,
+            # Górne oszacowanie: niewykorzystany budżet max_tokens w chwili anulowania
+            "tokens_saved": 0,
+        }
+
+    def register(self, request_id: str, max_tokens: int, sock: Optional[socket.socket] = None) -> ActiveStream:
+        with self._lock:
+            if request_id in self._streams:
+                request_id = f"{request_id}-{uuid.uuid4().hex[:8]}"
+            stream = ActiveStream(request_id, max_tokens, sock)
+            self._streams[request_id] = stream
+            self._stats["started"] += 1
+            # Po fork (prefork) wątek strażnika nie istnieje w dziecku - startujemy go per proces
+            if self._watcher is None or self._watcher_pid != os.getpid() or not self._watcher.is_alive():
+                self._watcher_pid = os.getpid()
+                self._watcher = threading.Thread(target=self._watch_loop, name="stream-watcher", daemon=True)
+                self._watcher.start()
+        return stream
+
+    def finish(self, stream: ActiveStream, output_tokens: int) -> None:
+        """Wyrejestrowuje stream i dolicza go do statystyk."""
+        with self._lock:
+            self._streams.pop(stream.request_id, None)
+            if stream.cancelled:
+                reasons = self._stats["reasons"]
+                reasons[stream.reason] = reasons.get(stream.reason, 0) + 1
+                self._stats["cancelled"] += 1
+                self._stats["output_tokens_at_cancel"] += output_tokens
+                self._stats["tokens_saved"] += max(0, stream.max_tokens - output_tokens)
+            else:
+                self._stats["completed"] += 1
+        if stream.cancelled:
+            log(f"STREAM: {stream.request_id} cancelled ({stream.reason}) after ~{output_tokens} tokens")
+        if WORKER_COUNT > 1:
+            # Także bez anulowania - spóźniony znacznik nie może zabić ponowienia z tym samym id
+            try:
+                os.remove(os.path.join(self.cancel_dir, stream.request_id))
+            except OSError:
+                pass
+
+    def cancel(self, request_id: str, reason: str = "cancel_request") -> str:
+        """
+        Anuluje stream o podanym id.
+
+        Returns:
+            "cancelled" - stream działał w tym procesie,
+            "broadcast" - zostawiono znacznik dla pozostałych workerów prefork,
+            "not_found" - brak takiego streamu
+        """
+        with self._lock:
+            stream = self._streams.get(request_id)
+        if stream is not None:
+            stream.cancel(reason)
+            return "cancelled"
+        if WORKER_COUNT <= 1:
+            return "not_found"
+        os.makedirs(self.cancel_dir, exist_ok=True)
+        self._prune_markers()
+        with open(os.path.join(self.cancel_dir, request_id), "w"):
+            pass
+        return "broadcast"
+
+    def _prune_markers(self) -> None:
+        cutoff = time.time() - STREAM_CANCEL_MARKER_TTL
+        try:
+            with os.scandir(self.cancel_dir) as it:
+                for entry in it:
+                    try:
+                        if entry.stat().st_mtime < cutoff:
+                            os.remove(entry.path)
+                    except OSError:
+                        pass
+        except OSError:
+            pass
+
+    def _watch_loop(self) -> None:
+        while True:
+            time.sleep(self.watch_interval)
+            with self._lock:
+                if not self._streams:
+                    # Nic do pilnowania - następny register uruchomi strażnika ponownie
+                    self._watcher = None
+                    return
+                streams = [s for s in self._streams.values() if not s.cancelled]
+            markers: Dict[str, float] = {}
+            if WORKER_COUNT > 1:
+                try:
+                    with os.scandir(self.cancel_dir) as it:
+                        for entry in it:
+                            try:
+                                markers[entry.name] = entry.stat().st_mtime
+                            except OSError:
+                                pass
+                except OSError:
+                    pass
+            for stream in streams:
+                marked_at = markers.get(stream.request_id)
+                if marked_at is not None and marked_at >= stream.started_at - STREAM_CANCEL_MARKER_SKEW:
+                    stream.cancel("cancel_request")
+                elif client_disconnected(stream.sock):
+                    stream.cancel("client_disconnected")
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return dict(self._stats, reasons=dict(self._stats["reasons"]), active=len(self._streams))
+
+
+STREAMS = StreamRegistry()
+
+
+
+# =============================================================================
+# Chat gateway - jeden streaming endpoint dla Claude, Gemini i Grok
+# =============================================================================
+
+XAI_BASE_URL = "https://api.x.ai/v1"
+
+PROVIDER_KEY_ENV: Dict[str, str] = {
+    "claude": "ANTHROPIC_API_KEY",
+    "gemini": "GOOGLE_API_KEY",
+    "grok": "XAI_API_KEY",
+}
+
+DEFAULT_PROVIDER_MODELS: Dict[str, str] = {
+    "claude": "claude-sonnet-4-20250514",
+    "gemini": "gemini-2.5-flash",
+    "grok": "grok-2-latest",
+}
+
+GATEWAY_STATS: Dict[str, Any] = {
+    "requests": 0,
+    "hedges_started": 0,
+    "failovers": 0,
+    "all_failed": 0,
+    "wins": {provider: 0 for provider in PROVIDER_KEY_ENV},
+}
+_gateway_stats_lock = threading.Lock()
+
+
+def _bump_gateway_stat(name: str, provider: Optional[str] = None) -> None:
+    """Thread-safe increment of a GATEWAY_STATS counter."""
+    with _gateway_stats_lock:
+        if provider is not None:
+            GATEWAY_STATS[name][provider] = GATEWAY_STATS[name].get(provider, 0) + 1
+        else:
+            GATEWAY_STATS[name] += 1
+
+
+def _message_text(message: Dict[str, Any]) -> str:
+    """Spłaszcza treść wiadomości (string lub lista bloków) do zwykłego tekstu."""
+    content = message.get("content", "")
+    if isinstance(content, str):
+        return content
+    if isinstance(content, list):
+        return "\n".join(
+            str(block.get("text", "")) for block in content
+            if isinstance(block, dict) and "text" in block
+        )
+    return str(content)
+
+
+_upstream_local = threading.local()
+
+
+def track_upstream(resource: Any) -> Any:
+    """
+    Rejestruje otwarty stream SDK trasy, żeby koordynator mógł go zamknąć.
+
+    Przegrana trasa hedgingu może wisieć w odczycie upstream - zamknięcie
+    odpowiedzi z innego wątku przerywa ten odczyt, zamiast czekać na kolejny
+    chunk (albo timeout). Poza wątkiem trasy nic nie robi.
+    """
+    attempt = getattr(_upstream_local, "attempt", None)
+    if attempt is not None:
+        with attempt["lock"]:
+            attempt["upstreams"].append(resource)
+            cancelled = attempt["cancel"].is_set()
+        if cancelled:
+            _close_upstream(resource)
+    return resource
+
+
+def _close_upstream(resource: Any) -> None:
+    close = getattr(resource, "close", None)
+    if close is None:
+        return
+    try:
+        close()
+    except Exception as e:
+        log(f"STREAM: closing upstream failed: {e}")
+
+
+def _stream_claude(model: str, system: str, messages: list, max_tokens: int) -> Iterator[str]:
+    """Streamuje odpowiedź z Claude (Anthropic)."""
+    client = anthropic.Anthropic(api_key=get_config().claude_key)
+    with client.messages.stream(
+        model=model,
+        max_tokens=max_tokens,
+        system=system,
+        messages=messages,
+    ) as stream_response:
+        track_upstream(stream_response)
+        for text in stream_response.text_stream:
+            yield text
+
+
+def _stream_gemini(model: str, system: str, messages: list, max_tokens: int) -> Iterator[str]:
+    """Streamuje odpowiedź z Gemini (Google)."""
+    genai.configure(api_key=get_config().gemini_key)
+    gemini_model = genai.GenerativeModel(model, system_instruction=system or None)
+    contents = [
+        {
+            "role": "model" if m.get("role") == "assistant" else "user",
+            "parts": [_message_text(m)],
+        }
+        for m in messages
+    ]
+    response = gemini_model.generate_content(
+        contents,
+        stream=True,
+        generation_config={"max_output_tokens": max_tokens},
+    )
+    track_upstream(response)
+    for chunk in response:
+        try:
+            text = chunk.text
+        except ValueError:
+            # Chunk bez części tekstowych (np. zablokowany przez safety filter)
+            continue
+        if text:
+            yield text
+
+
+def _stream_grok(model: str, system: str, messages: list, max_tokens: int) -> Iterator[str]:
+    """Streamuje odpowiedź z Grok (xAI, API kompatybilne z OpenAI)."""
+    client = openai.OpenAI(api_key=get_config().grok_key, base_url=XAI_BASE_URL)
+    payload = [{"role": "system", "content": system}] if system else []
+    payload += [{"role": m.get("role"), "content": _message_text(m)} for m in messages]
+    stream_response = client.chat.completions.create(
+        model=model,
+        messages=payload,
+        max_tokens=max_tokens,
+        stream=True,
+    )
+    track_upstream(stream_response)
+    try:
+        for chunk in stream_response:
+            if chunk.choices and chunk.choices[0].delta.content:
+                yield chunk.choices[0].delta.content
+    finally:
+        close = getattr(stream_response, "close", None)
+        if close:
+            close()
+
+
+PROVIDER_STREAMERS: Dict[str, Callable[[str, str, list, int], Iterator[str]]] = {
+    "claude": _stream_claude,
+    "gemini": _stream_gemini,
+    "grok": _stream_grok,
+}
+
+
+def provider_available(provider: str) -> bool:
+    """Sprawdza czy provider ma zainstalowane SDK i skonfigurowany klucz."""
+    sdk_available = {
+        "claude": ANTHROPIC_AVAILABLE,
+        "gemini": GOOGLE_AI_AVAILABLE,
+        "grok": OPENAI_AVAILABLE,
+    }.get(provider, False)
+    return sdk_available and bool(get_config().api_key(provider))
+
+
+def build_provider_routes(
+    primary: str,
+    model: Optional[str] = None,
+    fallback: bool = True,
+) -> List[Dict[str, str]]:
+    """
+    Buduje listę tras (provider + model) w kolejności prób.
+
+    Pierwsza trasa to provider główny z modelem z żądania, kolejne to
+    pozostałe skonfigurowane providery z CHAT_FALLBACK_ORDER i ich domyślne modele.
+    """
+    routes = [{"provider": primary, "model": model or DEFAULT_PROVIDER_MODELS.get(primary, "")}]
+    if fallback:
+        for provider in get_config().chat_fallback_order:
+            if provider != primary and provider_available(provider):
+                routes.append({"provider": provider, "model": DEFAULT_PROVIDER_MODELS[provider]})
+    return routes
+
+
+class ProviderError(Exception):
+    """Błąd providera w trakcie streamingu."""
+
+    def __init__(self, provider: str, error: Exception):
+        super().__init__(f"{provider}: {error}")
+        self.provider = provider
+        self.error = error
+
+
+class AllProvidersFailedError(Exception):
+    """Żadna trasa nie zwróciła odpowiedzi."""
+
+    def __init__(self, errors: Dict[str, str], retry_after: Optional[float] = None):
+        super().__init__("; ".join(f"{p}: {e}" for p, e in errors.items()) or "No providers available")
+        self.errors = errors
+        # Ustawione, gdy wszystkie trasy odrzuciła lokalna kontrola dopuszczenia
+        self.retry_after = retry_after
+
+
+def hedged_chat_stream(
+    routes: List[Dict[str, str]],
+    system: str,
+    messages: list,
+    max_tokens: int = DEFAULT_MAX_OUTPUT_TOKENS,
+    hedge_after: Optional[float] = None,
+    cancel: Optional[threading.Event] = None,
+) -> Iterator[Dict[str, Any]]:
+    """
+    Streamuje czat z pierwszej trasy, z hedgingiem i failoverem na kolejne.
+
+    - jeśli trasa nie da pierwszego tokenu w ciągu hedge_after sekund,
+      startuje równolegle kolejna trasa (hedge); hedge_after=None wyłącza hedging
+      (handlery podają get_config().hedge_after),
+    - bez żadnego zdarzenia przez STREAM_IDLE_TIMEOUT trasa jest uznawana za
+      martwą (przed pierwszym tokenem - failover, później ProviderError),
+    - jeśli trasa padnie przed pierwszym tokenem, od razu startuje kolejna (failover),
+    - wygrywa trasa, która pierwsza odda token; pozostałe są anulowane.
+
+    Yields:
+        {"provider", "model", "context"} raz na starcie, potem {"text": ...}
+
+    Ustawienie `cancel` (rozłączony klient, /api/chat/cancel) kończy stream
+    także w trakcie czekania na token. Anulowane trasy mają zamykane połączenia
+    upstream (track_upstream) od razu, z wątku koordynatora.
+
+    Raises:
+        AllProvidersFailedError: gdy wszystkie trasy padły przed pierwszym tokenem
+        ProviderError: gdy zwycięska trasa padła w trakcie streamingu
+        StreamCancelled: gdy ustawiono `cancel`
+    """
+    events: "queue.Queue[tuple]" = queue.Queue()
+    attempts: List[Dict[str, Any]] = []
+    errors: Dict[str, str] = {}
+    rejections: List[AdmissionRejected] = []
+
+    def launch(route: Dict[str, str]) -> None:
+        idx = len(attempts)
+        stop = threading.Event()
+        attempt = {"route": route, "cancel": stop, "failed": False, "upstreams": [], "lock": threading.Lock()}
+        attempts.append(attempt)
+
+        def worker() -> None:
+            streamer = PROVIDER_STREAMERS.get(route["provider"])
+            _upstream_local.attempt = attempt
+            try:
+                if streamer is None:
+                    raise ValueError(f"Unknown provider: {route['provider']}")
+                if not provider_available(route["provider"]):
+                    raise RuntimeError("SDK not installed or API key not configured")
+                msgs, sys_prompt, tokens, info = fit_messages_to_context(
+                    messages, system, route["model"], max_tokens
+                )
+                # Trasy zapasowe nie czekają w kolejce - limit = natychmiastowy failover
+                permit = ADMISSION.admit(
+                    None, route["provider"], info["estimated_input_tokens"] + tokens,
+                    max_wait=None if idx == 0 else 0.0,
+                )
+                events.put((idx, "meta", info))
+                try:
+                    chunks = streamer(route["model"], sys_prompt, msgs, tokens)
+                    try:
+                        for text in chunks:
+                            if stop.is_set():
+                                break
+                            if text:
+                                events.put((idx, "text", text))
+                    finally:
+                        # Zamknięcie generatora zamyka upstreamowe połączenie
+                        close = getattr(chunks, "close", None)
+                        if close:
+                            close()
+                finally:
+                    permit.release()
+                events.put((idx, "done", None))
+            except Exception as e:
+                events.put((idx, "error", e))
+            finally:
+                _upstream_local.attempt = None
+
+        threading.Thread(target=worker, name=f"gateway-{route['provider']}", daemon=True).start()
+        log(f"GATEWAY: started {route['provider']}/{route['model']} (attempt {idx + 1})")
+
+    def next_event(timeout: float) -> tuple:
+        if cancel is None:
+            return events.get(timeout=timeout)
+        # Czekamy porcjami, żeby zauważyć anulowanie przed kolejnym tokenem
+        deadline = time.monotonic() + timeout
+        while True:
+            if cancel.is_set():
+                raise StreamCancelled("cancelled")
+            try:
+                return events.get(timeout=min(STREAM_WATCH_INTERVAL, max(0.0, deadline - time.monotonic())))
+            except queue.Empty:
+                if time.monotonic() >= deadline:
+                    raise
+
+    def cancel_all(except_idx: Optional[int] = None) -> None:
+        for i, attempt in enumerate(attempts):
+            if i == except_idx or attempt["cancel"].is_set():
+                continue
+            with attempt["lock"]:
+                attempt["cancel"].set()
+                upstreams = list(attempt["upstreams"])
+            # Trasa zablokowana w odczycie nie zobaczy flagi - zamykamy jej odpowiedź
+            for resource in upstreams:
+                _close_upstream(resource)
+
+    _bump_gateway_stat("requests")
+    if not routes:
+        _bump_gateway_stat("all_failed")
+        raise AllProvidersFailedError({})
+
+    contexts: Dict[int, Dict[str, Any]] = {}
+    winner: Optional[int] = None
+    def fail_over_or_raise() -> None:
+        nonlocal hedge_deadline
+        if len(attempts) < len(routes):
+            _bump_gateway_stat("failovers")
+            launch(routes[len(attempts)])
+            hedge_deadline = time.monotonic() + hedge_after if hedge_after is not None else None
+            return
+        _bump_gateway_stat("all_failed")
+        retry_after = None
+        if len(rejections) == len(attempts):
+            retry_after = min(r.retry_after for r in rejections)
+        raise AllProvidersFailedError(errors, retry_after)
+
+    launch(routes[0])
+    hedge_deadline = time.monotonic() + hedge_after if hedge_after is not None else None
+    idle_timeout = get_config().stream_idle_timeout
+    idle_deadline = time.monotonic() + idle_timeout
+
+    try:
+        while True:
+            can_hedge = hedge_deadline is not None and winner is None and len(attempts) < len(routes)
+            # Czekanie zawsze ograniczone idle_timeout (także bez hedgingu)
+            wait_until = min(hedge_deadline, idle_deadline) if can_hedge else idle_deadline
+            try:
+                idx, kind, payload = next_event(max(0.0, wait_until - time.monotonic()))
+            except queue.Empty:
+                if can_hedge and time.monotonic() >= hedge_deadline:
+                    _bump_gateway_stat("hedges_started")
+                    log(f"GATEWAY: no first token after {hedge_after:.1f}s, hedging")
+                    launch(routes[len(attempts)])
+                    hedge_deadline = time.monotonic() + hedge_after
+                    continue
+                if time.monotonic() < idle_deadline:
+                    continue
+                timeout_error = TimeoutError(f"No data for {idle_timeout:.0f}s")
+                if winner is not None:
+                    raise ProviderError(attempts[winner]["route"]["provider"], timeout_error)
+                # Żadna trasa nie oddała tokenu - wszystkie uznajemy za martwe
+                log(f"GATEWAY: no data for {idle_timeout:.1f}s before first token")
+                for attempt in attempts:
+                    if not attempt["failed"]:
+                        attempt["failed"] = True
+                        errors[attempt["route"]["provider"]] = str(timeout_error)
+                cancel_all()
+                idle_deadline = time.monotonic() + idle_timeout
+                fail_over_or_raise()
+                continue
+
+            if winner is not None and idx != winner:
+                continue  # Resztki z anulowanej trasy
+            if attempts[idx]["failed"]:
+                continue  # Trasa już uznana za martwą (idle timeout)
+            idle_deadline = time.monotonic() + idle_timeout
+
+            route = attempts[idx]["route"]
+            if kind == "meta":
+                contexts[idx] = payload
+            elif kind in ("text", "done") and winner is None:
+                winner = idx
+                cancel_all(except_idx=idx)
+                _bump_gateway_stat("wins", route["provider"])
+                log(f"GATEWAY: {route['provider']} won (attempt {idx + 1})")
+                yield {"provider": route["provider"], "model": route["model"], "context": contexts.get(idx)}
+
+            if kind == "text":
+                yield {"text": payload}
+            elif kind == "done":
+                return
+            elif kind == "error":
+                if winner == idx:
+                    raise ProviderError(route["provider"], payload)
+                attempts[idx]["failed"] = True
+                errors[route["provider"]] = str(payload)
+                if isinstance(payload, AdmissionRejected):
+                    rejections.append(payload)
+                log(f"GATEWAY: {route['provider']} failed: {str(payload)[:200]}")
+                if all(a["failed"] for a in attempts):
+                    fail_over_or_raise()
+    finally:
+        cancel_all()
+
+
+# =============================================================================
+# Batch - wiele żądań czatu w jednym wywołaniu, wyniki jako NDJSON
+# =============================================================================
+
+BATCH_MAX_ITEMS = int(os.environ.get("BATCH_MAX_ITEMS", "500"))
+BATCH_MAX_PARALLELISM = int(os.environ.get("BATCH_MAX_PARALLELISM", "16"))
+BATCH_DEFAULT_PARALLELISM = 4
+# Elementy batcha mają najniższy priorytet, więc mogą czekać na slot dłużej
+BATCH_ITEM_MAX_WAIT = float(os.environ.get("BATCH_ITEM_MAX_WAIT", "120"))
+BATCH_CUSTOM_ID_PATTERN = re.compile(r"^[a-zA-Z0-9_-]{1,64}$")
+
+
+def validate_chat_messages(messages: Any) -> Optional[str]:
+    """Zwraca komunikat błędu albo None, jeśli lista wiadomości jest poprawna."""
+    if not isinstance(messages, list) or len(messages) == 0:
+        return "'messages' must be a non-empty array"
+    if not all(isinstance(m, dict) and m.get("role") in ("user", "assistant") for m in messages):
+        return "each message must be an object with role 'user' or 'assistant'"
+    return None
+
+
+def normalize_batch_items(data: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """
+    Waliduje listę żądań batcha i uzupełnia ją domyślnymi wartościami.
+
+    Pola "model", "system" i "max_tokens" z poziomu batcha są domyślne dla
+    elementów, które ich nie podają. Błędy pojedynczych elementów nie
+    przerywają batcha - element dostaje pole "error".
+
+    Raises:
+        ValueError: gdy "requests" nie jest niepustą listą lub jest za długa
+    """
+    requests_list = data.get("requests")
+    if not isinstance(requests_list, list) or len(requests_list) == 0:
+        raise ValueError("'requests' must be a non-empty array")
+    if len(requests_list) > BATCH_MAX_ITEMS:
+        raise ValueError(f"Too many requests in batch ({len(requests_list)} > {BATCH_MAX_ITEMS})")
+
+    default_model = data.get("model") if isinstance(data.get("model"), str) else DEFAULT_PROVIDER_MODELS["claude"]
+    default_system = data.get("system", "You are a helpful assistant.")
+    default_max_tokens = data.get("max_tokens", DEFAULT_MAX_OUTPUT_TOKENS)
+
+    items = []
+    seen_ids = set()
+    for i, raw in enumerate(requests_list):
+        raw = raw if isinstance(raw, dict) else {}
+        max_tokens = raw.get("max_tokens", default_max_tokens)
+        if not isinstance(max_tokens, int) or isinstance(max_tokens, bool) or max_tokens <= 0:
+            max_tokens = DEFAULT_MAX_OUTPUT_TOKENS
+        item = {
+            "index": i,
+            "custom_id": str(raw.get("custom_id", f"item-{i}")),
+            "model": raw.get("model") if isinstance(raw.get("model"), str) else default_model,
+            "system": raw.get("system", default_system),
+            "messages": raw.get("messages"),
+            "max_tokens": max_tokens,
+        }
+        error = validate_chat_messages(item["messages"]) or validate_system_prompt(item["system"])
+        if error is None and not BATCH_CUSTOM_ID_PATTERN.match(item["custom_id"]):
+            error = "'custom_id' must match [a-zA-Z0-9_-]{1,64}"
+        if error is None and item["custom_id"] in seen_ids:
+            error = f"duplicate custom_id '{item['custom_id']}'"
+        if error is None:
+            try:
+                item["messages"], item["system"], item["max_tokens"], _ = fit_messages_to_context(
+                    item["messages"], item["system"], item["model"], item["max_tokens"]
+                )
+            except ContextLengthError as e:
+                error = str(e)
+        if error is not None:
+            item["error"] = error
+        seen_ids.add(item["custom_id"])
+        items.append(item)
+    return items
+
+
+def iter_batch_results(
+    items: List[Dict[str, Any]],
+    worker: Callable[[Dict[str, Any]], Dict[str, Any]],
+    parallelism: int = BATCH_DEFAULT_PARALLELISM,
+    cancel: Optional[threading.Event] = None,
+) -> Iterator[Dict[str, Any]]:
+    """
+    Wykonuje worker(item) dla elementów batcha z ograniczoną równoległością.
+
+    Wyniki są zwracane w kolejności ukończenia (nie wejścia). Ustawienie
+    cancel anuluje elementy, które jeszcze nie wystartowały.
+    """
+    def run(item: Dict[str, Any]) -> Dict[str, Any]:
+        base = {"index": item["index"], "custom_id": item["custom_id"]}
+        if "error" in item:
+            return {**base, "status": "errored", "type": "invalid_request", "error": item["error"]}
+        if cancel is not None and cancel.is_set():
+            return {**base, "status": "canceled"}
+        started = time.monotonic()
+        try:
+            result = worker(item)
+            return {**base, "status": "succeeded", **result,
+                    "latency_ms": int((time.monotonic() - started) * 1000)}
+        except AdmissionRejected as e:
+            return {**base, "status": "errored", "type": "rate_limit_error", "error": str(e),
+                    "retry_after": max(1, math.ceil(e.retry_after))}
+        except Exception as e:
+            return {**base, "status": "errored", "type": "api_error", "error": str(e),
+                    "latency_ms": int((time.monotonic() - started) * 1000)}
+
+    parallelism = max(1, min(parallelism, BATCH_MAX_PARALLELISM))
+    executor = ThreadPoolExecutor(max_workers=parallelism, thread_name_prefix="batch")
+    try:
+        futures = [executor.submit(run, item) for item in items]
+        for future in as_completed(futures):
+            yield future.result()
+    finally:
+        if cancel is not None:
+            cancel.set()
+        executor.shutdown(wait=False, cancel_futures=True)
+
+
+# =============================================================================
+# Admission control - token buckety per klient / provider + limit współbieżności
+# =============================================================================
+
+def _env_int(name: str, default: int) -> int:
+    """Czyta liczbę całkowitą ze zmiennej środowiskowej (z domyślną wartością)."""
+    try:
+        return int(os.environ.get(name, default))
+    except (TypeError, ValueError):
+        return default
+
+
+class TokenBucket:
+    """
+    Token bucket z rezerwacją (GCRA).
+
+    reserve() zawsze pobiera tokeny (saldo może zejść poniżej zera) i zwraca,
+    ile sekund trzeba odczekać, aż rezerwacja zostanie "spłacona". Dzięki temu
+    Retry-After jest dokładny, a odrzucona rezerwacja jest zwracana przez refund().
+    Pojemność <= 0 oznacza brak limitu.
+    """
+
+    def __init__(self, capacity: float, per_seconds: float = 60.0):
+        self.capacity = float(capacity)
+        self.rate = self.capacity / per_seconds if capacity > 0 else 0.0
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def reserve(self, amount: float) -> float:
+        """Rezerwuje tokeny i zwraca czas oczekiwania w sekundach."""
+        if self.capacity <= 0:
+            return 0.0
+        with self._lock:
+            self._refill()
+            self._tokens -= min(amount, self.capacity)
+            return 0.0 if self._tokens >= 0 else -self._tokens / self.rate
+
+    def refund(self, amount: float) -> None:
+        """Zwraca wcześniej zarezerwowane tokeny."""
+        if self.capacity <= 0 or amount <= 0:
+            return
+        with self._lock:
+            self._refill()
+            self._tokens = min(self.capacity, self._tokens + min(amount, self.capacity))
+
+    def available(self) -> float:
+        """Aktualna liczba dostępnych tokenów (ujemna = długi rezerwacji)."""
+        if self.capacity <= 0:
+            return float("inf")
+        with self._lock:
+            self._refill()
+            return self._tokens
+
+    def is_full(self) -> bool:
+        return self.available() >= self.capacity
+
+
+PRIORITY_CLASSES = ("interactive", "improve", "background", "bulk")
+
+
+class PriorityScheduler:
+    """
+    Przydziela ograniczoną liczbę slotów według priorytetu z postarzaniem.
+
+    Kolejność obsługi wyznacza czas wejścia do kolejki przesunięty o
+    rank * aging_seconds (interactive=0, improve=1, background=2, bulk=3).
+    Czat interaktywny wyprzedza więc pracę w tle, ale zadanie bulk czekające
+    dłużej niż 3 * aging_seconds nie zostanie zagłodzone.
+    """
+
+    def __init__(self, capacity: int, aging_seconds: float = 5.0):
+        self.capacity = capacity
+        self.aging_seconds = aging_seconds
+        self._free = capacity
+        self._heap: List[tuple] = []
+        self._seq = 0
+        self._lock = threading.Lock()
+
+    def acquire(self, priority: str = "interactive", timeout: Optional[float] = None) -> bool:
+        """Czeka na slot maksymalnie timeout sekund. Zwraca False po przekroczeniu."""
+        rank = PRIORITY_CLASSES.index(priority) if priority in PRIORITY_CLASSES else len(PRIORITY_CLASSES)
+        with self._lock:
+            if self._free > 0 and not self._heap:
+                self._free -= 1
+                return True
+            waiter = {"event": threading.Event(), "granted": False, "cancelled": False}
+            self._seq += 1
+            heapq.heappush(self._heap, (time.monotonic() + rank * self.aging_seconds, self._seq, waiter))
+
+        waiter["event"].wait(timeout)
+        with self._lock:
+            if waiter["granted"]:
+                return True
+            # Usuwanie leniwe - release() pominie anulowanego czekającego
+            waiter["cancelled"] = True
+            return False
+
+    def release(self) -> None:
+        """Oddaje slot najlepszemu czekającemu albo do puli wolnych."""
+        with self._lock:
+            while self._heap:
+                _, _, waiter = heapq.heappop(self._heap)
+                if not waiter["cancelled"]:
+                    waiter["granted"] = True
+                    waiter["event"].set()
+                    return
+            self._free += 1
+
+
+class AdmissionRejected(Exception):
+    """Żądanie przekroczyło limit i nie zmieści się w kolejce przed deadlinem."""
+
+    def __init__(self, retry_after: float, reason: str):
+        super().__init__(f"Rate limit ({reason}), retry after {retry_after:.1f}s")
+        self.retry_after = retry_after
+        self.reason = reason
+
+
+class AdmissionPermit:
+    """Zgoda na wywołanie upstream; zwalnia slot współbieżności przy release()."""
+
+    def __init__(self, controller: "AdmissionController", provider: Optional[str],
+                 token_reservations: List[tuple], tokens: int):
+        self._controller = controller
+        self._provider = provider
+        self._token_reservations = token_reservations
+        self._tokens = tokens
+        self._released = False
+
+    def settle(self, actual_tokens: int) -> None:
+        """Koryguje rezerwację TPM do faktycznego zużycia (zwraca nadwyżkę)."""
+        surplus = self._tokens - actual_tokens
+        if surplus > 0:
+            for bucket in self._token_reservations:
+                bucket.refund(surplus)
+            self._tokens = actual_tokens
+
+    def release(self) -> None:
+        if not self._released:
+            self._released = True
+            self._controller._release_slot(self._provider)
+
+    def __enter__(self) -> "AdmissionPermit":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.release()
+
+
+class AdmissionController:
+    """
+    Kontrola dopuszczenia żądań do providerów.
+
+    Każdy klient (IP) i każdy provider ma token buckety na żądania/min
+    i tokeny/min, a provider dodatkowo ograniczoną liczbę slotów współbieżności
+    przydzielanych przez PriorityScheduler według klasy priorytetu.
+    Żądanie ponad limit czeka w ograniczonej kolejce maksymalnie max_wait
+    sekund, w przeciwnym razie dostaje AdmissionRejected z retry_after.
+
+    Każda klasa priorytetu ma własną kolejkę (queue_size miejsc), więc zalew
+    zadań bulk nie odbiera czatowi miejsca. Buckety RPM/TPM providera są
+    rezerwowane dopiero po przydziale slotu - kolejność ich spłacania wyznacza
+    więc scheduler, a nie kolejność przyjścia żądań.
+    """
+
+    MAX_TRACKED_CLIENTS = 1024
+
+    def __init__(
+        self,
+        client_rpm: int = 120,
+        client_tpm: int = 1_000_000,
+        provider_limits: Optional[Dict[str, Dict[str, int]]] = None,
+        queue_size: int = 32,
+        max_wait: float = 10.0,
+        aging_seconds: float = 5.0,
+    ):
+        self.client_rpm = client_rpm
+        self.client_tpm = client_tpm
+        self.queue_size = queue_size
+        self.max_wait = max_wait
+        self._lock = threading.Lock()
+        self._clients: Dict[str, Dict[str, TokenBucket]] = {}
+        self._providers: Dict[str, Dict[str, Any]] = {}
+        self._queue_wait: Dict[str, Dict[str, float]] = {
+            cls: {"admitted": 0, "rejected": 0, "total_wait_ms": 0.0, "max_wait_ms": 0.0}
+            for cls in PRIORITY_CLASSES
+        }
+        for provider, limits in (provider_limits or {}).items():
+            self._providers[provider] = {
+                "rpm": TokenBucket(limits.get("rpm", 0)),
+                "tpm": TokenBucket(limits.get("tpm", 0)),
+                "slots": PriorityScheduler(limits.get("max_concurrency", 8), aging_seconds),
+                "max_concurrency": limits.get("max_concurrency", 8),
+                "in_flight": 0,
+                "waiting": {cls: 0 for cls in PRIORITY_CLASSES},
+                "admitted": 0,
+                "rejected": 0,
+            }
+
+    @classmethod
+    def from_config(cls, settings: AdmissionSettings, workers: int = 1) -> "AdmissionController":
+        """
+        Buduje kontroler z limitów snapshotu konfiguracji (RATE_LIMIT_* / ADMISSION_*).
+
+        W trybie prefork każdy z `workers` procesów dostaje równą część limitów,
+        żeby suma po wszystkich procesach odpowiadała konfiguracji.
+        """
+        def share(value: int) -> int:
+            return value if value <= 0 or workers <= 1 else max(1, math.ceil(value / workers))
+
+        provider_limits = {
+            provider: {"rpm": share(rpm), "tpm": share(tpm), "max_concurrency": max(1, share(concurrency))}
+            for provider, rpm, tpm, concurrency in settings.provider_limits
+        }
+        return cls(
+            client_rpm=share(settings.client_rpm),
+            client_tpm=share(settings.client_tpm),
+            provider_limits=provider_limits,
+            queue_size=settings.queue_size,
+            max_wait=settings.max_wait,
+            aging_seconds=settings.aging_seconds,
+        )
+
+    def _client_buckets(self, client: str) -> Dict[str, TokenBucket]:
+        with self._lock:
+            buckets = self._clients.get(client)
+            if buckets is None:
+                if len(self._clients) >= self.MAX_TRACKED_CLIENTS:
+                    # Pełne buckety nie niosą żadnej informacji - można je zapomnieć
+                    for key in [k for k, b in self._clients.items() if b["rpm"].is_full() and b["tpm"].is_full()]:
+                        del self._clients[key]
+                buckets = {"rpm": TokenBucket(self.client_rpm), "tpm": TokenBucket(self.client_tpm)}
+                self._clients[client] = buckets
+            return buckets
+
+    def admit(
+        self,
+        client: Optional[str],
+        provider: Optional[str],
+        tokens: int = 0,
+        requests: int = 1,
+        max_wait: Optional[float] = None,
+        priority: str = "interactive",
+    ) -> AdmissionPermit:
+        """
+        Dopuszcza żądanie (ewentualnie po odczekaniu) albo rzuca AdmissionRejected.
+
+        Args:
+            client: Identyfikator klienta (IP) lub None, by pominąć limity klienta
+            provider: Nazwa providera lub None, by pominąć limity providera
+            tokens: Szacowana liczba tokenów (wejście + max wyjścia)
+            requests: Liczba żądań do zaliczenia w RPM
+            max_wait: Maksymalny czas oczekiwania w kolejce (domyślnie ADMISSION_MAX_WAIT)
+            priority: Klasa priorytetu (interactive, improve, background, bulk)
+        """
+        if priority not in PRIORITY_CLASSES:
+            priority = "interactive"
+        max_wait = self.max_wait if max_wait is None else max_wait
+        started = time.monotonic()
+        deadline = started + max_wait
+        state = self._providers.get(provider) if provider else None
+
+        reservations: List[tuple] = []
+
+        def reserve(entries: List[tuple]) -> tuple:
+            wait, reason = 0.0, ""
+            for name, bucket, amount in entries:
+                reservations.append((name, bucket, amount))
+                bucket_wait = bucket.reserve(amount)
+                if bucket_wait > wait:
+                    wait, reason = bucket_wait, name
+            return wait, reason
+
+        def reject(retry_after: float, why: str) -> None:
+            for _, bucket, amount in reservations:
+                bucket.refund(amount)
+            with self._lock:
+                self._queue_wait[priority]["rejected"] += 1
+                if state is not None:
+                    state["rejected"] += 1
+            log(f"ADMISSION: rejected client={client} provider={provider} ({why}), retry after {retry_after:.1f}s")
+            raise AdmissionRejected(retry_after, why)
+
+        # Limity klienta dotyczą tylko jego własnych żądań - rezerwacja od razu
+        wait, reason = 0.0, ""
+        if client is not None:
+            buckets = self._client_buckets(client)
+            wait, reason = reserve([("client_rpm", buckets["rpm"], requests), ("client_tpm", buckets["tpm"], tokens)])
+            if wait > max_wait:
+                reject(wait, reason)
+
+        if wait > 0:
+            time.sleep(wait)
+        token_buckets = [bucket for name, bucket, _ in reservations if name.endswith("_tpm")]
+        if state is None:
+            self._record_wait(priority, started)
+            return AdmissionPermit(self, None, token_buckets, tokens)
+
+        with self._lock:
+            waiting = state["waiting"]
+            if waiting[priority] >= self.queue_size and state["in_flight"] >= state["max_concurrency"]:
+                queue_full = True
+            else:
+                queue_full = False
+                waiting[priority] += 1
+        if queue_full:
+            reject(1.0, "queue_full")
+
+        try:
+            acquired = state["slots"].acquire(priority, timeout=max(0.0, deadline - time.monotonic()))
+        finally:
+            with self._lock:
+                state["waiting"][priority] -= 1
+
+        if not acquired:
+            reject(1.0, "provider_concurrency")
+
+        with self._lock:
+            state["in_flight"] += 1
+
+        # Buckety providera w kolejności przydziału slotów (czyli wg priorytetu)
+        wait, reason = reserve([("provider_rpm", state["rpm"], requests), ("provider_tpm", state["tpm"], tokens)])
+        if wait > 0 and time.monotonic() + wait > deadline:
+            self._release_slot(provider)
+            reject(wait, reason)
+        if wait > 0:
+            time.sleep(wait)
+
+        with self._lock:
+            state["admitted"] += 1
+        self._record_wait(priority, started)
+        token_buckets += [state["tpm"]]
+        return AdmissionPermit(self, provider, token_buckets, tokens)
+
+    def _record_wait(self, priority: str, started: float) -> None:
+        waited_ms = (time.monotonic() - started) * 1000
+        with self._lock:
+            stats = self._queue_wait[priority]
+            stats["admitted"] += 1
+            stats["total_wait_ms"] += waited_ms
+            stats["max_wait_ms"] = max(stats["max_wait_ms"], waited_ms)
+
+    def _release_slot(self, provider: Optional[str]) -> None:
+        state = self._providers.get(provider) if provider else None
+        if state is None:
+            return
+        with self._lock:
+            state["in_flight"] -= 1
+        state["slots"].release()
+
+    def stats(self) -> Dict[str, Any]:
+        """Stan limiterów do /api/health."""
+        with self._lock:
+            providers = {
+                provider: {
+                    "in_flight": state["in_flight"],
+                    "waiting": sum(state["waiting"].values()),
+                    "waiting_by_class": dict(state["waiting"]),
+                    "max_concurrency": state["max_concurrency"],
+                    "admitted": state["admitted"],
+                    "rejected": state["rejected"],
+                }
+                for provider, state in self._providers.items()
+            }
+            tracked_clients = len(self._clients)
+            queue_wait = {
+                cls: {
+                    "admitted": int(stats["admitted"]),
+                    "rejected": int(stats["rejected"]),
+                    "avg_wait_ms": round(stats["total_wait_ms"] / stats["admitted"], 2) if stats["admitted"] else 0.0,
+                    "max_wait_ms": round(stats["max_wait_ms"], 2),
+                }
+                for cls, stats in self._queue_wait.items()
+            }
+        for provider, state in self._providers.items():
+            for name in ("rpm", "tpm"):
+                bucket = state[name]
+                providers[provider][f"{name}_limit"] = int(bucket.capacity)
+                providers[provider][f"{name}_available"] = (
+                    None if bucket.capacity <= 0 else int(bucket.available())
+                )
+        return {
+            "providers": providers,
+            "client_rpm_limit": self.client_rpm,
+            "client_tpm_limit": self.client_tpm,
+            "tracked_clients": tracked_clients,
+            "queue_wait": queue_wait,
+            "queue_size": self.queue_size,
+            "max_wait_seconds": self.max_wait,
+        }
+
+
+ADMISSION = AdmissionController.from_config(CONFIG.admission)
+
+# Liczba procesów obsługujących żądania (ustawiana przez supervisor prefork)
+WORKER_COUNT = 1
+
+class SingleFlight:
+    """
+    Łączy identyczne równoległe wywołania w jedno (wzorzec single-flight).
+
+    Pierwsze wywołanie dla danego klucza wykonuje funkcję, kolejne czekają
+    na jego wynik (lub wyjątek) zamiast wysyłać własne żądanie upstream.
+    """
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._calls: Dict[str, Dict[str, Any]] = {}
+        self._stats = {"calls": 0, "executed": 0, "collapsed": 0}
+
+    def do(self, key: str, func: Callable[[], T]) -> T:
+        """Wykonuje func() albo dołącza do trwającego wywołania z tym samym kluczem."""
+        with self._lock:
+            self._stats["calls"] += 1
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = {"done": threading.Event(), "result": None, "error": None}
+                self._calls[key] = call
+                self._stats["executed"] += 1
+            else:
+                self._stats["collapsed"] += 1
+
+        if not leader:
+            call["done"].wait()
+            if call["error"] is not None:
+                raise call["error"]
+            return call["result"]
+
+        try:
+            call["result"] = func()
+            return call["result"]
+        except Exception as e:
+            call["error"] = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call["done"].set()
+
+    def stats(self) -> Dict[str, int]:
+        """Zwraca kopię liczników (z liczbą aktualnie trwających wywołań)."""
+        with self._lock:
+            return {**self._stats, "in_flight": len(self._calls)}
+
+
+def single_flight_key(route: str, body: Optional[Dict[str, Any]] = None) -> str:
+    """Klucz single-flight: trasa + znormalizowane (posortowane) body JSON."""
+    if not body:
+        return route
+    return f"{route} {json.dumps(body, sort_keys=True, separators=(',', ':'), ensure_ascii=False)}"
+
+
+# =============================================================================
+# Transcripts - historia czatów w SQLite (WAL + FTS5)
+# =============================================================================
+# Pełne wiadomości z modelem, zużyciem tokenów i latencją. Zapisy trafiają do
+# kolejki i są wstawiane paczkami przez jeden wątek-writer (jedna transakcja
+# na paczkę), odczyty idą przez osobne połączenia - WAL nie blokuje czytelników.
+
+TRANSCRIPT_DB = os.environ.get("TRANSCRIPT_DB", os.path.join(LOG_DIR, "transcripts.db"))
+TRANSCRIPT_BATCH_SIZE = int(os.environ.get("TRANSCRIPT_BATCH_SIZE", "200"))
+TRANSCRIPT_FLUSH_SECONDS = float(os.environ.get("TRANSCRIPT_FLUSH_MS", "200")) / 1000.0
+HISTORY_DEFAULT_LIMIT = 50
+HISTORY_MAX_LIMIT = 500
+
+_TRANSCRIPT_SCHEMA = """
+CREATE TABLE IF NOT EXISTS messages (
+    id INTEGER PRIMARY KEY,
+    ts REAL NOT NULL,
+    conversation_id TEXT,
+    role TEXT NOT NULL,
+    content TEXT NOT NULL,
+    provider TEXT,
+    model TEXT,
+    input_tokens INTEGER,
+    output_tokens INTEGER,
+    latency_ms INTEGER,
+    client TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_messages_ts ON messages(ts);
+CREATE INDEX IF NOT EXISTS idx_messages_conversation ON messages(conversation_id, id);
+CREATE INDEX IF NOT EXISTS idx_messages_provider ON messages(provider, id);
+"""
+
+_TRANSCRIPT_FTS_SCHEMA = """
+CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(
+    content, content='messages', content_rowid='id', tokenize='unicode61 remove_diacritics 2'
+);
+CREATE TRIGGER IF NOT EXISTS messages_fts_insert AFTER INSERT ON messages BEGIN
+    INSERT INTO messages_fts(rowid, content) VALUES (new.id, new.content);
+END;
+CREATE TRIGGER IF NOT EXISTS messages_fts_delete AFTER DELETE ON messages BEGIN
+    INSERT INTO messages_fts(messages_fts, rowid, content) VALUES ('delete', old.id, old.content);
+END;
+"""
+
+_TRANSCRIPT_COLUMNS = (
+    "ts", "conversation_id", "role", "content", "provider", "model",
+    "input_tokens", "output_tokens", "latency_ms", "client",
+)
+
+
+def fts_query(text: str) -> str:
+    """Zamienia tekst użytkownika na bezpieczne zapytanie FTS5 (AND słów, `abc*` = prefiks)."""
+    terms = []
+    for word in text.split():
+        prefix = word.endswith("*")
+        word = word.rstrip("*").replace('"', '""')
+        if word:
+            terms.append(f'"{word}"' + ("*" if prefix else ""))
+    return " ".join(terms)
+
+
+class TranscriptStore:
+    """Indeksowany magazyn transkryptów czatu (SQLite WAL, paczkowane INSERT, FTS5)."""
+
+    def __init__(self, path: str, batch_size: int = TRANSCRIPT_BATCH_SIZE,
+                 flush_interval: float = TRANSCRIPT_FLUSH_SECONDS) -> None:
+        self.path = path
+        self.batch_size = max(1, batch_size)
+        self.flush_interval = flush_interval
+        self.fts_enabled = False
+        self._queue: "queue.Queue[Optional[tuple]]" = queue.Queue()
+        self._lock = threading.Lock()
+        self._writer: Optional[threading.Thread] = None
+        self._writer_pid: Optional[int] = None
+        self._initialized = False
+        self._stats = {"written": 0, "batches": 0, "errors": 0}
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.path, timeout=10, check_same_thread=False)
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+    def _ensure_schema(self) -> None:
+        if self._initialized:
+            return
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        conn = self._connect()
+        try:
+            conn.executescript(_TRANSCRIPT_SCHEMA)
+            try:
+                conn.executescript(_TRANSCRIPT_FTS_SCHEMA)
+                self.fts_enabled = True
+            except sqlite3.OperationalError as e:
+                # SQLite bez FTS5 - wyszukiwanie pełnotekstowe przez LIKE
+                log(f"TRANSCRIPTS: FTS5 unavailable ({e}), falling back to LIKE search")
+            conn.commit()
+        finally:
+            conn.close()
+        self._initialized = True
+
+    def _start_writer(self) -> None:
+        # Po fork (prefork) wątek writera nie istnieje w dziecku - startujemy go per proces
+        if self._writer is not None and self._writer_pid == os.getpid() and self._writer.is_alive():
+            return
+        with self._lock:
+            if self._writer is not None and self._writer_pid == os.getpid() and self._writer.is_alive():
+                return
+            self._ensure_schema()
+            self._queue = queue.Queue()
+            self._writer_pid = os.getpid()
+            self._writer = threading.Thread(target=self._write_loop, name="transcript-writer", daemon=True)
+            self._writer.start()
+
+    def _write_loop(self) -> None:
+        conn = self._connect()
+        pending: List[tuple] = []
+        stopping = False
+        while not stopping:
+            try:
+                row = self._queue.get(timeout=self.flush_interval if pending else None)
+                if row is None:
+                    stopping = True
+                else:
+                    pending.append(row)
+                    if len(pending) < self.batch_size:
+                        continue
+            except queue.Empty:
+                pass
+            if pending:
+                self._insert(conn, pending)
+                for _ in pending:
+                    self._queue.task_done()
+                pending = []
+            if stopping:
+                self._queue.task_done()
+        conn.close()
+
+    def _insert(self, conn: sqlite3.Connection, rows: List[tuple]) -> None:
+        placeholders = ", ".join("?" for _ in _TRANSCRIPT_COLUMNS)
+        try:
+            with conn:
+                conn.executemany(
+                    f"INSERT INTO messages ({', '.join(_TRANSCRIPT_COLUMNS)}) VALUES ({placeholders})", rows
+                )
+            self._stats["written"] += len(rows)
+            self._stats["batches"] += 1
+        except sqlite3.Error as e:
+            self._stats["errors"] += 1
+            log(f"TRANSCRIPTS: failed to write {len(rows)} messages: {e}")
+
+    def record(
+        self,
+        role: str,
+        content: str,
+        conversation_id: Optional[str] = None,
+        provider: Optional[str] = None,
+        model: Optional[str] = None,
+        input_tokens: Optional[int] = None,
+        output_tokens: Optional[int] = None,
+        latency_ms: Optional[int] = None,
+        client: Optional[str] = None,
+    ) -> None:
+        """Kolejkuje wiadomość do zapisu (nie blokuje handlera)."""
+        try:
+            self._start_writer()
+        except (OSError, sqlite3.Error) as e:
+            log(f"TRANSCRIPTS: store unavailable: {e}")
+            return
+        self._queue.put((
+            time.time(), conversation_id, role, content, provider, model,
+            input_tokens, output_tokens, latency_ms, client,
+        ))
+
+    def flush(self) -> None:
+        """Czeka, aż wszystkie zakolejkowane wiadomości zostaną zapisane."""
+        if self._writer is not None and self._writer_pid == os.getpid() and self._writer.is_alive():
+            self._queue.join()
+
+    def close(self) -> None:
+        if self._writer is not None and self._writer_pid == os.getpid() and self._writer.is_alive():
+            self._queue.put(None)
+            self._writer.join(timeout=5)
+        self._writer = None
+
+    def search(
+        self,
+        query: Optional[str] = None,
+        role: Optional[str] = None,
+        provider: Optional[str] = None,
+        model: Optional[str] = None,
+        conversation_id: Optional[str] = None,
+        since: Optional[float] = None,
+        until: Optional[float] = None,
+        before: Optional[int] = None,
+        limit: int = HISTORY_DEFAULT_LIMIT,
+    ) -> Dict[str, Any]:
+        """
+        Zwraca wiadomości od najnowszych (paginacja kursorem po id - bez OFFSET).
+
+        Returns:
+            {"items": [...], "next_cursor": id lub None}
+        """
+        limit = max(1, min(int(limit), HISTORY_MAX_LIMIT))
+        where: List[str] = []
+        params: List[Any] = []
+        select = "m.*"
+        source = "messages m"
+        order_key = "m.id"
+
+        if query:
+            if self.fts_enabled:
+                match = fts_query(query)
+                if match:
+                    source = "messages_fts JOIN messages m ON m.id = messages_fts.rowid"
+                    select = "m.*, snippet(messages_fts, 0, '[', ']', '…', 16) AS snippet"
+                    where.append("messages_fts MATCH ?")
+                    params.append(match)
+                    # FTS5 zwraca dopasowania w kolejności rowid - LIMIT kończy skan wcześnie
+                    order_key = "messages_fts.rowid"
+            else:
+                where.append("m.content LIKE ? ESCAPE '\\'")
+                escaped = query.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+                params.append(f"%{escaped}%")
+
+        for column, value in (("role", role), ("provider", provider), ("model", model),
+                              ("conversation_id", conversation_id)):
+            if value:
+                where.append(f"m.{column} = ?")
+                params.append(value)
+        if since is not None:
+            where.append("m.ts >= ?")
+            params.append(since)
+        if until is not None:
+            where.append("m.ts < ?")
+            params.append(until)
+        if before is not None:
+            where.append(f"{order_key} < ?")
+            params.append(before)
+
+        sql = f"SELECT {select} FROM {source}"
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        sql += f" ORDER BY {order_key} DESC LIMIT ?"
+        params.append(limit + 1)
+
+        self._ensure_schema()
+        conn = self._connect()
+        try:
+            rows = conn.execute(sql, params).fetchall()
+        finally:
+            conn.close()
+        items = [dict(row) for row in rows[:limit]]
+        next_cursor = items[-1]["id"] if len(rows) > limit else None
+        return {"items": items, "next_cursor": next_cursor}
+
+    def stats(self) -> Dict[str, Any]:
+        return dict(self._stats, queued=self._queue.qsize(), fts=self.fts_enabled)
+
+
+TRANSCRIPTS = TranscriptStore(TRANSCRIPT_DB)
+
+
+def record_transcript(role: str, content: str, **metadata: Any) -> None:
+    """Zapisuje wiadomość czatu w historii (gdy ENABLE_LOGGING=true)."""
+    if not CONFIG.enable_logging or not content:
+        return
+    TRANSCRIPTS.record(role, content, **metadata)
+
+
+def _parse_history_time(value: Optional[str]) -> Optional[float]:
+    """Czas jako epoch (sekundy) albo ISO 8601."""
+    if not value:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        return datetime.datetime.fromisoformat(value).timestamp()
+
+
+
+# =============================================================================
+# Log reader - tail/paginacja logów przez mmap i follow przez SSE
+# =============================================================================
+# Czytamy od końca pliku po offsetach bajtowych, więc koszt ostatnich N linii
+# nie zależy od rozmiaru logu. Kursor = offset bajtowy początku linii.
+
+LOG_SOURCES: Dict[str, str] = {
+    "server": LOG_FILE,
+    "ai-commands": AI_COMMAND_LOG,
+}
+LOGS_DEFAULT_LIMIT = 200
+LOGS_MAX_LIMIT = 5000
+# Ile bajtów maksymalnie skanujemy na jedno żądanie przy filtrach (resztę dociąga kursor)
+LOGS_MAX_SCAN_BYTES = int(os.environ.get("LOGS_MAX_SCAN_BYTES", str(64 * 1024 * 1024)))
+LOGS_SCAN_BLOCK_BYTES = 1024 * 1024
+LOGS_FOLLOW_POLL_SECONDS = 0.5
+LOGS_FOLLOW_HEARTBEAT_SECONDS = 15.0
+
+# Poziom = minimalna waga (warning obejmuje też błędy)
+LOG_LEVEL_KEYWORDS: Dict[str, tuple] = {
+    "error": (b"error", b"critical", b"crash", b"fatal", b"traceback"),
+    "warning": (b"error", b"critical", b"crash", b"fatal", b"traceback", b"warn"),
+}
+
+
+class LogLineFilter:
+    """Filtr linii logu: poziom i/lub podciąg (bez rozróżniania wielkości liter)."""
+
+    def __init__(self, level: Optional[str] = None, contains: Optional[str] = None) -> None:
+        self.keywords = LOG_LEVEL_KEYWORDS.get(level, ()) if level else ()
+        self.needle = contains.lower().encode("utf-8") if contains else None
+        # Literały szukane w całych blokach (bytes.find w C), a nie linia po linii
+        self.literals = (self.needle,) if self.needle else self.keywords
+
+    def __bool__(self) -> bool:
+        return bool(self.literals)
+
+    def _matches(self, lower_line: bytes) -> bool:
+        if self.keywords and not any(k in lower_line for k in self.keywords):
+            return False
+        return self.needle is None or self.needle in lower_line
+
+    def __call__(self, line: bytes) -> bool:
+        return self._matches(line.lower())
+
+    def matching_lines(self, mm: mmap.mmap, start: int, end: int) -> Iterator[tuple]:
+        """Zwraca (początek, koniec) pasujących linii w zakresie [start, end) - rosnąco."""
+        while start < end:
+            block_end = min(end, start + LOGS_SCAN_BLOCK_BYTES)
+            if block_end < end:
+                newline = mm.rfind(b"\n", start, block_end)
+                if newline < 0:
+                    newline = mm.find(b"\n", block_end, end)
+                block_end = newline if newline >= 0 else end
+            block = mm[start:block_end].lower()
+
+            line_starts = set()
+            for literal in self.literals:
+                position = block.find(literal)
+                while position >= 0:
+                    line_starts.add(block.rfind(b"\n", 0, position) + 1)
+                    newline = block.find(b"\n", position)
+                    if newline < 0:
+                        break
+                    position = block.find(literal, newline + 1)
+
+            for line_start in sorted(line_starts):
+                line_end = block.find(b"\n", line_start)
+                if line_end < 0:
+                    line_end = len(block)
+                if self._matches(block[line_start:line_end]):
+                    yield start + line_start, start + line_end
+            start = block_end + 1
+
+
+def _log_line(mm: mmap.mmap, start: int, end: int) -> Dict[str, Any]:
+    return {"offset": start, "text": mm[start:end].decode("utf-8", errors="replace").rstrip("\r")}
+
+
+def read_log_tail(
+    path: str,
+    limit: int = LOGS_DEFAULT_LIMIT,
+    before: Optional[int] = None,
+    line_filter: Optional[LogLineFilter] = None,
+    max_scan: int = LOGS_MAX_SCAN_BYTES,
+) -> Dict[str, Any]:
+    """
+    Zwraca ostatnie `limit` linii przed offsetem `before` (domyślnie koniec pliku).
+
+    Skanuje plik wstecz przez mmap, bez wczytywania całości. Z filtrem
+    przeszukuje bloki od końca, najwyżej `max_scan` bajtów na wywołanie.
+
+    Returns:
+        {"lines": [{"offset", "text"}] (od najstarszej), "next_cursor": offset
+        do dalszego cofania lub None, "end_offset": koniec ostatniej pełnej
+        linii (start dla follow), "size": rozmiar pliku}
+    """
+    limit = max(1, min(int(limit), LOGS_MAX_LIMIT))
+    try:
+        size = os.path.getsize(path)
+    except OSError:
+        return {"lines": [], "next_cursor": None, "end_offset": 0, "size": 0}
+    if size == 0:
+        return {"lines": [], "next_cursor": None, "end_offset": 0, "size": 0}
+
+    lines: List[Dict[str, Any]] = []
+    with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        # Pomijamy niepełną ostatnią linię (może być właśnie dopisywana)
+        end_offset = mm.rfind(b"\n") + 1
+        stop = end_offset if before is None else max(0, min(int(before), end_offset))
+
+        if not line_filter:
+            while stop > 0 and len(lines) < limit:
+                # stop wskazuje bajt tuż za "\n" kończącym linię
+                start = mm.rfind(b"\n", 0, stop - 1) + 1
+                lines.append(_log_line(mm, start, stop - 1))
+                stop = start
+        else:
+            scan_floor = max(0, stop - max_scan)
+            while stop > scan_floor and len(lines) < limit:
+                block_start = max(scan_floor, stop - LOGS_SCAN_BLOCK_BYTES)
+                block_start = mm.rfind(b"\n", 0, block_start) + 1 if block_start > 0 else 0
+                found = list(line_filter.matching_lines(mm, block_start, stop - 1))
+                for line_start, line_end in reversed(found):
+                    lines.append(_log_line(mm, line_start, line_end))
+                    if len(lines) == limit:
+                        block_start = line_start
+                        break
+                stop = block_start
+
+    lines.reverse()
+    return {"lines": lines, "next_cursor": stop or None, "end_offset": end_offset, "size": size}
+
+
+def read_log_forward(
+    path: str,
+    after: int,
+    limit: int = LOGS_DEFAULT_LIMIT,
+    line_filter: Optional[LogLineFilter] = None,
+    max_scan: int = LOGS_MAX_SCAN_BYTES,
+) -> Dict[str, Any]:
+    """
+    Zwraca kompletne linie od offsetu `after` w przód (paginacja i follow).
+
+    Returns:
+        {"lines": [...], "next_offset": offset kolejnej nieprzeczytanej linii, "size"}
+    """
+    limit = max(1, min(int(limit), LOGS_MAX_LIMIT))
+    try:
+        size = os.path.getsize(path)
+    except OSError:
+        return {"lines": [], "next_offset": 0, "size": 0}
+    if after > size:
+        after = 0  # Plik został obcięty lub zrotowany - czytamy od początku
+    if after == size:
+        return {"lines": [], "next_offset": after, "size": size}
+
+    lines: List[Dict[str, Any]] = []
+    position = after
+    with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        # Tylko pełne linie - ostatnia bez "\n" może być jeszcze dopisywana
+        ceiling = mm.rfind(b"\n", position, min(len(mm), after + max_scan)) + 1
+        if ceiling > position:
+            if not line_filter:
+                while position < ceiling and len(lines) < limit:
+                    newline = mm.find(b"\n", position, ceiling)
+                    lines.append(_log_line(mm, position, newline))
+                    position = newline + 1
+            else:
+                for line_start, line_end in line_filter.matching_lines(mm, position, ceiling - 1):
+                    lines.append(_log_line(mm, line_start, line_end))
+                    if len(lines) == limit:
+                        ceiling = line_end + 1
+                        break
+                position = ceiling
+
+    return {"lines": lines, "next_offset": position, "size": size}
+
+
+# =============================================================================
+# Tissaia - wsadowe przetwarzanie skanów po stronie serwera
+# =============================================================================
+# Etapy 3 (Smart Crop wg mapy cięć) i lokalne ulepszanie obrazu dla całych
+# paczek skanów: NumPy (operacje wektorowe), pula procesów na wszystkie rdzenie
+# i binarne ramki zamiast data URL w base64.
+#
+# Format ramek (TISSAIA_FRAMES_MIME), żądanie i odpowiedź:
+#   [u32 big-endian: długość nagłówka][nagłówek JSON UTF-8][blob 0][blob 1]...
+# Nagłówek opisuje elementy w kolejności blobów, każdy z polem "size".
+
+numpy = LazySDK("numpy")
+PIL_Image = LazySDK("PIL.Image")
+PIL_ImageOps = LazySDK("PIL.ImageOps")
+NUMPY_AVAILABLE = module_available("numpy")
+PIL_AVAILABLE = module_available("PIL")
+
+TISSAIA_FRAMES_MIME = "application/x-regis-frames"
+TISSAIA_MAX_BATCH_BYTES = int(os.environ.get("TISSAIA_MAX_BATCH_MB", "512")) * 1024 * 1024
+TISSAIA_MAX_ITEMS = int(os.environ.get("TISSAIA_MAX_ITEMS", "200"))
+# Wartości domyślne zgodne z PIPELINE_CONFIG (STAGE_3_SMART_CROP)
+TISSAIA_HYGIENE_MARGIN = 0.02
+TISSAIA_BACKGROUND = (255, 255, 255)
+TISSAIA_FORMATS = {"png": "image/png", "jpeg": "image/jpeg", "webp": "image/webp"}
+
+_TISSAIA_POOL: Optional[ProcessPoolExecutor] = None
+_TISSAIA_POOL_PID: Optional[int] = None
+_TISSAIA_POOL_LOCK = threading.Lock()
+
+
+class FrameError(ValueError):
+    """Niepoprawna ramka binarna."""
+
+
+def encode_frames(header: Dict[str, Any], blobs: List[bytes]) -> bytes:
+    """Składa nagłówek JSON i bloby w jedną ramkę."""
+    head = json.dumps(header, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+    return b"".join([len(head).to_bytes(4, "big"), head, *blobs])
+
+
+def decode_frames(body: bytes, items_key: str = "items") -> tuple:
+    """
+    Rozkłada ramkę na (nagłówek, [memoryview bloba, ...]) - bez kopiowania danych.
+
+    Raises:
+        FrameError: gdy nagłówek lub rozmiary się nie zgadzają
+    """
+    view = memoryview(body)
+    if len(view) < 4:
+        raise FrameError("Frame too short")
+    head_len = int.from_bytes(view[:4], "big")
+    if 4 + head_len > len(view):
+        raise FrameError("Header length exceeds body size")
+    try:
+        header = json.loads(bytes(view[4:4 + head_len]).decode("utf-8"))
+    except (UnicodeDecodeError, json.JSONDecodeError) as e:
+        raise FrameError(f"Invalid frame header: {e}")
+    items = header.get(items_key) if isinstance(header, dict) else None
+    if not isinstance(items, list):
+        raise FrameError(f"Frame header must contain '{items_key}' array")
+
+    blobs = []
+    offset = 4 + head_len
+    for item in items:
+        size = item.get("size") if isinstance(item, dict) else None
+        if not isinstance(size, int) or size < 0 or offset + size > len(view):
+            raise FrameError("Invalid blob size in frame header")
+        blobs.append(view[offset:offset + size])
+        offset += size
+    if offset != len(view):
+        raise FrameError("Trailing bytes after last blob")
+    return header, blobs
+
+
+def tissaia_pixel_boxes(boxes: List[Dict[str, Any]], width: int, height: int,
+                        margin: float = TISSAIA_HYGIENE_MARGIN):
+    """
+    Mapuje znormalizowane ramki (0-1) na piksele z marginesem higienicznym.
+
+    Wektorowo dla całej mapy cięć; te same reguły co stage3-smartcrop.ts
+    (applyHygieneMargin + przycięcie do obrazu, zaokrąglenie jak Math.round).
+
+    Returns:
+        ndarray (n, 4) int: x, y, szerokość, wysokość
+    """
+    np = numpy.load()
+    b = np.asarray([[box["x"], box["y"], box["width"], box["height"]] for box in boxes], dtype=np.float64)
+    b = b.reshape(-1, 4)
+    if margin:
+        x = np.maximum(0.0, b[:, 0] - margin)
+        y = np.maximum(0.0, b[:, 1] - margin)
+        w = np.minimum(1.0 - (b[:, 0] - margin), b[:, 2] + margin * 2)
+        h = np.minimum(1.0 - (b[:, 1] - margin), b[:, 3] + margin * 2)
+        b = np.stack([x, y, w, h], axis=1)
+
+    px = np.floor(b * np.array([width, height, width, height], dtype=np.float64) + 0.5).astype(np.int64)
+    px[:, 0] = np.clip(px[:, 0], 0, width - 1)
+    px[:, 1] = np.clip(px[:, 1], 0, height - 1)
+    px[:, 2] = np.clip(px[:, 2], 1, width - px[:, 0])
+    px[:, 3] = np.clip(px[:, 3], 1, height - px[:, 1])
+    return px
+
+
+def tissaia_enhance(pixels, autolevels: float = 0.5, gamma: float = 1.0, sharpen: float = 0.0):
+    """
+    Lokalne ulepszenie skanu: auto-levels per kanał, gamma i unsharp mask.
+
+    Levels i gamma są składane w jedną tablicę LUT (256 wartości na kanał),
+    więc cały obraz przechodzi jedną operacją indeksowania.
+    """
+    np = numpy.load()
+    img = pixels
+    lut = np.tile(np.arange(256, dtype=np.float32), (3, 1))
+
+    if autolevels is not None and autolevels >= 0:
+        # Percentyle z podpróbki - wystarczająco dokładne i niezależne od rozdzielczości
+        step = max(1, int(math.sqrt(img.shape[0] * img.shape[1] / 250_000)))
+        sample = img[::step, ::step].reshape(-1, 3)
+        low = np.percentile(sample, autolevels, axis=0).astype(np.float32)
+        high = np.percentile(sample, 100 - autolevels, axis=0).astype(np.float32)
+        scale = 255.0 / np.maximum(high - low, 1.0)
+        lut = (lut - low[:, None]) * scale[:, None]
+    lut = np.clip(lut, 0, 255)
+    if gamma and gamma != 1.0:
+        lut = 255.0 * (lut / 255.0) ** (1.0 / gamma)
+    lut = np.rint(lut).astype(np.uint8)
+
+    out = np.empty_like(img)
+    for channel in range(3):
+        np.take(lut[channel], img[..., channel], out=out[..., channel])
+
+    if sharpen and sharpen > 0:
+        # Unsharp mask: out + s * (out - rozmycie 3x3). Rozmycie separowalne (suma
+        # wierszy, potem kolumn) w uint16, reszta w int32 ze stałym przecinkiem (1/16)
+        p = np.pad(out, ((1, 1), (1, 1), (0, 0)), mode="edge").astype(np.uint16)
+        rows = p[:, :-2] + p[:, 1:-1]
+        rows += p[:, 2:]
+        box = rows[:-2] + rows[1:-1]
+        box += rows[2:]
+        amount = int(round(sharpen * 16))
+        acc = out.astype(np.int32) * (9 * 16 + 9 * amount)
+        acc -= box.astype(np.int32) * amount
+        acc //= 9 * 16
+        out = np.clip(acc, 0, 255).astype(np.uint8)
+    return out
+
+
+def _tissaia_decode(data: bytes):
+    """Dekoduje obraz do tablicy RGB (EXIF rotation, przezroczystość na białym tle)."""
+    np = numpy.load()
+    image = PIL_Image.open(io.BytesIO(data))
+    image = PIL_ImageOps.exif_transpose(image)
+    if image.mode in ("RGBA", "LA") or (image.mode == "P" and "transparency" in image.info):
+        background = PIL_Image.new("RGB", image.size, TISSAIA_BACKGROUND)
+        background.paste(image, mask=image.convert("RGBA").getchannel("A"))
+        image = background
+    return np.asarray(image.convert("RGB"))
+
+
+def _tissaia_encode(pixels, options: Dict[str, Any]) -> bytes:
+    """Koduje tablicę RGB do formatu z opcji (png domyślnie, jak w PIPELINE_CONFIG)."""
+    fmt = options.get("format", "png")
+    quality = int(round(float(options.get("quality", 0.95)) * 100))
+    buffer = io.BytesIO()
+    image = PIL_Image.fromarray(pixels)
+    if fmt == "png":
+        image.save(buffer, format="PNG", compress_level=int(options.get("png_compression", 1)))
+    else:
+        image.save(buffer, format=fmt.upper(), quality=quality)
+    return buffer.getvalue()
+
+
+def _tissaia_enhance_options(options: Dict[str, Any]) -> Optional[Dict[str, float]]:
+    enhance = options.get("enhance")
+    if not enhance:
+        return None
+    if enhance is True:
+        enhance = {}
+    return {
+        "autolevels": float(enhance.get("autolevels", 0.5)),
+        "gamma": float(enhance.get("gamma", 1.0)),
+        "sharpen": float(enhance.get("sharpen", 0.0)),
+    }
+
+
+def tissaia_crop_scan(data: bytes, boxes: List[Dict[str, Any]], options: Dict[str, Any]) -> List[tuple]:
+    """
+    Wycina wszystkie obiekty z jednego skanu (dekodowanie raz na skan).
+
+    Returns:
+        Lista (metadane, bajty obrazu) - po jednym na ramkę z mapy cięć
+    """
+    pixels = _tissaia_decode(data)
+    height, width = pixels.shape[:2]
+    margin = float(options.get("hygiene_margin", TISSAIA_HYGIENE_MARGIN))
+    enhance = _tissaia_enhance_options(options)
+    rects = tissaia_pixel_boxes(boxes, width, height, margin) if boxes else []
+
+    results = []
+    for index, (x, y, w, h) in enumerate(rects):
+        shard = pixels[y:y + h, x:x + w]  # Widok - bez kopiowania
+        if enhance:
+            shard = tissaia_enhance(shard, **enhance)
+        results.append(({
+            "index": index,
+            "label": boxes[index].get("label"),
+            "box": [int(x), int(y), int(w), int(h)],
+            "width": int(w),
+            "height": int(h),
+        }, _tissaia_encode(shard, options)))
+    return results
+
+
+def tissaia_enhance_image(data: bytes, options: Dict[str, Any]) -> List[tuple]:
+    """Ulepsza jeden obraz (np. shard, gdy Alchemy nie ma klucza API)."""
+    pixels = _tissaia_decode(data)
+    # Ten etap zawsze ulepsza - bez opcji używamy wartości domyślnych
+    enhance = _tissaia_enhance_options(options) or _tissaia_enhance_options({"enhance": True})
+    enhanced = tissaia_enhance(pixels, **enhance)
+    return [({"width": int(pixels.shape[1]), "height": int(pixels.shape[0])}, _tissaia_encode(enhanced, options))]
+
+
+TISSAIA_STAGES: Dict[str, Callable[..., List[tuple]]] = {
+    "crop": lambda data, item, options: tissaia_crop_scan(data, item.get("boxes") or [], options),
+    "enhance": lambda data, item, options: tissaia_enhance_image(data, options),
+}
+
+
+def _tissaia_run(stage: str, data: bytes, item: Dict[str, Any], options: Dict[str, Any]) -> List[tuple]:
+    """Punkt wejścia w procesie puli (funkcja modułu - musi dać się zpicklować)."""
+    return TISSAIA_STAGES[stage](data, item, options)
+
+
+def tissaia_pool() -> ProcessPoolExecutor:
+    """Pula procesów dla obrazów, tworzona leniwie (osobno w każdym workerze prefork)."""
+    global _TISSAIA_POOL, _TISSAIA_POOL_PID
+    with _TISSAIA_POOL_LOCK:
+        if _TISSAIA_POOL is None or _TISSAIA_POOL_PID != os.getpid():
+            cpus = resolve_worker_count("auto")
+            workers = _env_int("TISSAIA_WORKERS", max(1, cpus // max(1, WORKER_COUNT)))
+            # spawn: bezpieczne w procesie z wątkami i takie samo na Windows
+            _TISSAIA_POOL = ProcessPoolExecutor(
+                max_workers=max(1, workers), mp_context=multiprocessing.get_context("spawn")
+            )
+            _TISSAIA_POOL_PID = os.getpid()
+            log(f"TISSAIA: process pool started ({workers} workers)")
+        return _TISSAIA_POOL
+
+
+def shutdown_tissaia_pool() -> None:
+    global _TISSAIA_POOL
+    with _TISSAIA_POOL_LOCK:
+        if _TISSAIA_POOL is not None and _TISSAIA_POOL_PID == os.getpid():
+            _TISSAIA_POOL.shutdown(wait=False, cancel_futures=True)
+        _TISSAIA_POOL = None
 
 
-def validate_api_key(key: Optional[str], provider: str) -> tuple[bool, Optional[str]]:
+def validate_tissaia_batch(stage: str, header: Dict[str, Any]) -> None:
     """
-    Validates API key format and returns (is_valid, error_message).
-    Relaxed validation - only checks if non-empty.
+    Sprawdza nagłówek paczki (typy pól, liczba elementów, ramki crop).
 
-    Args:
-        key: The API key to validate
-        provider: Provider name ('claude' or 'gemini')
+    Raises:
+        FrameError: gdy paczka jest niepoprawna
+    """
+    items = header.get("items")
+    if not isinstance(items, list) or not all(isinstance(item, dict) for item in items):
+        raise FrameError("'items' must be an array of objects")
+    options = header.get("options")
+    if options is not None and not isinstance(options, dict):
+        raise FrameError("'options' must be an object")
+    if len(items) > TISSAIA_MAX_ITEMS:
+        raise FrameError(f"Too many items: {len(items)} (max {TISSAIA_MAX_ITEMS})")
+    if stage == "crop":
+        for item in items:
+            boxes = item.get("boxes")
+            if not isinstance(boxes, list) or not all(
+                isinstance(b, dict) and all(isinstance(b.get(k), (int, float)) for k in ("x", "y", "width", "height"))
+                for b in boxes
+            ):
+                raise FrameError(f"Item {item.get('id')}: 'boxes' must be an array of {{x, y, width, height}}")
+
+
+def run_tissaia_batch(stage: str, header: Dict[str, Any], blobs: List[memoryview],
+                      executor: Optional[Any] = None,
+                      progress: Optional[Callable[[Dict[str, Any]], None]] = None) -> tuple:
+    """
+    Przetwarza paczkę skanów równolegle (skan = zadanie w puli procesów).
+
+    progress(...) jest wołane po każdym skanie ({"done", "total", "item_id", "status"});
+    wyjątek z callbacku anuluje skany, które jeszcze nie wystartowały.
 
     Returns:
-        Tuple of (is_valid, error_message)
+        (nagłówek odpowiedzi, lista blobów) - błąd jednego skanu nie przerywa paczki
     """
-    if not key:
-        return False, None
-
-    if not isinstance(key, str):
-        return False, f"{provider} API key must be a string"
+    options = header.get("options") or {}
+    if options.get("format", "png") not in TISSAIA_FORMATS:
+        raise FrameError(f"Unsupported format: {options.get('format')}. Available: {', '.join(TISSAIA_FORMATS)}")
+    mime = TISSAIA_FORMATS[options.get("format", "png")]
+    executor = executor or tissaia_pool()
+
+    items = header["items"]
+    futures = [
+        executor.submit(_tissaia_run, stage, bytes(blob), {k: v for k, v in item.items() if k != "size"}, options)
+        for item, blob in zip(items, blobs)
+    ]
+
+    results: List[Dict[str, Any]] = []
+    out_blobs: List[bytes] = []
+    try:
+        for position, (item, future) in enumerate(zip(items, futures)):
+            item_id = item.get("id", position)
+            try:
+                outputs = future.result()
+            except Exception as e:
+                log(f"TISSAIA: {stage} failed for {item_id}: {e}")
+                results.append({"id": item_id, "status": "error", "error": str(e), "size": 0})
+                status = "error"
+            else:
+                for meta, data in outputs:
+                    results.append(dict(meta, id=item_id, status="ok", mime=mime, size=len(data)))
+                    out_blobs.append(data)
+                status = "ok"
+            if progress is not None:
+                progress({"done": position + 1, "total": len(items), "item_id": item_id, "status": status})
+    except BaseException:
+        for future in futures:
+            future.cancel()
+        raise
+    return {"results": results}, out_blobs
+
+
+# =============================================================================
+# File serving - fs_read: Range, ETag i wykrywanie typu (mmap / sendfile)
+# =============================================================================
+
+# Ile bajtów z początku pliku oglądamy przy wykrywaniu typu
+SNIFF_BYTES = 512
+# Fallback bez os.sendfile - zapis plasterkami mmap (memoryview, bez kopii do str)
+FILE_CHUNK_BYTES = 1024 * 1024
+
+# Sygnatury (offset, magic, typ) - sprawdzane przed rozszerzeniem pliku
+_MAGIC_SIGNATURES = (
+    (0, b"\x89PNG\r\n\x1a\n", "image/png"),
+    (0, b"\xff\xd8\xff", "image/jpeg"),
+    (0, b"GIF87a", "image/gif"),
+    (0, b"GIF89a", "image/gif"),
+    (0, b"%PDF-", "application/pdf"),
+    (0, b"PK\x03\x04", "application/zip"),
+    (0, b"\x1f\x8b", "application/gzip"),
+    (0, b"\x00asm", "application/wasm"),
+    (0, b"BM", "image/bmp"),
+    (0, b"OggS", "audio/ogg"),
+    (0, b"ID3", "audio/mpeg"),
+    (0, b"\x1aE\xdf\xa3", "video/webm"),
+    (4, b"ftyp", "video/mp4"),
+)
+
+
+def sniff_content_type(path: str, head: bytes) -> str:
+    """
+    Wykrywa Content-Type: sygnatura binarna, potem rozszerzenie, potem heurystyka tekstu.
 
-    key = key.strip()
+    Tekst (brak bajtów NUL, poprawne UTF-8) dostaje charset=utf-8.
+    """
+    for offset, magic, content_type in _MAGIC_SIGNATURES:
+        if head[offset:offset + len(magic)] == magic:
+            return content_type
+    if head[:4] == b"RIFF" and head[8:12] in (b"WEBP", b"WAVE", b"AVI "):
+        return {b"WEBP": "image/webp", b"WAVE": "audio/wav", b"AVI ": "video/x-msvideo"}[head[8:12]]
+
+    guessed, _ = mimetypes.guess_type(path)
+    is_text = b"\x00" not in head and _looks_like_utf8(head)
+    if guessed:
+        if is_text and (guessed.startswith("text/") or guessed in (
+            "application/json", "application/javascript", "application/xml", "image/svg+xml"
+        )):
+            return f"{guessed}; charset=utf-8"
+        return guessed
+    return "text/plain; charset=utf-8" if is_text else "application/octet-stream"
+
+
+def _looks_like_utf8(head: bytes) -> bool:
+    try:
+        head.decode("utf-8")
+        return True
+    except UnicodeDecodeError as e:
+        # Wielobajtowy znak ucięty na końcu próbki nie świadczy o binarce
+        return e.start >= len(head) - 3
 
-    if len(key) == 0:
-        return False, f"{provider} API key is empty"
 
-    # Relaxed validation - just check minimum length (no strict format checking)
-    if len(key) < 10:
-        return False, f"{provider} API key is too short (minimum 10 characters)"
+def file_etag(st: os.stat_result) -> str:
+    """ETag z rozmiaru i mtime (ns) - bez czytania zawartości."""
+    return f'"{st.st_size:x}-{st.st_mtime_ns:x}"'
 
-    return True, None
 
+def etag_matches(header: Optional[str], etag: str) -> bool:
+    """Porównanie If-None-Match (słabe - W/ ignorowane, obsługa list i *)."""
+    if not header:
+        return False
+    if header.strip() == "*":
+        return True
+    bare = etag[2:] if etag.startswith("W/") else etag
+    return any(
+        (candidate.strip()[2:] if candidate.strip().startswith("W/") else candidate.strip()) == bare
+        for candidate in header.split(",")
+    )
 
-def get_api_keys() -> Dict[str, Optional[str]]:
-    """Pobiera i waliduje klucze API z zmiennych środowiskowych."""
-    claude_key = os.environ.get("ANTHROPIC_API_KEY")
-    gemini_key = os.environ.get("GOOGLE_API_KEY")
-    grok_key = os.environ.get("XAI_API_KEY")
-
-    # Validate keys if present
-    if claude_key:
-        is_valid, error = validate_api_key(claude_key, "claude")
-        if not is_valid and error:
-            log(f"WARNING: {error}")
-
-    if gemini_key:
-        is_valid, error = validate_api_key(gemini_key, "gemini")
-        if not is_valid and error:
-            log(f"WARNING: {error}")
-
-    if grok_key:
-        is_valid, error = validate_api_key(grok_key, "grok")
-        if not is_valid and error:
-            log(f"WARNING: {error}")
 
-    return {
-        "claude": claude_key.strip() if claude_key else None,
-        "gemini": gemini_key.strip() if gemini_key else None,
-        "grok": grok_key.strip() if grok_key else None,
-        "default_provider": os.environ.get("DEFAULT_AI_PROVIDER", "claude").lower(),
-    }
+# Listy modeli zmieniają się rzadko - przeglądarka może je trzymać chwilę bez pytania serwera
+MODELS_CACHE_CONTROL = f"private, max-age={int(os.environ.get('MODELS_CACHE_SECONDS', '60'))}"
 
 
-T = TypeVar('T')
+def content_etag(body: bytes) -> str:
+    """Silny ETag z hasha treści odpowiedzi (ten sam w każdym workerze prefork)."""
+    return '"' + hashlib.blake2b(body, digest_size=12).hexdigest() + '"'
 
 
-def retry_with_backoff(
-    func: Callable[[], T],
-    max_retries: int = 3,
-    initial_delay: float = 1.0,
-    max_delay: float = 10.0,
-    backoff_factor: float = 2.0,
-    retryable_exceptions: tuple = (Exception,)
-) -> T:
+def parse_byte_range(header: Optional[str], size: int) -> Optional[tuple]:
     """
-    Retry a function with exponential backoff.
-
-    Args:
-        func: Function to retry
-        max_retries: Maximum number of retry attempts
-        initial_delay: Initial delay between retries (seconds)
-        max_delay: Maximum delay between retries (seconds)
-        backoff_factor: Multiplier for delay after each retry
-        retryable_exceptions: Tuple of exceptions that should trigger a retry
+    Parsuje pojedynczy zakres `bytes=start-end` / `bytes=start-` / `bytes=-suffix`.
 
     Returns:
-        Result of the function call
+        (start, end) włącznie; None gdy brak nagłówka lub zakres wielokrotny /
+        nieczytelny (wtedy serwujemy cały plik)
 
     Raises:
-        The last exception if all retries fail
+        ValueError: zakres poza plikiem (416 Range Not Satisfiable)
     """
-    delay = initial_delay
-    last_exception = None
+    if not header or not header.strip().lower().startswith("bytes="):
+        return None
+    spec = header.strip()[6:].strip()
+    if "," in spec or "-" not in spec:
+        return None
+    first, last = (part.strip() for part in spec.split("-", 1))
+    try:
+        start = int(first) if first else None
+        end = int(last) if last else None
+    except ValueError:
+        return None
+
+    if size == 0:
+        raise ValueError("Range requested for an empty file")
+    if start is None:
+        if end is None or end <= 0:
+            raise ValueError(f"Invalid suffix range: {header}")
+        return max(0, size - end), size - 1
+    if end is None:
+        end = size - 1
+    if start >= size or end < start:
+        raise ValueError(f"Range {header} not satisfiable for size {size}")
+    return start, min(end, size - 1)
+
+
+# =============================================================================
+# WebSocket - jeden trwały kanał dla czatu, komend, logów, health i Tissaia
+# =============================================================================
+# RFC 6455 na http.server (bez zależności). Jedno połączenie niesie wiele
+# logicznych strumieni rozróżnianych polem "id"; każdy strumień ma własne okno
+# kredytów - liczbę wiadomości, które serwer może wysłać bez potwierdzenia
+# (jak WINDOW_UPDATE w HTTP/2). Wiadomości końcowe (done/error/cancelled)
+# nie zużywają kredytu.
+#
+# Klient -> serwer (ramki tekstowe JSON):
+#   {"type": "chat", "id": "c1", "messages": [...], "provider"?, "model"?, "system"?,
+#    "max_tokens"?, "hedge"?, "fallback"?, "conversation_id"?, "request_id"?}
+#   {"type": "command", "id": "k1", "command": "npm test", "cwd"?}
+#   {"type": "logs", "id": "l1", "source"?, "level"?, "q"?, "limit"?, "follow"?}
+#   {"type": "health", "id": "h1", "interval"?}   - interval = push co N sekund
+#   {"type": "cancel", "id": "c1"}                - przerywa strumień
+#   {"type": "credit", "id": "c1", "n": 64}       - powiększa okno strumienia
+#   {"type": "ping"}                              - odpowiedź {"event": "pong"}
+#   ramka binarna: encode_frames({"type": "tissaia", "id", "stage", "items", "options"}, bloby)
+# Każde otwarcie może podać "credit" (początkowe okno, domyślnie WS_INITIAL_CREDIT).
+#
+# Serwer -> klient: {"id", "event", ...}, event: meta / text (czat), output (komenda),
+# lines (logi), health, progress (Tissaia), done / error / cancelled; wyniki Tissaia
+# jako ramka binarna encode_frames({"id", "event": "result", "results"}, bloby).
+
+WS_GUID = "258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+WS_MAX_STREAMS = int(os.environ.get("WS_MAX_STREAMS", "16"))
+WS_INITIAL_CREDIT = int(os.environ.get("WS_INITIAL_CREDIT", "256"))
+WS_MAX_MESSAGE_BYTES = int(os.environ.get("WS_MAX_MESSAGE_MB", "64")) * 1024 * 1024
+WS_PING_INTERVAL = float(os.environ.get("WS_PING_INTERVAL", "30"))
+# Co ile sekund strażnik sesji sprawdza bezczynność i drenowanie serwera
+WS_KEEPALIVE_TICK = 1.0
+WS_COMMAND_CHUNK_BYTES = 64 * 1024
+WS_STREAM_ID_PATTERN = re.compile(r"^[A-Za-z0-9._:-]{1,128}$")
+
+WS_OP_CONTINUATION, WS_OP_TEXT, WS_OP_BINARY = 0x0, 0x1, 0x2
+WS_OP_CLOSE, WS_OP_PING, WS_OP_PONG = 0x8, 0x9, 0xA
+
+WS_STATS: Dict[str, Any] = {"sessions": 0, "active_sessions": 0, "streams": {}}
+_ws_stats_lock = threading.Lock()
+
+
+class WebSocketClosed(Exception):
+    """Połączenie WebSocket zamknięte (ramka close, EOF albo błąd protokołu)."""
+
+    def __init__(self, code: int = 1000, reason: str = ""):
+        super().__init__(f"{code} {reason}".strip())
+        self.code = code
+        self.reason = reason
+
+
+def websocket_accept_key(key: str) -> str:
+    """Wartość Sec-WebSocket-Accept dla klucza z handshake."""
+    return base64.b64encode(hashlib.sha1((key + WS_GUID).encode("ascii")).digest()).decode("ascii")
+
+
+def ws_unmask(payload: bytes, mask: bytes) -> bytes:
+    """Zdejmuje maskę klienta - XOR całego bufora naraz zamiast pętli po bajtach."""
+    length = len(payload)
+    if not length:
+        return payload
+    key = (mask * (length // 4 + 1))[:length]
+    return (int.from_bytes(payload, "little") ^ int.from_bytes(key, "little")).to_bytes(length, "little")
+
+
+def ws_frame_header(opcode: int, length: int, mask: Optional[bytes] = None) -> bytes:
+    """Nagłówek ramki z FIN=1 (maska tylko po stronie klienta, np. w testach)."""
+    mask_bit = 0x80 if mask else 0
+    if length < 126:
+        header = bytes((0x80 | opcode, mask_bit | length))
+    elif length < 1 << 16:
+        header = bytes((0x80 | opcode, mask_bit | 126)) + length.to_bytes(2, "big")
+    else:
+        header = bytes((0x80 | opcode, mask_bit | 127)) + length.to_bytes(8, "big")
+    return header + (mask or b"")
+
+
+class WebSocketConnection:
+    """Odczyt i zapis ramek RFC 6455 po handshake. Zapis jest bezpieczny wątkowo."""
+
+    def __init__(self, rfile: Any, sock: socket.socket, max_message: int = WS_MAX_MESSAGE_BYTES) -> None:
+        self.rfile = rfile
+        self.sock = sock
+        self.max_message = max_message
+        self.closed = False
+        self.last_activity = time.monotonic()
+        self._send_lock = threading.Lock()
+
+    def _read_exact(self, n: int) -> bytes:
+        try:
+            data = self.rfile.read(n)
+        except OSError:
+            raise WebSocketClosed(1006, "connection lost")
+        if len(data) < n:
+            raise WebSocketClosed(1006, "connection lost")
+        return data
+
+    def receive(self) -> tuple:
+        """
+        Czyta jedną wiadomość: składa fragmenty, odpowiada na ping.
+
+        Returns:
+            (opcode, payload) - WS_OP_TEXT albo WS_OP_BINARY
+
+        Raises:
+            WebSocketClosed: ramka close, EOF albo błąd protokołu
+        """
+        message_opcode: Optional[int] = None
+        parts: List[bytes] = []
+        size = 0
+        while True:
+            head = self._read_exact(2)
+            self.last_activity = time.monotonic()
+            fin, opcode = head[0] & 0x80, head[0] & 0x0F
+            if head[0] & 0x70:
+                raise WebSocketClosed(1002, "reserved bits set")
+            if not head[1] & 0x80:
+                raise WebSocketClosed(1002, "client frames must be masked")
+            length = head[1] & 0x7F
+            if length == 126:
+                length = int.from_bytes(self._read_exact(2), "big")
+            elif length == 127:
+                length = int.from_bytes(self._read_exact(8), "big")
+            mask = self._read_exact(4)
+
+            if opcode >= WS_OP_CLOSE:
+                if length > 125 or not fin:
+                    raise WebSocketClosed(1002, "invalid control frame")
+                payload = ws_unmask(self._read_exact(length), mask)
+                if opcode == WS_OP_PING:
+                    self.send(WS_OP_PONG, payload)
+                elif opcode == WS_OP_CLOSE:
+                    code = int.from_bytes(payload[:2], "big") if len(payload) >= 2 else 1000
+                    self.close(code)
+                    raise WebSocketClosed(code, payload[2:].decode("utf-8", errors="replace"))
+                continue
+
+            size += length
+            if size > self.max_message:
+                raise WebSocketClosed(1009, f"message larger than {self.max_message} bytes")
+            if opcode == WS_OP_CONTINUATION:
+                if message_opcode is None:
+                    raise WebSocketClosed(1002, "unexpected continuation frame")
+            elif opcode in (WS_OP_TEXT, WS_OP_BINARY):
+                if message_opcode is not None:
+                    raise WebSocketClosed(1002, "expected continuation frame")
+                message_opcode = opcode
+            else:
+                raise WebSocketClosed(1003, f"unsupported opcode {opcode}")
+            parts.append(ws_unmask(self._read_exact(length), mask))
+            if fin:
+                return message_opcode, parts[0] if len(parts) == 1 else b"".join(parts)
+
+    def send(self, opcode: int, payload: bytes = b"") -> None:
+        header = ws_frame_header(opcode, len(payload))
+        with self._send_lock:
+            if self.closed:
+                raise WebSocketClosed(1006, "connection closed")
+            try:
+                if len(payload) <= 65536:
+                    self.sock.sendall(header + payload)
+                else:
+                    # Duże wiadomości (wyniki Tissaia) bez sklejania z nagłówkiem
+                    self.sock.sendall(header)
+                    self.sock.sendall(payload)
+            except OSError as e:
+                self.closed = True
+                raise WebSocketClosed(1006, str(e))
+
+    def send_json(self, data: Dict[str, Any]) -> None:
+        self.send(WS_OP_TEXT, json.dumps(data, ensure_ascii=False).encode("utf-8"))
+
+    def close(self, code: int = 1000, reason: str = "") -> None:
+        """Wysyła ramkę close (raz); dalsze wysyłanie kończy się WebSocketClosed."""
+        with self._send_lock:
+            if self.closed:
+                return
+            self.closed = True
+            payload = code.to_bytes(2, "big") + reason.encode("utf-8")[:123]
+            try:
+                self.sock.sendall(ws_frame_header(WS_OP_CLOSE, len(payload)) + payload)
+            except OSError:
+                pass
 
-    for attempt in range(max_retries + 1):
+    def abort(self) -> None:
+        """Zrywa połączenie - odblokowuje wątek czekający w receive()."""
         try:
-            return func()
-        except retryable_exceptions as e:
-            last_exception = e
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
 
-            # Don't retry on last attempt
-            if attempt == max_retries:
+
+class WebSocketStream:
+    """Logiczny strumień w sesji: okno kredytów i anulowanie (ActiveStream)."""
+
+    def __init__(self, conn: WebSocketConnection, stream_id: str, kind: str,
+                 credit: int, control: ActiveStream) -> None:
+        self.conn = conn
+        self.id = stream_id
+        self.kind = kind
+        self.control = control
+        self._credit = credit
+        self._cond = threading.Condition()
+
+    def grant(self, n: int) -> None:
+        with self._cond:
+            self._credit += n
+            self._cond.notify_all()
+
+    def cancel(self, reason: str) -> None:
+        self.control.cancel(reason)
+        with self._cond:
+            self._cond.notify_all()
+
+    def _take_credit(self) -> None:
+        with self._cond:
+            while self._credit <= 0 and not self.control.cancelled:
+                self._cond.wait()
+            if self.control.cancelled:
+                raise StreamCancelled(self.control.reason or "cancelled")
+            self._credit -= 1
+
+    def _send(self, opcode: int, payload: bytes) -> None:
+        try:
+            self.conn.send(opcode, payload)
+        except WebSocketClosed:
+            self.control.cancel("client_disconnected")
+            raise
+
+    def emit(self, event: str, **fields: Any) -> None:
+        """Wiadomość z danymi - czeka na kredyt, gdy klient nie nadąża."""
+        self._take_credit()
+        self._send(WS_OP_TEXT, json.dumps({"id": self.id, "event": event, **fields}, ensure_ascii=False).encode("utf-8"))
+
+    def emit_frames(self, header: Dict[str, Any], blobs: List[bytes]) -> None:
+        """Wiadomość binarna (encode_frames) - też w oknie kredytów."""
+        self._take_credit()
+        self._send(WS_OP_BINARY, encode_frames({"id": self.id, **header}, blobs))
+
+    def finish(self, event: str, **fields: Any) -> None:
+        """Wiadomość końcowa (done/error/cancelled) - poza oknem kredytów."""
+        self._send(WS_OP_TEXT, json.dumps({"id": self.id, "event": event, **fields}, ensure_ascii=False).encode("utf-8"))
+
+
+def _ws_error_fields(error: Exception) -> Dict[str, Any]:
+    """Mapuje wyjątek strumienia na pola {"error", "type"} - jak odpowiedzi HTTP."""
+    if isinstance(error, AdmissionRejected):
+        return {"error": "Too many requests", "type": "rate_limited", "retry_after": error.retry_after}
+    if isinstance(error, AllProvidersFailedError):
+        return {"error": "All AI providers failed to respond.", "type": "all_providers_failed",
+                "details": error.errors, "retry_after": error.retry_after}
+    if isinstance(error, ProviderError):
+        return {"error": f"Provider error: {error}", "type": "provider_error", "provider": error.provider}
+    if isinstance(error, (ValueError, FrameError)):
+        return {"error": str(error), "type": "invalid_request"}
+    if isinstance(error, PermissionError):
+        return {"error": str(error), "type": "forbidden_command"}
+    if isinstance(error, TimeoutError):
+        return {"error": str(error), "type": "timeout_error"}
+    if isinstance(error, FileNotFoundError):
+        return {"error": str(error), "type": "not_found_error"}
+    return {"error": str(error), "type": "internal_error"}
+
+
+def _kill_process_tree(proc: subprocess.Popen) -> None:
+    try:
+        if platform.system() != "Windows":
+            # start_new_session=True - zabijamy całą grupę (shell + dzieci)
+            os.killpg(proc.pid, signal.SIGKILL)
+        else:
+            proc.kill()
+    except (ProcessLookupError, PermissionError, OSError):
+        pass
+
+
+class WebSocketSession:
+    """Multipleksuje logiczne strumienie (czat, komendy, logi, health, Tissaia) na jednym połączeniu."""
+
+    def __init__(self, conn: WebSocketConnection, client_id: str,
+                 health: Callable[[], Dict[str, Any]]) -> None:
+        self.conn = conn
+        self.client_id = client_id
+        self.health = health
+        self._lock = threading.Lock()
+        self._streams: Dict[str, WebSocketStream] = {}
+        self._threads: List[threading.Thread] = []
+        self._closed = threading.Event()
+        self._runners: Dict[str, Callable[..., None]] = {
+            "chat": self._run_chat,
+            "command": self._run_command,
+            "logs": self._run_logs,
+            "health": self._run_health,
+            "tissaia": self._run_tissaia,
+        }
+
+    def run(self) -> None:
+        """Pętla odczytu - działa do zamknięcia połączenia."""
+        with _ws_stats_lock:
+            WS_STATS["sessions"] += 1
+            WS_STATS["active_sessions"] += 1
+        keepalive = threading.Thread(target=self._keepalive, name="ws-keepalive", daemon=True)
+        keepalive.start()
+        close_code = 1001
+        try:
+            while True:
+                opcode, payload = self.conn.receive()
+                if opcode == WS_OP_BINARY:
+                    self._on_binary(payload)
+                else:
+                    self._on_text(payload)
+        except WebSocketClosed as e:
+            log(f"WS: session closed ({e.code} {e.reason})".rstrip())
+            if e.code in (1002, 1003, 1009):
+                close_code = e.code  # Błąd protokołu - klient dostaje jego kod
+        finally:
+            self._closed.set()
+            with self._lock:
+                streams = list(self._streams.values())
+            for stream in streams:
+                stream.cancel("client_disconnected")
+            for thread in self._threads:
+                thread.join(timeout=5)
+            self.conn.close(close_code)
+            with _ws_stats_lock:
+                WS_STATS["active_sessions"] -= 1
+
+    def _keepalive(self) -> None:
+        last_ping = time.monotonic()
+        while not self._closed.wait(WS_KEEPALIVE_TICK):
+            now = time.monotonic()
+            if LIFECYCLE.draining:
+                # Nowe strumienie są odrzucane; zamykamy, gdy skończą się bieżące
+                with self._lock:
+                    idle = not self._streams
+                if idle:
+                    self.conn.close(1001, "server shutting down")
+                    break
+            if now - self.conn.last_activity > 2 * WS_PING_INTERVAL + WS_KEEPALIVE_TICK:
+                log("WS: no pong from client, closing session")
+                self.conn.close(1001, "ping timeout")
                 break
+            if now - self.conn.last_activity >= WS_PING_INTERVAL and now - last_ping >= WS_PING_INTERVAL:
+                try:
+                    self.conn.send(WS_OP_PING)
+                except WebSocketClosed:
+                    break
+                last_ping = now
+        # Klient ma chwilę na odesłanie close, potem zrywamy połączenie
+        if not self._closed.wait(2.0):
+            self.conn.abort()
+
+    def _error(self, stream_id: Any, message: str, error_type: str) -> None:
+        self.conn.send_json({"id": stream_id, "event": "error", "error": message, "type": error_type})
+
+    def _on_text(self, payload: bytes) -> None:
+        try:
+            message = json.loads(payload.decode("utf-8"))
+        except (UnicodeDecodeError, json.JSONDecodeError):
+            self._error(None, "Invalid JSON", "invalid_request")
+            return
+        if not isinstance(message, dict):
+            self._error(None, "Message must be a JSON object", "invalid_request")
+            return
 
-            # Check if it's a retryable error
-            error_str = str(e).lower()
-            is_retryable = any(keyword in error_str for keyword in [
-                'rate limit',
-                'timeout',
-                'connection',
-                'network',
-                '429',
-                '503',
-                '504',
-                'overloaded'
-            ])
+        kind = message.get("type")
+        stream_id = message.get("id")
+        if kind == "ping":
+            self.conn.send_json({"id": stream_id, "event": "pong"})
+        elif kind in ("cancel", "credit"):
+            with self._lock:
+                stream = self._streams.get(stream_id)
+            if stream is None:
+                self._error(stream_id, f"No active stream with id {stream_id}", "not_found_error")
+            elif kind == "cancel":
+                stream.cancel("cancel_request")
+            else:
+                n = message.get("n")
+                if not isinstance(n, int) or isinstance(n, bool) or n <= 0:
+                    self._error(stream_id, "'n' must be a positive integer", "invalid_request")
+                else:
+                    stream.grant(n)
+        elif kind in self._runners and kind != "tissaia":
+            self._open(kind, message)
+        else:
+            self._error(stream_id, f"Unknown message type: {kind}", "invalid_request")
 
-            if not is_retryable:
-                # Non-retryable error, raise immediately
-                raise
+    def _on_binary(self, payload: bytes) -> None:
+        try:
+            header, blobs = decode_frames(payload)
+        except FrameError as e:
+            self._error(None, str(e), "invalid_request")
+            return
+        if header.get("type") != "tissaia":
+            self._error(header.get("id"), "Binary messages must have type 'tissaia'", "invalid_request")
+            return
+        self._open("tissaia", header, blobs)
 
-            log(f"RETRY: Attempt {attempt + 1}/{max_retries} failed: {str(e)[:100]}")
-            log(f"RETRY: Waiting {delay:.1f}s before next attempt...")
+    def _open(self, kind: str, message: Dict[str, Any], *args: Any) -> None:
+        stream_id = message.get("id")
+        if not isinstance(stream_id, str) or not WS_STREAM_ID_PATTERN.match(stream_id):
+            self._error(stream_id, "'id' must match [A-Za-z0-9._:-]{1,128}", "invalid_request")
+            return
+        if LIFECYCLE.draining:
+            self._error(stream_id, "Server is shutting down, reconnect", "server_draining")
+            return
+        credit = message.get("credit", WS_INITIAL_CREDIT)
+        if not isinstance(credit, int) or isinstance(credit, bool) or credit <= 0:
+            self._error(stream_id, "'credit' must be a positive integer", "invalid_request")
+            return
 
-            time.sleep(delay)
-            delay = min(delay * backoff_factor, max_delay)
+        with self._lock:
+            if stream_id in self._streams:
+                self._error(stream_id, f"Stream {stream_id} is already active", "invalid_request")
+                return
+            if len(self._streams) >= WS_MAX_STREAMS:
+                self._error(stream_id, f"Too many concurrent streams (max {WS_MAX_STREAMS})", "too_many_streams")
+                return
+            if kind == "chat":
+                max_tokens = message.get("max_tokens", DEFAULT_MAX_OUTPUT_TOKENS)
+                if not isinstance(max_tokens, int) or isinstance(max_tokens, bool) or max_tokens <= 0:
+                    max_tokens = DEFAULT_MAX_OUTPUT_TOKENS
+                request_id = message.get("request_id")
+                if not isinstance(request_id, str) or not REQUEST_ID_PATTERN.match(request_id):
+                    request_id = uuid.uuid4().hex
+                # Czat w rejestrze STREAMS - statystyki anulowań i POST /api/chat/cancel
+                control = STREAMS.register(request_id, max_tokens)
+            else:
+                control = ActiveStream(stream_id, 0)
+            stream = WebSocketStream(self.conn, stream_id, kind, credit, control)
+            self._streams[stream_id] = stream
+            thread = threading.Thread(target=self._run, args=(stream, message, *args),
+                                      name=f"ws-{kind}", daemon=True)
+            self._threads = [t for t in self._threads if t.is_alive()] + [thread]
+        with _ws_stats_lock:
+            WS_STATS["streams"][kind] = WS_STATS["streams"].get(kind, 0) + 1
+        thread.start()
+
+    def _run(self, stream: WebSocketStream, message: Dict[str, Any], *args: Any) -> None:
+        try:
+            self._runners[stream.kind](stream, message, *args)
+        except StreamCancelled:
+            if stream.control.reason != "client_disconnected":
+                try:
+                    stream.finish("cancelled", reason=stream.control.reason)
+                except WebSocketClosed:
+                    pass
+        except WebSocketClosed:
+            pass
+        except Exception as e:
+            if not isinstance(e, (ValueError, FrameError, AdmissionRejected, PermissionError)):
+                log(f"WS: {stream.kind} stream {stream.id} failed: {e}\n{traceback.format_exc()}")
+            try:
+                stream.finish("error", **_ws_error_fields(e))
+            except WebSocketClosed:
+                pass
+        finally:
+            with self._lock:
+                self._streams.pop(stream.id, None)
+
+    def _run_chat(self, stream: WebSocketStream, message: Dict[str, Any]) -> None:
+        """Czat przez gateway (hedging + failover), tokeny jako zdarzenia "text"."""
+        full_response = ""
+        client_permit: Optional[AdmissionPermit] = None
+        input_tokens = 0
+        try:
+            messages = message.get("messages")
+            error = validate_chat_messages(messages)
+            if error is not None:
+                raise ValueError(error)
+            provider = str(message.get("provider") or get_api_keys()["default_provider"]).lower()
+            if provider not in PROVIDER_STREAMERS:
+                raise ValueError(f"Unknown provider: {provider}")
+            model = message.get("model") if isinstance(message.get("model"), str) else None
+            system_prompt = message.get("system", "You are a helpful assistant.")
+            error = validate_system_prompt(system_prompt)
+            if error is not None:
+                raise ValueError(error)
+            system_prompt = system_prompt_text(system_prompt)
+            max_tokens = stream.control.max_tokens
+            hedge_after = get_config().hedge_after if message.get("hedge", True) else None
+
+            input_tokens = estimate_messages_tokens(messages, system_prompt)
+            client_permit = ADMISSION.admit(self.client_id, None, input_tokens + max_tokens)
+            client_permit.release()  # Bez slotu providera - zostaje tylko rezerwacja TPM do rozliczenia
+            routes = build_provider_routes(provider, model, fallback=message.get("fallback", True))
+
+            started = time.monotonic()
+            conversation_id = message.get("conversation_id")
+            if not isinstance(conversation_id, str) or not 0 < len(conversation_id) <= 128:
+                conversation_id = None
+            if messages[-1].get("role") == "user":
+                record_transcript("user", _message_text(messages[-1]), conversation_id=conversation_id,
+                                  provider=provider, model=model, client=self.client_id)
+
+            chat_stream = hedged_chat_stream(routes, system_prompt, messages, max_tokens, hedge_after,
+                                             cancel=stream.control.event)
+            meta: Dict[str, Any] = {}
+            try:
+                meta = next(chat_stream)
+                stream.emit("meta", request_id=stream.control.request_id, **meta)
+                for event in chat_stream:
+                    full_response += event["text"]
+                    stream.emit("text", text=event["text"])
+            finally:
+                chat_stream.close()
+                if full_response:
+                    record_transcript(
+                        "assistant", full_response, conversation_id=conversation_id,
+                        provider=meta.get("provider", provider), model=meta.get("model", model),
+                        output_tokens=estimate_tokens(full_response),
+                        latency_ms=int((time.monotonic() - started) * 1000), client=self.client_id,
+                    )
+            stream.finish("done", output_tokens=estimate_tokens(full_response))
+        finally:
+            output_tokens = estimate_tokens(full_response)
+            if client_permit is not None:
+                # TPM klienta: faktyczne zużycie zamiast pełnego budżetu max_tokens
+                client_permit.settle(input_tokens + output_tokens)
+            STREAMS.finish(stream.control, output_tokens)
+
+    def _run_command(self, stream: WebSocketStream, message: Dict[str, Any]) -> None:
+        """Komenda powłoki z wyjściem streamowanym kawałkami (stdout + stderr)."""
+        cmd = message.get("command")
+        if not cmd or not isinstance(cmd, str):
+            raise ValueError("Invalid command: must be a non-empty string")
+        if not command_allowed(cmd):
+            raise PermissionError("Command blocked for safety reasons (SAFE_MODE=true)")
+        cmd = translate_command(cmd)
+        cwd = message.get("cwd") if isinstance(message.get("cwd"), str) else os.getcwd()
+        command_timeout = get_config().command_timeout
+
+        popen_options: Dict[str, Any] = {}
+        if platform.system() == "Windows":
+            startupinfo = subprocess.STARTUPINFO()
+            startupinfo.dwFlags |= subprocess.STARTF_USESHOWWINDOW
+            startupinfo.wShowWindow = subprocess.SW_HIDE
+            popen_options["startupinfo"] = startupinfo
+        else:
+            popen_options["start_new_session"] = True
+        proc = subprocess.Popen(cmd, shell=True, cwd=cwd, stdin=subprocess.DEVNULL,
+                                stdout=subprocess.PIPE, stderr=subprocess.STDOUT, **popen_options)
+        stream.emit("meta", pid=proc.pid, cmd_executed=cmd)
+
+        timed_out = threading.Event()
+
+        def watchdog() -> None:
+            # Anulowanie albo timeout zabija proces - odblokowuje czytanie potoku
+            deadline = time.monotonic() + command_timeout
+            while proc.poll() is None:
+                if stream.control.event.wait(0.2):
+                    _kill_process_tree(proc)
+                    return
+                if time.monotonic() >= deadline:
+                    timed_out.set()
+                    _kill_process_tree(proc)
+                    return
 
-    # All retries exhausted
-    log(f"RETRY: All {max_retries} retries exhausted")
-    raise last_exception
+        threading.Thread(target=watchdog, name="ws-command-watchdog", daemon=True).start()
+        decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+        head = ""
+        try:
+            while True:
+                chunk = proc.stdout.read1(WS_COMMAND_CHUNK_BYTES)
+                if not chunk:
+                    break
+                text = decoder.decode(chunk)
+                if text:
+                    if len(head) < 500:
+                        head += text[:500 - len(head)]
+                    stream.emit("output", data=text)
+            text = decoder.decode(b"", final=True)
+            if text:
+                stream.emit("output", data=text)
+            code = proc.wait()
+        finally:
+            if proc.poll() is None:
+                _kill_process_tree(proc)
+                proc.wait()
+            proc.stdout.close()
+
+        log_ai_command(cmd, head, code)
+        if timed_out.is_set():
+            raise TimeoutError(f"Command execution timeout ({command_timeout}s)")
+        if stream.control.cancelled:
+            raise StreamCancelled(stream.control.reason or "cancelled")
+        stream.finish("done", code=code)
+
+    def _run_logs(self, stream: WebSocketStream, message: Dict[str, Any]) -> None:
+        """Ostatnie linie logu, potem (follow) dopisywane linie paczkami."""
+        source = message.get("source", "server")
+        path = LOG_SOURCES.get(source)
+        if path is None:
+            raise ValueError(f"Unknown log source: {source}. Available: {', '.join(LOG_SOURCES)}")
+        level = message.get("level")
+        if level and level not in LOG_LEVEL_KEYWORDS:
+            raise ValueError(f"Unknown level: {level}. Available: {', '.join(LOG_LEVEL_KEYWORDS)}")
+        limit = message.get("limit", LOGS_DEFAULT_LIMIT)
+        if not isinstance(limit, int) or isinstance(limit, bool):
+            raise ValueError("'limit' must be an integer")
+
+        line_filter = LogLineFilter(level, message.get("q"))
+        result = read_log_tail(path, limit, None, line_filter)
+        stream.emit("lines", source=source, lines=result["lines"])
+        offset = result["end_offset"]
+
+        while message.get("follow", True) and not LIFECYCLE.draining:
+            chunk = read_log_forward(path, offset, LOGS_MAX_LIMIT, line_filter)
+            if chunk["next_offset"] < offset:
+                stream.emit("truncated")
+            offset = chunk["next_offset"]
+            if chunk["lines"]:
+                stream.emit("lines", source=source, lines=chunk["lines"])
+                if len(chunk["lines"]) == LOGS_MAX_LIMIT:
+                    continue  # Zaległości - czytamy dalej bez czekania
+            if stream.control.event.wait(LOGS_FOLLOW_POLL_SECONDS):
+                raise StreamCancelled(stream.control.reason or "cancelled")
+        stream.finish("done")
+
+    def _run_health(self, stream: WebSocketStream, message: Dict[str, Any]) -> None:
+        """Stan serwera raz albo co "interval" sekund (zamiast odpytywania /api/health)."""
+        interval = message.get("interval")
+        if interval is not None and (not isinstance(interval, (int, float)) or interval < 1):
+            raise ValueError("'interval' must be a number >= 1")
+        while True:
+            stream.emit("health", **self.health())
+            if interval is None:
+                break
+            if stream.control.event.wait(interval):
+                raise StreamCancelled(stream.control.reason or "cancelled")
+        stream.finish("done")
+
+    def _run_tissaia(self, stream: WebSocketStream, header: Dict[str, Any], blobs: List[memoryview]) -> None:
+        """Paczka Tissaia: zdarzenia "progress" per skan, na końcu wyniki w ramce binarnej."""
+        stage = header.get("stage")
+        if stage not in TISSAIA_STAGES:
+            raise ValueError(f"Unknown Tissaia stage: {stage}")
+        if not (NUMPY_AVAILABLE and PIL_AVAILABLE):
+            raise RuntimeError("NumPy and Pillow are required. Run: pip install numpy Pillow --break-system-packages")
+        validate_tissaia_batch(stage, header)
+
+        started = time.perf_counter()
+        response, out_blobs = run_tissaia_batch(
+            stage, header, blobs, progress=lambda update: stream.emit("progress", **update)
+        )
+        response["stage"] = stage
+        response["took_ms"] = round((time.perf_counter() - started) * 1000, 1)
+        stream.emit_frames(dict(response, event="result"), out_blobs)
+        stream.finish("done", count=len(out_blobs))
+
+
+def ws_stats() -> Dict[str, Any]:
+    with _ws_stats_lock:
+        return dict(WS_STATS, streams=dict(WS_STATS["streams"]))
 
 
 class RegisAPIHandler(BaseHTTPRequestHandler):
     """Handler dla API Regis AI Studio."""
 
+    # Wspólne dla wszystkich wątków - identyczne równoległe żądania upstream są łączone
+    single_flight = SingleFlight()
+
     def log_message(self, format: str, *args) -> None:
         """Override logowania - zapisuje do pliku zamiast stderr."""
         try:
@@ -243,30 +3527,122 @@ class RegisAPIHandler(BaseHTTPRequestHandler):
         except Exception:
             pass
 
+    def end_headers(self) -> None:
+        if STARTUP_TIMINGS["first_response_ms"] is None:
+            _mark_startup("first_response_ms")
+            log(f"STARTUP: {json.dumps(startup_report())}")
+        super().end_headers()
+
     def _send_cors(self) -> None:
         """Dodaje nagłówki CORS."""
         self.send_header("Access-Control-Allow-Origin", "*")
         self.send_header("Access-Control-Allow-Methods", "GET, POST, OPTIONS")
-        self.send_header("Access-Control-Allow-Headers", "Content-Type")
+        self.send_header("Access-Control-Allow-Headers", "Content-Type, Range, If-None-Match, If-Range, X-Request-ID")
+        self.send_header("Access-Control-Expose-Headers", "ETag, Content-Range, Accept-Ranges, X-Request-ID")
 
-    def _send_json(self, code: int, data: Dict[str, Any]) -> None:
+    def _send_json(self, code: int, data: Dict[str, Any], headers: Optional[Dict[str, str]] = None) -> None:
         """Wysyła odpowiedź JSON."""
         try:
             self.send_response(code)
             self.send_header("Content-type", "application/json")
+            for name, value in (headers or {}).items():
+                self.send_header(name, value)
             self._send_cors()
             self.end_headers()
             self.wfile.write(json.dumps(data, ensure_ascii=False).encode("utf-8"))
         except Exception as e:
             log(f"SEND ERROR: {e}")
 
-    def _send_sse(self, data: str) -> None:
-        """Wysyła chunk Server-Sent Event."""
+    def _send_json_cached(self, data: Dict[str, Any], cache_control: str = "no-cache",
+                          if_none_match: Optional[str] = None,
+                          etag_exclude: tuple = ()) -> None:
+        """
+        Wysyła 200 z ETag (hash treści) albo 304 bez body, gdy klient ma aktualną wersję.
+
+        etag_exclude - pola pomijane przy liczeniu ETag (np. znacznik czasu w health),
+        żeby odpytywanie bez zmian stanu kończyło się na nagłówkach.
+        """
+        body = json.dumps(data, ensure_ascii=False).encode("utf-8")
+        if etag_exclude:
+            stable = {k: v for k, v in data.items() if k not in etag_exclude}
+            etag = content_etag(json.dumps(stable, ensure_ascii=False).encode("utf-8"))
+        else:
+            etag = content_etag(body)
+        if if_none_match is None:
+            if_none_match = self.headers.get("If-None-Match")
+        not_modified = etag_matches(if_none_match, etag)
+
+        try:
+            if not_modified:
+                self.send_response(304)
+            else:
+                self.send_response(200)
+                self.send_header("Content-type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+            self.send_header("ETag", etag)
+            self.send_header("Cache-Control", cache_control)
+            self._send_cors()
+            self.end_headers()
+            if not not_modified:
+                self.wfile.write(body)
+        except Exception as e:
+            log(f"SEND ERROR: {e}")
+
+    def _send_rate_limited(self, error: AdmissionRejected) -> None:
+        """Wysyła 429 z dokładnym nagłówkiem Retry-After."""
+        retry_after = max(1, math.ceil(error.retry_after))
+        self._send_json(429, {
+            "error": f"Rate limit exceeded ({error.reason}). Retry after {retry_after}s.",
+            "type": "rate_limit_error",
+            "reason": error.reason,
+            "retry_after": retry_after,
+        }, headers={"Retry-After": str(retry_after)})
+
+    def _client_id(self) -> str:
+        """Identyfikator klienta dla limitów (adres IP)."""
+        try:
+            return str(self.client_address[0])
+        except (AttributeError, IndexError, TypeError):
+            return "unknown"
+
+    def _client_socket(self) -> Optional[socket.socket]:
+        """Gniazdo klienta (None poza prawdziwym połączeniem, np. w testach)."""
+        connection = getattr(self, "connection", None)
+        return connection if isinstance(connection, socket.socket) else None
+
+    def _request_id(self, data: Dict[str, Any]) -> str:
+        """Id żądania do anulowania: nagłówek X-Request-ID, pole "request_id" albo nowy uuid."""
+        value = self.headers.get("X-Request-ID") or data.get("request_id")
+        if isinstance(value, str) and REQUEST_ID_PATTERN.match(value):
+            return value
+        return uuid.uuid4().hex
+
+    def _conversation_id(self, data: Dict[str, Any]) -> Optional[str]:
+        """Opcjonalny identyfikator rozmowy z body (dla /api/history)."""
+        value = data.get("conversation_id")
+        if isinstance(value, str) and 0 < len(value) <= 128:
+            return value
+        return None
+
+    def _send_sse(self, data: str) -> bool:
+        """Wysyła chunk Server-Sent Event. Zwraca False, gdy klient się rozłączył."""
         try:
             self.wfile.write(f"data: {data}\n\n".encode("utf-8"))
             self.wfile.flush()
+            return True
         except Exception as e:
             log(f"SSE ERROR: {e}")
+            return False
+
+    def _send_ndjson(self, data: Dict[str, Any]) -> bool:
+        """Wysyła jedną linię NDJSON. Zwraca False, gdy klient się rozłączył."""
+        try:
+            self.wfile.write(json.dumps(data, ensure_ascii=False).encode("utf-8") + b"\n")
+            self.wfile.flush()
+            return True
+        except Exception as e:
+            log(f"NDJSON ERROR: {e}")
+            return False
 
     def do_OPTIONS(self) -> None:
         """Obsługuje preflight CORS requests."""
@@ -287,26 +3663,13 @@ class RegisAPIHandler(BaseHTTPRequestHandler):
             })
 
         elif self.path == "/api/config":
-            keys = get_api_keys()
-            # Nie wysyłamy pełnych kluczy - tylko info czy są dostępne
-            self._send_json(200, {
-                "claudeKey": "***" if keys["claude"] else None,
-                "geminiKey": keys["gemini"],  # Legacy - Gemini może być w frontend
-                "grokKey": "***" if keys["grok"] else None,
-                "envKey": keys["gemini"],  # Backwards compatibility
-                "defaultProvider": keys["default_provider"],
-                "hasClaudeKey": bool(keys["claude"]),
-                "hasGeminiKey": bool(keys["gemini"]),
-                "hasGrokKey": bool(keys["grok"]),
-            })
+            self._send_json_cached(self.single_flight.do(
+                single_flight_key("GET /api/config"), self._config_payload
+            ))
 
         elif self.path == "/api/health":
-            # Health check endpoint
-            self._send_json(200, {
-                "status": "healthy",
-                "timestamp": datetime.datetime.now().isoformat(),
-                "anthropic_available": ANTHROPIC_AVAILABLE,
-            })
+            # Health check endpoint (timestamp poza ETag - bez zmian stanu wystarczy 304)
+            self._send_json_cached(self._health_payload(), etag_exclude=("timestamp",))
 
         elif self.path == "/api/models":
             # Fetch available models from Claude API
@@ -316,9 +3679,204 @@ class RegisAPIHandler(BaseHTTPRequestHandler):
             # Fetch available models from all providers
             self._handle_get_all_models()
 
+        elif self.path == "/api/history" or self.path.startswith("/api/history?"):
+            # Historia czatów: filtry, paginacja kursorem, wyszukiwanie pełnotekstowe
+            self._handle_history()
+
+        elif self.path == "/api/logs" or self.path.startswith("/api/logs?"):
+            # Logi serwera: tail, paginacja, filtry i follow (SSE)
+            self._handle_logs()
+
+        elif self.path == "/api/ws":
+            # WebSocket: multipleksowane strumienie czatu, komend, logów i Tissaia
+            self._handle_websocket()
+
+        elif self.path.startswith("/api/fs/read?"):
+            # fs_read przez GET - dla <img>/<video>/fetch z nagłówkiem Range
+            params = {k: v[-1] for k, v in urllib.parse.parse_qs(urllib.parse.urlsplit(self.path).query).items()}
+            if not params.get("path"):
+                self._send_json(400, {"error": "Missing 'path' parameter", "type": "invalid_request"})
+            else:
+                self._send_file(
+                    os.path.join(params.get("cwd", os.getcwd()), params["path"]),
+                    range_header=self.headers.get("Range"),
+                    if_none_match=self.headers.get("If-None-Match"),
+                    if_range=self.headers.get("If-Range"),
+                )
+
+        elif self.path.startswith("/api/claude/batch/"):
+            # Status / wyniki batcha offline (Message Batches API)
+            self._handle_claude_batch_status(self.path[len("/api/claude/batch/"):])
+
         else:
             self._send_json(404, {"error": "Not Found"})
 
+    def _handle_websocket(self) -> None:
+        """GET /api/ws - upgrade do WebSocket (RFC 6455) i sesja multipleksowana."""
+        key = self.headers.get("Sec-WebSocket-Key")
+        if (self.headers.get("Upgrade", "").lower() != "websocket" or not key
+                or self.headers.get("Sec-WebSocket-Version") != "13"):
+            self._send_json(426, {
+                "error": "WebSocket upgrade required (Sec-WebSocket-Version: 13)",
+                "type": "upgrade_required"
+            }, headers={"Sec-WebSocket-Version": "13", "Upgrade": "websocket"})
+            return
+
+        # 101 musi iść jako HTTP/1.1; po sesji połączenie jest zamykane
+        self.protocol_version = "HTTP/1.1"
+        self.close_connection = True
+        self.send_response(101, "Switching Protocols")
+        self.send_header("Upgrade", "websocket")
+        self.send_header("Connection", "Upgrade")
+        self.send_header("Sec-WebSocket-Accept", websocket_accept_key(key))
+        self.end_headers()
+        self.wfile.flush()
+
+        self.connection.settimeout(None)
+        log(f"WS: session opened from {self._client_id()}")
+        WebSocketSession(WebSocketConnection(self.rfile, self.connection), self._client_id(),
+                         self._health_payload).run()
+
+    def _handle_history(self) -> None:
+        """GET /api/history?q=&role=&provider=&model=&conversation_id=&since=&until=&before=&limit="""
+        params = {k: v[-1] for k, v in urllib.parse.parse_qs(urllib.parse.urlsplit(self.path).query).items()}
+        try:
+            limit = int(params.get("limit", HISTORY_DEFAULT_LIMIT))
+            before = int(params["before"]) if params.get("before") else None
+            since = _parse_history_time(params.get("since"))
+            until = _parse_history_time(params.get("until"))
+        except ValueError as e:
+            self._send_json(400, {"error": f"Invalid query parameter: {e}", "type": "invalid_request"})
+            return
+
+        started = time.perf_counter()
+        try:
+            result = TRANSCRIPTS.search(
+                query=params.get("q"),
+                role=params.get("role"),
+                provider=params.get("provider"),
+                model=params.get("model"),
+                conversation_id=params.get("conversation_id"),
+                since=since,
+                until=until,
+                before=before,
+                limit=limit,
+            )
+        except sqlite3.Error as e:
+            log(f"HISTORY ERROR: {e}")
+            self._send_json(500, {"error": f"History query failed: {e}", "type": "history_error"})
+            return
+        result["took_ms"] = round((time.perf_counter() - started) * 1000, 2)
+        self._send_json(200, result)
+
+    def _handle_logs(self) -> None:
+        """GET /api/logs?source=&limit=&before=&after=&level=&q=&follow="""
+        params = {k: v[-1] for k, v in urllib.parse.parse_qs(urllib.parse.urlsplit(self.path).query).items()}
+        source = params.get("source", "server")
+        path = LOG_SOURCES.get(source)
+        if path is None:
+            self._send_json(400, {
+                "error": f"Unknown log source: {source}. Available: {', '.join(LOG_SOURCES)}",
+                "type": "invalid_request"
+            })
+            return
+        level = params.get("level")
+        if level and level not in LOG_LEVEL_KEYWORDS:
+            self._send_json(400, {
+                "error": f"Unknown level: {level}. Available: {', '.join(LOG_LEVEL_KEYWORDS)}",
+                "type": "invalid_request"
+            })
+            return
+        try:
+            limit = int(params.get("limit", LOGS_DEFAULT_LIMIT))
+            before = int(params["before"]) if params.get("before") else None
+            after = int(params["after"]) if params.get("after") else None
+        except ValueError as e:
+            self._send_json(400, {"error": f"Invalid query parameter: {e}", "type": "invalid_request"})
+            return
+
+        line_filter = LogLineFilter(level, params.get("q"))
+        if after is not None:
+            result = read_log_forward(path, after, limit, line_filter)
+        else:
+            result = read_log_tail(path, limit, before, line_filter)
+        result["source"] = source
+
+        if params.get("follow", "").lower() in ("1", "true"):
+            offset = result.get("next_offset", result.get("end_offset", 0))
+            self._follow_log(path, offset, result["lines"], line_filter)
+        else:
+            self._send_json(200, result)
+
+    def _follow_log(self, path: str, offset: int, initial: List[Dict[str, Any]],
+                    line_filter: LogLineFilter) -> None:
+        """Streamuje dopisywane linie przez SSE, śledząc offset w pliku."""
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Cache-Control", "no-cache")
+        self._send_cors()
+        self.end_headers()
+
+        try:
+            for line in initial:
+                self.wfile.write(f"data: {json.dumps(line, ensure_ascii=False)}\n\n".encode("utf-8"))
+            self.wfile.flush()
+
+            last_write = time.monotonic()
+            while not LIFECYCLE.draining:
+                chunk = read_log_forward(path, offset, LOGS_MAX_LIMIT, line_filter)
+                if chunk["next_offset"] < offset:
+                    self.wfile.write(b"event: truncated\ndata: {}\n\n")
+                offset = chunk["next_offset"]
+                for line in chunk["lines"]:
+                    self.wfile.write(f"data: {json.dumps(line, ensure_ascii=False)}\n\n".encode("utf-8"))
+                if chunk["lines"]:
+                    self.wfile.flush()
+                    last_write = time.monotonic()
+                    if len(chunk["lines"]) == LOGS_MAX_LIMIT:
+                        continue  # Zaległości - czytamy dalej bez czekania
+                elif time.monotonic() - last_write >= LOGS_FOLLOW_HEARTBEAT_SECONDS:
+                    # Komentarz SSE - wykrywa rozłączonego klienta
+                    self.wfile.write(b": keep-alive\n\n")
+                    self.wfile.flush()
+                    last_write = time.monotonic()
+                time.sleep(LOGS_FOLLOW_POLL_SECONDS)
+        except (BrokenPipeError, ConnectionResetError, OSError) as e:
+            log(f"LOGS FOLLOW: client disconnected ({e.__class__.__name__})")
+
+    def _health_payload(self) -> Dict[str, Any]:
+        """Buduje odpowiedź /api/health (także dla strumieni "health" przez WebSocket)."""
+        return {
+            "status": "healthy",
+            "timestamp": datetime.datetime.now().isoformat(),
+            "anthropic_available": ANTHROPIC_AVAILABLE,
+            "gateway": GATEWAY_STATS,
+            "single_flight": self.single_flight.stats(),
+            "admission": ADMISSION.stats(),
+            "worker": {"pid": os.getpid(), "workers": WORKER_COUNT},
+            "lifecycle": LIFECYCLE.stats(),
+            "startup": startup_report(),
+            "config": {"version": CONFIG.version, "loaded_at": CONFIG.loaded_at},
+            "transcripts": TRANSCRIPTS.stats(),
+            "streams": STREAMS.stats(),
+            "websocket": ws_stats(),
+        }
+
+    def _config_payload(self) -> Dict[str, Any]:
+        """Buduje odpowiedź /api/config."""
+        keys = get_api_keys()
+        # Nie wysyłamy pełnych kluczy - tylko info czy są dostępne
+        return {
+            "claudeKey": "***" if keys["claude"] else None,
+            "geminiKey": keys["gemini"],  # Legacy - Gemini może być w frontend
+            "grokKey": "***" if keys["grok"] else None,
+            "envKey": keys["gemini"],  # Backwards compatibility
+            "defaultProvider": keys["default_provider"],
+            "hasClaudeKey": bool(keys["claude"]),
+            "hasGeminiKey": bool(keys["gemini"]),
+            "hasGrokKey": bool(keys["grok"]),
+        }
+
     def _handle_get_models(self) -> None:
         """Fetches available models from Claude API."""
         if not ANTHROPIC_AVAILABLE:
@@ -329,7 +3887,7 @@ class RegisAPIHandler(BaseHTTPRequestHandler):
             })
             return
 
-        api_key = os.environ.get("ANTHROPIC_API_KEY")
+        api_key = get_config().claude_key
         if not api_key:
             self._send_json(401, {
                 "error": "ANTHROPIC_API_KEY not configured",
@@ -342,7 +3900,8 @@ class RegisAPIHandler(BaseHTTPRequestHandler):
             client = anthropic.Anthropic(api_key=api_key)
 
             # Fetch models from Claude API
-            models_response = client.models.list()
+            with ADMISSION.admit(None, "claude", priority="background"):
+                models_response = client.models.list()
 
             # Convert to list of model info
             models = []
@@ -357,12 +3916,14 @@ class RegisAPIHandler(BaseHTTPRequestHandler):
 
             log(f"MODELS: Fetched {len(models)} models from Claude API")
 
-            self._send_json(200, {
+            self._send_json_cached({
                 "models": models,
                 "count": len(models),
                 "provider": "claude"
-            })
+            }, cache_control=MODELS_CACHE_CONTROL)
 
+        except AdmissionRejected as e:
+            self._send_rate_limited(e)
         except anthropic.APIError as e:
             log(f"MODELS API ERROR: {e}")
             error_str = str(e).lower()
@@ -392,13 +3953,14 @@ class RegisAPIHandler(BaseHTTPRequestHandler):
         if not ANTHROPIC_AVAILABLE:
             return {"models": [], "error": "Anthropic SDK not installed"}
 
-        api_key = os.environ.get("ANTHROPIC_API_KEY")
+        api_key = get_config().claude_key
         if not api_key:
             return {"models": [], "error": "ANTHROPIC_API_KEY not configured"}
 
         try:
             client = anthropic.Anthropic(api_key=api_key)
-            models_response = client.models.list()
+            with ADMISSION.admit(None, "claude", priority="background"):
+                models_response = client.models.list()
 
             models = []
             for model in models_response.data:
@@ -422,7 +3984,7 @@ class RegisAPIHandler(BaseHTTPRequestHandler):
         if not GOOGLE_AI_AVAILABLE:
             return {"models": [], "error": "Google Generative AI SDK not installed"}
 
-        api_key = os.environ.get("GOOGLE_API_KEY")
+        api_key = get_config().gemini_key
         if not api_key:
             return {"models": [], "error": "GOOGLE_API_KEY not configured"}
 
@@ -430,7 +3992,9 @@ class RegisAPIHandler(BaseHTTPRequestHandler):
             genai.configure(api_key=api_key)
 
             models = []
-            for model in genai.list_models():
+            with ADMISSION.admit(None, "gemini", priority="background"):
+                gemini_models = list(genai.list_models())
+            for model in gemini_models:
                 # Filter for generative models that support content generation
                 if 'generateContent' in model.supported_generation_methods:
                     model_id = model.name.replace('models/', '')
@@ -453,17 +4017,18 @@ class RegisAPIHandler(BaseHTTPRequestHandler):
         if not OPENAI_AVAILABLE:
             return {"models": [], "error": "OpenAI SDK not installed (needed for Grok)"}
 
-        api_key = os.environ.get("XAI_API_KEY")
+        api_key = get_config().grok_key
         if not api_key:
             return {"models": [], "error": "XAI_API_KEY not configured"}
 
         try:
-            client = OpenAI(
+            client = openai.OpenAI(
                 api_key=api_key,
-                base_url="https://api.x.ai/v1"
+                base_url=XAI_BASE_URL
             )
 
-            models_response = client.models.list()
+            with ADMISSION.admit(None, "grok", priority="background"):
+                models_response = client.models.list()
 
             models = []
             for model in models_response.data:
@@ -484,6 +4049,13 @@ class RegisAPIHandler(BaseHTTPRequestHandler):
 
     def _handle_get_all_models(self) -> None:
         """Fetches available models from all configured providers."""
+        result = self.single_flight.do(
+            single_flight_key("GET /api/models/all"), self._collect_all_models
+        )
+        self._send_json_cached(result, cache_control=MODELS_CACHE_CONTROL)
+
+    def _collect_all_models(self) -> Dict[str, Any]:
+        """Pobiera listy modeli od wszystkich providerów."""
         result = {
             "claude": self._fetch_claude_models(),
             "gemini": self._fetch_gemini_models(),
@@ -497,13 +4069,19 @@ class RegisAPIHandler(BaseHTTPRequestHandler):
         )
 
         log(f"ALL MODELS: Total {total_count} models fetched")
-
-        self._send_json(200, result)
+        return result
 
     def do_POST(self) -> None:
         """Obsługuje POST requests."""
         try:
             length = int(self.headers.get("Content-Length", 0))
+
+            # === TISSAIA: binarne ramki obrazów (bez JSON/base64) ===
+            if self.path.startswith("/api/tissaia/"):
+                log(f"POST {self.path} ({length} bytes)")
+                self._handle_tissaia(self.path[len("/api/tissaia/"):], length)
+                return
+
             body = self.rfile.read(length).decode("utf-8")
             data = json.loads(body) if body else {}
 
@@ -513,10 +4091,26 @@ class RegisAPIHandler(BaseHTTPRequestHandler):
             if self.path == "/api/claude/chat":
                 self._handle_claude_chat(data)
 
+            # === CLAUDE BATCH (NDJSON) ===
+            elif self.path == "/api/claude/batch":
+                self._handle_claude_batch(data)
+
+            # === UNIFIED CHAT GATEWAY (hedging + failover) ===
+            elif self.path == "/api/chat":
+                self._handle_chat(data)
+
+            # === ANULOWANIE STREAMU CZATU (po request_id) ===
+            elif self.path == "/api/chat/cancel":
+                self._handle_chat_cancel(data)
+
             # === CLAUDE IMPROVE PROMPT ===
             elif self.path == "/api/claude/improve":
                 self._handle_claude_improve(data)
 
+            # === ADMIN: ZERO-DOWNTIME RELOAD / GRACEFUL SHUTDOWN ===
+            elif self.path in ("/api/admin/reload", "/api/admin/shutdown"):
+                self._handle_admin_lifecycle(self.path.rsplit("/", 1)[-1])
+
             # === LEGACY API ENDPOINT ===
             elif self.path == "/api":
                 self._handle_legacy_api(data)
@@ -527,10 +4121,53 @@ class RegisAPIHandler(BaseHTTPRequestHandler):
         except json.JSONDecodeError as e:
             log(f"JSON PARSE ERROR: {e}")
             self._send_json(400, {"error": "Invalid JSON"})
+        except AdmissionRejected as e:
+            self._send_rate_limited(e)
         except Exception as e:
             log(f"CRASH: {e}\n{traceback.format_exc()}")
             self._send_json(500, {"error": str(e)})
 
+    def _handle_tissaia(self, stage: str, length: int) -> None:
+        """POST /api/tissaia/{crop,enhance} - paczka skanów w ramce binarnej."""
+        if stage not in TISSAIA_STAGES:
+            self._send_json(404, {"error": f"Unknown Tissaia stage: {stage}", "type": "not_found"})
+            return
+        if not (NUMPY_AVAILABLE and PIL_AVAILABLE):
+            self._send_json(500, {
+                "error": "NumPy and Pillow are required. Run: pip install numpy Pillow --break-system-packages",
+                "type": "missing_dependency"
+            })
+            return
+        if length > TISSAIA_MAX_BATCH_BYTES:
+            self.close_connection = True
+            self._send_json(413, {
+                "error": f"Batch too large: {length} bytes (max {TISSAIA_MAX_BATCH_BYTES})",
+                "type": "payload_too_large"
+            })
+            return
+
+        try:
+            header, blobs = decode_frames(self.rfile.read(length))
+            items = header["items"]
+            validate_tissaia_batch(stage, header)
+            started = time.perf_counter()
+            response_header, out_blobs = run_tissaia_batch(stage, header, blobs)
+        except FrameError as e:
+            self._send_json(400, {"error": str(e), "type": "invalid_request"})
+            return
+
+        response_header["stage"] = stage
+        response_header["took_ms"] = round((time.perf_counter() - started) * 1000, 1)
+        payload = encode_frames(response_header, out_blobs)
+        log(f"TISSAIA: {stage} {len(items)} items -> {len(out_blobs)} images in {response_header['took_ms']} ms")
+
+        self.send_response(200)
+        self.send_header("Content-Type", TISSAIA_FRAMES_MIME)
+        self.send_header("Content-Length", str(len(payload)))
+        self._send_cors()
+        self.end_headers()
+        self.wfile.write(payload)
+
     def _handle_claude_chat(self, data: Dict[str, Any]) -> None:
         """Obsługuje chat z Claude API ze streamingiem."""
         if not ANTHROPIC_AVAILABLE:
@@ -540,7 +4177,7 @@ class RegisAPIHandler(BaseHTTPRequestHandler):
             })
             return
 
-        api_key = os.environ.get("ANTHROPIC_API_KEY")
+        api_key = get_config().claude_key
         if not api_key:
             self._send_json(401, {
                 "error": "ANTHROPIC_API_KEY not configured in .env file. Please add your API key.",
@@ -577,50 +4214,119 @@ class RegisAPIHandler(BaseHTTPRequestHandler):
         system_prompt = data.get("system", "You are a helpful assistant.")
         stream = data.get("stream", True)
 
+        error = validate_system_prompt(system_prompt)
+        if error is not None:
+            self._send_json(400, {"error": error, "type": "invalid_request"})
+            return
+
         # Relaxed model validation - let the API handle unknown models
         if not isinstance(model, str):
             model = "claude-sonnet-4-20250514"  # Fallback to default
 
-        log(f"CLAUDE CHAT: model={model}, messages={len(messages)}, stream={stream}")
+        if not all(isinstance(m, dict) and m.get("role") in ("user", "assistant") for m in messages):
+            self._send_json(400, {
+                "error": "Invalid request: each message must be an object with role 'user' or 'assistant'",
+                "type": "invalid_request"
+            })
+            return
+
+        max_tokens = data.get("max_tokens", DEFAULT_MAX_OUTPUT_TOKENS)
+        if not isinstance(max_tokens, int) or isinstance(max_tokens, bool) or max_tokens <= 0:
+            max_tokens = DEFAULT_MAX_OUTPUT_TOKENS
+
+        # Walidacja i przycięcie kontekstu lokalnie - zanim zapłacimy za round-trip
+        try:
+            messages, system_prompt, max_tokens, context_info = fit_messages_to_context(
+                messages, system_prompt, model, max_tokens
+            )
+        except ContextLengthError as e:
+            log(f"CLAUDE CONTEXT ERROR: {e}")
+            self._send_json(400, {
+                "error": str(e),
+                "type": "context_length_exceeded"
+            })
+            return
+
+        log(f"CLAUDE CHAT: model={model}, messages={len(messages)}, stream={stream}, "
+            f"input~{context_info['estimated_input_tokens']}")
+
+        try:
+            permit = ADMISSION.admit(
+                self._client_id(), "claude", context_info["estimated_input_tokens"] + max_tokens
+            )
+        except AdmissionRejected as e:
+            self._send_rate_limited(e)
+            return
 
-        # Log user message
+        # Historia: wiadomość użytkownika
+        started = time.monotonic()
+        conversation_id = self._conversation_id(data)
         if messages and len(messages) > 0:
             last_message = messages[-1]
             if isinstance(last_message, dict) and last_message.get("role") == "user":
-                log_chat("user", last_message.get("content", "")[:500])  # Log first 500 chars
+                record_transcript("user", _message_text(last_message), conversation_id=conversation_id,
+                                  provider="claude", model=model, client=self._client_id())
 
         try:
             client = anthropic.Anthropic(api_key=api_key)
 
             if stream:
                 # Streaming response
-                self.send_response(200)
-                self.send_header("Content-Type", "text/event-stream")
-                self.send_header("Cache-Control", "no-cache")
-                self._send_cors()
-                self.end_headers()
-
+                active = STREAMS.register(self._request_id(data), max_tokens, self._client_socket())
                 full_response = ""
-                with client.messages.stream(
-                    model=model,
-                    max_tokens=4096,
-                    system=system_prompt,
-                    messages=messages,
-                ) as stream_response:
-                    for text in stream_response.text_stream:
-                        full_response += text
-                        self._send_sse(json.dumps({"text": text}))
-
-                # Log assistant response
-                log_chat("assistant", full_response[:500])  # Log first 500 chars
-                self._send_sse("[DONE]")
+                try:
+                    self.send_response(200)
+                    self.send_header("Content-Type", "text/event-stream")
+                    self.send_header("Cache-Control", "no-cache")
+                    self.send_header("X-Request-ID", active.request_id)
+                    self._send_cors()
+                    self.end_headers()
+
+                    if context_info["dropped_messages"]:
+                        self._send_sse(json.dumps({"context": context_info}))
+
+                    try:
+                        with client.messages.stream(
+                            model=model,
+                            max_tokens=max_tokens,
+                            system=system_prompt,
+                            messages=messages,
+                        ) as stream_response:
+                            active.track(stream_response)
+                            for text in stream_response.text_stream:
+                                full_response += text
+                                if not self._send_sse(json.dumps({"text": text})):
+                                    active.cancel("client_disconnected")
+                                if active.cancelled:
+                                    break  # Wyjście z `with` zamyka połączenie upstream
+                    except Exception:
+                        # Anulowanie zamknęło upstream w trakcie odczytu - to nie jest błąd API
+                        if not active.cancelled:
+                            raise
+                finally:
+                    output_tokens = estimate_tokens(full_response)
+                    STREAMS.finish(active, output_tokens)
+                    permit.settle(context_info["estimated_input_tokens"] + output_tokens)
+
+                # Historia: odpowiedź asystenta (zużycie szacowane - stream)
+                record_transcript(
+                    "assistant", full_response, conversation_id=conversation_id,
+                    provider="claude", model=model,
+                    input_tokens=context_info["estimated_input_tokens"],
+                    output_tokens=output_tokens,
+                    latency_ms=int((time.monotonic() - started) * 1000), client=self._client_id(),
+                )
+                if active.reason != "client_disconnected":
+                    if active.cancelled:
+                        self._send_sse(json.dumps({"cancelled": True, "request_id": active.request_id}))
+                    self._send_sse("[DONE]")
 
             else:
                 # Non-streaming response with retry logic
                 def make_api_call():
                     return client.messages.create(
                         model=model,
-                        max_tokens=4096,
+                        max_tokens=max_tokens,
                         system=system_prompt,
                         messages=messages,
                     )
@@ -634,9 +4340,17 @@ class RegisAPIHandler(BaseHTTPRequestHandler):
                     retryable_exceptions=(Exception,)
                 )
 
-                # Log assistant response
+                permit.settle(response.usage.input_tokens + response.usage.output_tokens)
+
+                # Historia: odpowiedź asystenta
                 assistant_content = response.content[0].text
-                log_chat("assistant", assistant_content[:500])  # Log first 500 chars
+                record_transcript(
+                    "assistant", assistant_content, conversation_id=conversation_id,
+                    provider="claude", model=response.model,
+                    input_tokens=response.usage.input_tokens,
+                    output_tokens=response.usage.output_tokens,
+                    latency_ms=int((time.monotonic() - started) * 1000), client=self._client_id(),
+                )
 
                 self._send_json(200, {
                     "content": assistant_content,
@@ -645,8 +4359,12 @@ class RegisAPIHandler(BaseHTTPRequestHandler):
                         "input_tokens": response.usage.input_tokens,
                         "output_tokens": response.usage.output_tokens,
                     },
+                    "context": context_info,
                 })
 
+        except AdmissionRejected as e:
+            log(f"CLAUDE RATE LIMITED: {e}")
+            self._send_rate_limited(e)
         except anthropic.APIError as e:
             log(f"CLAUDE API ERROR: {e}")
             error_type = "api_error"
@@ -687,23 +4405,446 @@ class RegisAPIHandler(BaseHTTPRequestHandler):
                 "type": "internal_error",
                 "details": str(e)
             })
+        finally:
+            permit.release()
 
-    def _handle_claude_improve(self, data: Dict[str, Any]) -> None:
-        """Ulepsza prompt używając Claude."""
+    def _handle_chat(self, data: Dict[str, Any]) -> None:
+        """Obsługuje czat przez gateway z hedgingiem i failoverem między providerami."""
+        messages = data.get("messages", [])
+        if not isinstance(messages, list) or len(messages) == 0:
+            self._send_json(400, {
+                "error": "Invalid request: 'messages' must be a non-empty array",
+                "type": "invalid_request"
+            })
+            return
+
+        if not all(isinstance(m, dict) and m.get("role") in ("user", "assistant") for m in messages):
+            self._send_json(400, {
+                "error": "Invalid request: each message must be an object with role 'user' or 'assistant'",
+                "type": "invalid_request"
+            })
+            return
+
+        provider = str(data.get("provider") or get_api_keys()["default_provider"]).lower()
+        if provider not in PROVIDER_STREAMERS:
+            self._send_json(400, {
+                "error": f"Unknown provider: {provider}",
+                "type": "invalid_request"
+            })
+            return
+
+        model = data.get("model")
+        if not isinstance(model, str):
+            model = None
+        system_prompt = data.get("system", "You are a helpful assistant.")
+        error = validate_system_prompt(system_prompt)
+        if error is not None:
+            self._send_json(400, {"error": error, "type": "invalid_request"})
+            return
+        system_prompt = system_prompt_text(system_prompt)
+        stream = data.get("stream", True)
+        max_tokens = data.get("max_tokens", DEFAULT_MAX_OUTPUT_TOKENS)
+        if not isinstance(max_tokens, int) or isinstance(max_tokens, bool) or max_tokens <= 0:
+            max_tokens = DEFAULT_MAX_OUTPUT_TOKENS
+        hedge_after = get_config().hedge_after if data.get("hedge", True) else None
+
+        # Limity klienta liczymy raz na żądanie; limity providerów sprawdza każda trasa
+        input_tokens = estimate_messages_tokens(messages, system_prompt)
+        try:
+            client_permit = ADMISSION.admit(self._client_id(), None, input_tokens + max_tokens)
+        except AdmissionRejected as e:
+            self._send_rate_limited(e)
+            return
+        client_permit.release()  # Bez slotu providera - zostaje tylko rezerwacja TPM do rozliczenia
+
+        routes = build_provider_routes(provider, model, fallback=data.get("fallback", True))
+        log(f"GATEWAY CHAT: routes={[r['provider'] for r in routes]}, messages={len(messages)}, stream={stream}")
+
+        started = time.monotonic()
+        conversation_id = self._conversation_id(data)
+        last_message = messages[-1]
+        if last_message.get("role") == "user":
+            record_transcript("user", _message_text(last_message), conversation_id=conversation_id,
+                              provider=provider, model=model, client=self._client_id())
+
+        active = STREAMS.register(self._request_id(data), max_tokens, self._client_socket())
+        chat_stream = hedged_chat_stream(routes, system_prompt, messages, max_tokens, hedge_after,
+                                         cancel=active.event)
+        full_response = ""
+        try:
+            # Nagłówki wysyłamy dopiero po wyborze zwycięzcy - do tego momentu
+            # można jeszcze odpowiedzieć poprawnym kodem błędu
+            meta = next(chat_stream)
+
+            if stream:
+                self.send_response(200)
+                self.send_header("Content-Type", "text/event-stream")
+                self.send_header("Cache-Control", "no-cache")
+                self.send_header("X-Request-ID", active.request_id)
+                self._send_cors()
+                self.end_headers()
+                self._send_sse(json.dumps(dict(meta, request_id=active.request_id)))
+
+            try:
+                for event in chat_stream:
+                    full_response += event["text"]
+                    if stream and not self._send_sse(json.dumps({"text": event["text"]})):
+                        active.cancel("client_disconnected")
+                    if active.cancelled:
+                        break
+            except StreamCancelled:
+                pass  # Anulowane w trakcie czekania na kolejny token
+            except ProviderError as e:
+                log(f"GATEWAY STREAM ERROR: {e}")
+                if not stream:
+                    raise
+                self._send_sse(json.dumps({"error": str(e), "provider": e.provider}))
+
+            record_transcript(
+                "assistant", full_response, conversation_id=conversation_id,
+                provider=meta["provider"], model=meta["model"],
+                input_tokens=(meta["context"] or {}).get("estimated_input_tokens"),
+                output_tokens=estimate_tokens(full_response),
+                latency_ms=int((time.monotonic() - started) * 1000), client=self._client_id(),
+            )
+            if stream:
+                if active.reason != "client_disconnected":
+                    if active.cancelled:
+                        self._send_sse(json.dumps({"cancelled": True, "request_id": active.request_id}))
+                    self._send_sse("[DONE]")
+            else:
+                response = {
+                    "content": full_response,
+                    "provider": meta["provider"],
+                    "model": meta["model"],
+                    "context": meta["context"],
+                    "request_id": active.request_id,
+                }
+                if active.cancelled:
+                    response["cancelled"] = True
+                self._send_json(200, response)
+
+        except StreamCancelled:
+            # Anulowane przed pierwszym tokenem - nagłówki nie zostały jeszcze wysłane
+            if active.reason != "client_disconnected":
+                self._send_json(200, {"cancelled": True, "request_id": active.request_id, "content": ""})
+        except AllProvidersFailedError as e:
+            log(f"GATEWAY: all providers failed: {e}")
+            if e.retry_after is not None:
+                self._send_rate_limited(AdmissionRejected(e.retry_after, "all_providers_rate_limited"))
+                return
+            self._send_json(502, {
+                "error": "All AI providers failed to respond.",
+                "type": "all_providers_failed",
+                "details": e.errors,
+            })
+        except ProviderError as e:
+            self._send_json(502, {
+                "error": f"Provider error: {e}",
+                "type": "provider_error",
+                "provider": e.provider,
+            })
+        finally:
+            chat_stream.close()
+            output_tokens = estimate_tokens(full_response)
+            # TPM klienta: faktyczne zużycie zamiast pełnego budżetu max_tokens
+            client_permit.settle(input_tokens + output_tokens)
+            STREAMS.finish(active, output_tokens)
+
+    def _handle_chat_cancel(self, data: Dict[str, Any]) -> None:
+        """POST /api/chat/cancel {"request_id"} - przerywa stream /api/chat lub /api/claude/chat."""
+        request_id = data.get("request_id")
+        if not isinstance(request_id, str) or not REQUEST_ID_PATTERN.match(request_id):
+            self._send_json(400, {
+                "error": "Invalid request: 'request_id' must match [A-Za-z0-9._-]{1,128}",
+                "type": "invalid_request"
+            })
+            return
+        result = STREAMS.cancel(request_id)
+        if result == "not_found":
+            self._send_json(404, {
+                "error": f"No active stream with request_id {request_id}",
+                "type": "not_found_error"
+            })
+            return
+        log(f"STREAM: cancel requested for {request_id} ({result})")
+        self._send_json(200 if result == "cancelled" else 202, {"status": result, "request_id": request_id})
+
+    def _handle_claude_batch(self, data: Dict[str, Any]) -> None:
+        """
+        Wykonuje listę żądań czatu Claude i streamuje wyniki jako NDJSON.
+
+        mode="online" (domyślnie) - żądania idą równolegle (parallelism),
+        z retry per element; każda linia to wynik jednego elementu, ostatnia
+        linia to podsumowanie {"done": true, ...}.
+        mode="offline" - batch trafia do Message Batches API; odpowiedź zawiera
+        batch_id do odpytywania przez GET /api/claude/batch/<batch_id>.
+        """
         if not ANTHROPIC_AVAILABLE:
-            self._send_json(200, {"improved": data.get("prompt", "")})
+            self._send_json(500, {
+                "error": "Anthropic SDK not installed. Run: pip install anthropic --break-system-packages",
+                "type": "missing_dependency"
+            })
             return
 
-        api_key = os.environ.get("ANTHROPIC_API_KEY")
+        api_key = get_config().claude_key
         if not api_key:
-            self._send_json(200, {"improved": data.get("prompt", "")})
+            self._send_json(401, {
+                "error": "ANTHROPIC_API_KEY not configured in .env file. Please add your API key.",
+                "type": "missing_api_key"
+            })
+            return
+
+        try:
+            items = normalize_batch_items(data)
+        except ValueError as e:
+            self._send_json(400, {"error": f"Invalid request: {e}", "type": "invalid_request"})
+            return
+
+        client = anthropic.Anthropic(api_key=api_key)
+        mode = data.get("mode", "online")
+
+        if mode == "offline":
+            self._submit_claude_message_batch(client, items)
+            return
+        if mode != "online":
+            self._send_json(400, {"error": f"Unknown batch mode: {mode}", "type": "invalid_request"})
+            return
+
+        valid_items = [item for item in items if "error" not in item]
+        try:
+            client_permit = ADMISSION.admit(
+                self._client_id(), None,
+                sum(estimate_messages_tokens(i["messages"], i["system"]) + i["max_tokens"] for i in valid_items),
+                requests=len(valid_items),
+                priority="bulk",
+            )
+        except AdmissionRejected as e:
+            self._send_rate_limited(e)
+            return
+        client_permit.release()  # Rezerwacja TPM klienta rozliczana po zakończeniu batcha
+        usage = {"used": 0, "in_flight": 0}  # in_flight: szacunek elementów, które jeszcze trwają
+        usage_lock = threading.Lock()
+
+        parallelism = data.get("parallelism", BATCH_DEFAULT_PARALLELISM)
+        if not isinstance(parallelism, int) or isinstance(parallelism, bool):
+            parallelism = BATCH_DEFAULT_PARALLELISM
+        max_retries = data.get("max_retries", 2)
+        if not isinstance(max_retries, int) or isinstance(max_retries, bool) or max_retries < 0:
+            max_retries = 2
+
+        def complete(item: Dict[str, Any]) -> Dict[str, Any]:
+            tokens = estimate_messages_tokens(item["messages"], item["system"]) + item["max_tokens"]
+            with usage_lock:
+                usage["in_flight"] += tokens
+            try:
+                with ADMISSION.admit(None, "claude", tokens, max_wait=BATCH_ITEM_MAX_WAIT, priority="bulk") as permit:
+                    response = retry_with_backoff(
+                        func=lambda: client.messages.create(
+                            model=item["model"],
+                            max_tokens=item["max_tokens"],
+                            system=item["system"],
+                            messages=item["messages"],
+                        ),
+                        max_retries=max_retries,
+                        initial_delay=1.0,
+                        max_delay=10.0,
+                        retryable_exceptions=(Exception,)
+                    )
+                    permit.settle(response.usage.input_tokens + response.usage.output_tokens)
+            finally:
+                with usage_lock:
+                    usage["in_flight"] -= tokens
+            with usage_lock:
+                usage["used"] += response.usage.input_tokens + response.usage.output_tokens
+            return {
+                "content": response.content[0].text if response.content else "",
+                "model": response.model,
+                "usage": {
+                    "input_tokens": response.usage.input_tokens,
+                    "output_tokens": response.usage.output_tokens,
+                },
+            }
+
+        log(f"CLAUDE BATCH: items={len(items)}, parallelism={parallelism}, max_retries={max_retries}")
+
+        started = time.monotonic()
+        counts = {"succeeded": 0, "errored": 0, "canceled": 0}
+        cancel = threading.Event()
+        try:
+            self.send_response(200)
+            self.send_header("Content-Type", "application/x-ndjson")
+            self.send_header("Cache-Control", "no-cache")
+            self._send_cors()
+            self.end_headers()
+
+            for result in iter_batch_results(items, complete, parallelism, cancel):
+                counts[result["status"]] += 1
+                if not self._send_ndjson(result):
+                    # Klient się rozłączył - nie marnujemy kolejnych wywołań
+                    log("CLAUDE BATCH: client disconnected, cancelling remaining items")
+                    cancel.set()
+                    break
+            else:
+                self._send_ndjson({
+                    "done": True,
+                    **counts,
+                    "elapsed_ms": int((time.monotonic() - started) * 1000),
+                })
+        finally:
+            # Elementy, które jeszcze trwają (rozłączenie klienta), zostają policzone szacunkowo
+            with usage_lock:
+                client_permit.settle(usage["used"] + usage["in_flight"])
+
+        log(f"CLAUDE BATCH: finished {counts}")
+
+    def _submit_claude_message_batch(self, client: Any, items: List[Dict[str, Any]]) -> None:
+        """Wysyła batch do Message Batches API (tryb offline)."""
+        invalid = [
+            {"index": item["index"], "custom_id": item["custom_id"], "error": item["error"]}
+            for item in items if "error" in item
+        ]
+        if invalid:
+            self._send_json(400, {
+                "error": "Invalid batch items",
+                "type": "invalid_request",
+                "details": invalid,
+            })
+            return
+
+        if not hasattr(getattr(client, "messages", None), "batches"):
+            self._send_json(501, {
+                "error": "Message Batches API requires a newer anthropic SDK. Run: pip install -U anthropic",
+                "type": "missing_dependency"
+            })
+            return
+
+        try:
+            batch = client.messages.batches.create(requests=[
+                {
+                    "custom_id": item["custom_id"],
+                    "params": {
+                        "model": item["model"],
+                        "max_tokens": item["max_tokens"],
+                        "system": item["system"],
+                        "messages": item["messages"],
+                    },
+                }
+                for item in items
+            ])
+            log(f"CLAUDE BATCH OFFLINE: submitted {batch.id} ({len(items)} items)")
+            self._send_json(202, {
+                "batch_id": batch.id,
+                "status": batch.processing_status,
+                "count": len(items),
+                "poll": f"/api/claude/batch/{batch.id}",
+            })
+        except anthropic.APIError as e:
+            log(f"CLAUDE BATCH OFFLINE ERROR: {e}")
+            self._send_json(502, {"error": f"Claude API error: {e}", "type": "api_error"})
+
+    def _handle_claude_batch_status(self, batch_id: str) -> None:
+        """Zwraca status batcha offline, a po zakończeniu streamuje wyniki jako NDJSON."""
+        if not ANTHROPIC_AVAILABLE or not get_config().claude_key:
+            self._send_json(401, {
+                "error": "Claude is not configured (missing SDK or ANTHROPIC_API_KEY)",
+                "type": "missing_api_key"
+            })
+            return
+
+        if not BATCH_CUSTOM_ID_PATTERN.match(batch_id):
+            self._send_json(400, {"error": "Invalid batch id", "type": "invalid_request"})
+            return
+
+        client = anthropic.Anthropic(api_key=get_config().claude_key)
+        if not hasattr(client.messages, "batches"):
+            self._send_json(501, {
+                "error": "Message Batches API requires a newer anthropic SDK. Run: pip install -U anthropic",
+                "type": "missing_dependency"
+            })
             return
 
+        headers_sent = False
+        try:
+            batch = client.messages.batches.retrieve(batch_id)
+            if batch.processing_status != "ended":
+                counts = batch.request_counts
+                self._send_json(200, {
+                    "batch_id": batch.id,
+                    "status": batch.processing_status,
+                    "request_counts": {
+                        "processing": counts.processing,
+                        "succeeded": counts.succeeded,
+                        "errored": counts.errored,
+                        "canceled": counts.canceled,
+                        "expired": counts.expired,
+                    },
+                })
+                return
+
+            self.send_response(200)
+            self.send_header("Content-Type", "application/x-ndjson")
+            self._send_cors()
+            self.end_headers()
+            headers_sent = True
+
+            for entry in client.messages.batches.results(batch_id):
+                result = {"custom_id": entry.custom_id, "status": entry.result.type}
+                if entry.result.type == "succeeded":
+                    message = entry.result.message
+                    result.update({
+                        "content": message.content[0].text if message.content else "",
+                        "model": message.model,
+                        "usage": {
+                            "input_tokens": message.usage.input_tokens,
+                            "output_tokens": message.usage.output_tokens,
+                        },
+                    })
+                elif entry.result.type == "errored":
+                    result["error"] = str(entry.result.error)
+                if not self._send_ndjson(result):
+                    break
+            else:
+                self._send_ndjson({"done": True, "batch_id": batch_id})
+
+        except anthropic.APIError as e:
+            log(f"CLAUDE BATCH STATUS ERROR: {e}")
+            if headers_sent:
+                # Status 200 już wysłany - błąd jako ostatnia linia NDJSON
+                self._send_ndjson({"error": f"Claude API error: {e}", "type": "api_error"})
+                self.close_connection = True
+            elif isinstance(e, anthropic.NotFoundError):
+                self._send_json(404, {"error": f"Batch not found: {batch_id}", "type": "not_found_error"})
+            else:
+                self._send_json(502, {"error": f"Claude API error: {e}", "type": "api_error"})
+
+    def _handle_claude_improve(self, data: Dict[str, Any]) -> None:
+        """Ulepsza prompt używając Claude."""
+        code, payload = self.single_flight.do(
+            single_flight_key("POST /api/claude/improve", data),
+            lambda: self._improve_prompt(data),
+        )
+        self._send_json(code, payload)
+
+    def _improve_prompt(self, data: Dict[str, Any]) -> tuple[int, Dict[str, Any]]:
+        """Wywołuje Claude i zwraca (status, odpowiedź) dla /api/claude/improve."""
+        if not isinstance(data.get("prompt", ""), str):
+            return 400, {"error": "Invalid request: 'prompt' must be a string", "type": "invalid_request"}
+
+        if not ANTHROPIC_AVAILABLE:
+            return 200, {"improved": data.get("prompt", "")}
+
+        api_key = get_config().claude_key
+        if not api_key:
+            return 200, {"improved": data.get("prompt", "")}
+
         original_prompt = data.get("prompt", "")
         if not original_prompt:
-            self._send_json(400, {"error": "No prompt provided"})
-            return
+            return 400, {"error": "No prompt provided"}
 
+        permit = ADMISSION.admit(
+            self._client_id(), "claude", estimate_tokens(original_prompt) + 1024 + 100, priority="improve"
+        )
         try:
             client = anthropic.Anthropic(api_key=api_key)
 
@@ -729,12 +4870,124 @@ Odpowiedz TYLKO ulepszonym promptem, bez wyjaśnień.""",
                 initial_delay=1.0,
                 retryable_exceptions=(Exception,)
             )
+            permit.settle(response.usage.input_tokens + response.usage.output_tokens)
             improved = response.content[0].text
-            self._send_json(200, {"improved": improved})
+            return 200, {"improved": improved}
 
+        except AdmissionRejected:
+            raise
         except Exception as e:
             log(f"IMPROVE ERROR: {e}")
-            self._send_json(200, {"improved": original_prompt})
+            return 200, {"improved": original_prompt}
+        finally:
+            permit.release()
+
+    def _send_file(self, path: str, range_header: Optional[str] = None,
+                   if_none_match: Optional[str] = None, if_range: Optional[str] = None) -> None:
+        """
+        Wysyła plik (cały lub zakres bajtów) z ETag/304 i wykrytym Content-Type.
+
+        Treść nie przechodzi przez stringi Pythona: os.sendfile (przez
+        socket.sendfile) tam, gdzie jest dostępny, w przeciwnym razie plasterki mmap.
+        """
+        try:
+            f = open(path, "rb")
+        except FileNotFoundError:
+            self._send_json(404, {"error": f"File not found: {path}", "type": "not_found_error"})
+            return
+        except IsADirectoryError:
+            self._send_json(400, {"error": f"Path is a directory: {path}", "type": "invalid_path_error"})
+            return
+        except PermissionError:
+            self._send_json(403, {"error": f"Permission denied: {path}", "type": "permission_error"})
+            return
+
+        with f:
+            st = os.fstat(f.fileno())
+            if not stat.S_ISREG(st.st_mode):
+                self._send_json(400, {"error": f"Not a regular file: {path}", "type": "invalid_path_error"})
+                return
+            size = st.st_size
+            etag = file_etag(st)
+            headers = {
+                "ETag": etag,
+                "Last-Modified": email.utils.formatdate(st.st_mtime, usegmt=True),
+                "Accept-Ranges": "bytes",
+                "Cache-Control": "no-cache",
+            }
+
+            if etag_matches(if_none_match, etag):
+                self.send_response(304)
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                self._send_cors()
+                self.end_headers()
+                return
+
+            # If-Range: zakres tylko, gdy klient ma nadal tę samą wersję pliku
+            if if_range and if_range.strip() != etag:
+                range_header = None
+            try:
+                byte_range = parse_byte_range(range_header, size)
+            except ValueError as e:
+                self._send_json(416, {"error": str(e), "type": "range_not_satisfiable"},
+                                headers={"Content-Range": f"bytes */{size}"})
+                return
+
+            start, end = byte_range or (0, size - 1)
+            length = end - start + 1 if size else 0
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if size else None
+            try:
+                content_type = sniff_content_type(path, mm[:SNIFF_BYTES] if mm is not None else b"")
+                self.send_response(206 if byte_range else 200)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(length))
+                if byte_range:
+                    self.send_header("Content-Range", f"bytes {start}-{end}/{size}")
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                self.send_header("X-Content-Type-Options", "nosniff")
+                self._send_cors()
+                self.end_headers()
+
+                if not length:
+                    return
+                if hasattr(os, "sendfile") and self._client_socket() is not None:
+                    self.wfile.flush()
+                    self.connection.sendfile(f, start, length)
+                else:
+                    with memoryview(mm) as view:
+                        for position in range(start, start + length, FILE_CHUNK_BYTES):
+                            self.wfile.write(view[position:min(position + FILE_CHUNK_BYTES, start + length)])
+            except (BrokenPipeError, ConnectionResetError) as e:
+                log(f"FS_READ: client disconnected ({e.__class__.__name__})")
+            finally:
+                if mm is not None:
+                    mm.close()
+
+    def _handle_admin_lifecycle(self, action: str) -> None:
+        """Przeładowanie bez przestoju lub łagodne zamknięcie (tylko z localhost)."""
+        if self._client_id() not in ("127.0.0.1", "::1", "localhost"):
+            self._send_json(403, {
+                "error": "Admin endpoints are only available from localhost",
+                "type": "forbidden"
+            })
+            return
+
+        if action == "reload":
+            if not reload_supported():
+                self._send_json(501, {
+                    "error": "Zero-downtime reload is not supported on this platform",
+                    "type": "not_supported"
+                })
+                return
+            log("ADMIN: reload requested")
+            self._send_json(202, {"status": "reloading", "drain_timeout": get_config().drain_timeout})
+            request_reload()
+        else:
+            log("ADMIN: graceful shutdown requested")
+            self._send_json(202, {"status": "draining", "drain_timeout": get_config().drain_timeout})
+            request_graceful_shutdown()
 
     def _handle_legacy_api(self, data: Dict[str, Any]) -> None:
         """Obsługuje legacy API dla kompatybilności wstecznej."""
@@ -755,28 +5008,14 @@ Odpowiedz TYLKO ulepszonym promptem, bez wyjaśnień.""",
                 return
 
             # Security: Optional safety check (disabled by default for power users)
-            safe_mode = os.environ.get("SAFE_MODE", "false").lower() == "true"
-            if safe_mode:
-                dangerous_patterns = ["rm -rf", "del /f", "format ", "mkfs", "dd if="]
-                if any(pattern in cmd.lower() for pattern in dangerous_patterns):
-                    log(f"WARNING: Potentially dangerous command blocked: {cmd}")
-                    self._send_json(403, {
-                        "error": "Command blocked for safety reasons (SAFE_MODE=true)",
-                        "type": "forbidden_command"
-                    })
-                    return
-            else:
-                # Log warning but allow execution
-                dangerous_patterns = ["rm -rf", "del /f", "format ", "mkfs", "dd if="]
-                if any(pattern in cmd.lower() for pattern in dangerous_patterns):
-                    log(f"WARNING: Executing potentially dangerous command: {cmd}")
-
-            # Windows command translation
-            if platform.system() == "Windows":
-                if cmd.strip() == "ls":
-                    cmd = "dir"
-                if cmd.startswith("ls "):
-                    cmd = cmd.replace("ls ", "dir ", 1)
+            if not command_allowed(cmd):
+                self._send_json(403, {
+                    "error": "Command blocked for safety reasons (SAFE_MODE=true)",
+                    "type": "forbidden_command"
+                })
+                return
+
+            cmd = translate_command(cmd)
 
             try:
                 # Hide window on Windows
@@ -787,7 +5026,7 @@ Odpowiedz TYLKO ulepszonym promptem, bez wyjaśnień.""",
                     startupinfo.wShowWindow = subprocess.SW_HIDE
 
                 # Add timeout to prevent hanging (configurable via .env)
-                command_timeout = int(os.environ.get("COMMAND_TIMEOUT", "300"))  # Default 5 minutes
+                command_timeout = get_config().command_timeout  # Default 5 minutes
                 result = subprocess.run(
                     cmd,
                     shell=True,
@@ -811,7 +5050,7 @@ Odpowiedz TYLKO ulepszonym promptem, bez wyjaśnień.""",
                     "cmd_executed": cmd,
                 })
             except subprocess.TimeoutExpired:
-                command_timeout = int(os.environ.get("COMMAND_TIMEOUT", "300"))
+                command_timeout = get_config().command_timeout
                 log(f"COMMAND TIMEOUT: {cmd}")
                 self._send_json(408, {
                     "error": f"Command execution timeout ({command_timeout}s)",
@@ -880,7 +5119,11 @@ Odpowiedz TYLKO ulepszonym promptem, bez wyjaśnień.""",
                     )
                 )
 
-                self._send_json(200, {"files": items, "cwd": os.path.abspath(cwd)})
+                # Klient może odesłać poprzedni ETag (nagłówek lub "etag" w body) - 304 gdy katalog bez zmian
+                self._send_json_cached(
+                    {"files": items, "cwd": os.path.abspath(cwd)},
+                    if_none_match=data.get("etag") or self.headers.get("If-None-Match"),
+                )
             except PermissionError as e:
                 log(f"PERMISSION DENIED: {cwd} - {e}")
                 self._send_json(403, {
@@ -894,24 +5137,542 @@ Odpowiedz TYLKO ulepszonym promptem, bez wyjaśnień.""",
                     "type": "internal_error"
                 })
 
+        elif action == "fs_read":
+            # Odczyt pliku bez powłoki: Range / If-None-Match z nagłówków lub z body
+            path = data.get("path")
+            if not path or not isinstance(path, str):
+                self._send_json(400, {
+                    "error": "Invalid request: 'path' must be a non-empty string",
+                    "type": "invalid_request"
+                })
+                return
+            self._send_file(
+                os.path.join(cwd, path),
+                range_header=data.get("range") or self.headers.get("Range"),
+                if_none_match=data.get("etag") or self.headers.get("If-None-Match"),
+                if_range=self.headers.get("If-Range"),
+            )
+
         elif action == "shutdown":
             log("SHUTDOWN COMMAND RECEIVED")
             self._send_json(200, {"status": "bye"})
-            if platform.system() == "Windows":
-                os.system("taskkill /F /IM python.exe /T")
-            else:
-                os.kill(os.getpid(), 9)
+            # Łagodne zamknięcie - aktywne streamy i komendy kończą się przed wyjściem
+            request_graceful_shutdown()
 
         else:
             self._send_json(400, {"error": f"Unknown action: {action}"})
 
 
-def run_server(port: int = 8000, host: str = "127.0.0.1") -> None:
-    """Uruchamia serwer HTTP."""
+# Vercel (i local_server.py) szukają klasy o nazwie `handler`
+handler = RegisAPIHandler
+
+
+def resolve_worker_count(value: Optional[str]) -> int:
+    """Zamienia BACKEND_WORKERS ("auto", "0", liczba) na liczbę procesów."""
+    if value is None or str(value).strip() == "":
+        return 1
+    value = str(value).strip().lower()
+    if value in ("auto", "0"):
+        # sched_getaffinity respektuje cpuset kontenera, cpu_count() nie
+        if hasattr(os, "sched_getaffinity"):
+            return max(1, len(os.sched_getaffinity(0)))
+        return os.cpu_count() or 1
+    try:
+        return max(1, int(value))
+    except ValueError:
+        log(f"PREFORK: invalid BACKEND_WORKERS={value!r}, using 1")
+        return 1
+
+
+def _create_listen_socket(host: str, port: int, reuse_port: bool = False) -> socket.socket:
+    """Tworzy gniazdo nasłuchujące (opcjonalnie z SO_REUSEPORT)."""
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reuse_port:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind((host, port))
+    sock.listen(socket.SOMAXCONN)
+    return sock
+
+
+# =============================================================================
+# Lifecycle - łagodne zamykanie, drenowanie i przeładowanie bez przestoju
+# =============================================================================
+
+# Ile sekund nowy proces ma na zgłoszenie gotowości przy przeładowaniu
+RELOAD_READY_TIMEOUT = float(os.environ.get("RELOAD_READY_TIMEOUT", "30"))
+LISTEN_FD_ENV = "REGIS_LISTEN_FD"
+READY_FD_ENV = "REGIS_READY_FD"
+
+# PID supervisora prefork (w procesach-workerach); None w trybie jednoprocesowym
+SUPERVISOR_PID: Optional[int] = None
+
+
+class ServerLifecycle:
+    """Śledzi aktywne żądania i koordynuje zatrzymanie serwera z drenowaniem."""
+
+    def __init__(self) -> None:
+        self._cond = threading.Condition()
+        self._active = 0
+        self._draining = False
+        self._handover = False
+        self._server: Optional[ThreadingHTTPServer] = None
+
+    def attach(self, server: ThreadingHTTPServer) -> None:
+        self._server = server
+
+    def begin(self) -> None:
+        with self._cond:
+            self._active += 1
+
+    def end(self) -> None:
+        with self._cond:
+            self._active -= 1
+            self._cond.notify_all()
+
+    def request_stop(self, handover: bool = False) -> None:
+        """
+        Przestaje przyjmować połączenia (idempotentne, bezpieczne w signal handlerze).
+
+        handover=True: gniazdo nasłuchujące przejmuje następca, więc połączeń
+        czekających w kolejce accept nie obsługujemy - odbierze je nowy proces.
+        """
+        with self._cond:
+            if handover:
+                self._handover = True
+            if self._draining:
+                return
+            self._draining = True
+        log(f"LIFECYCLE: stopping accept loop, {self._active} requests in flight")
+        if self._server is not None:
+            # shutdown() blokuje do końca serve_forever - nie może działać w jego wątku
+            threading.Thread(target=self._server.shutdown, name="lifecycle-stop", daemon=True).start()
+
+    def drain(self, timeout: Optional[float] = None) -> bool:
+        """
+        Czeka, aż aktywne żądania się zakończą. Zwraca False po przekroczeniu czasu.
+
+        Domyślny limit to DRAIN_TIMEOUT z bieżącego snapshotu konfiguracji.
+        """
+        if timeout is None:
+            timeout = get_config().drain_timeout
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            self._draining = True
+            while self._active > 0:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    log(f"LIFECYCLE: drain timeout, abandoning {self._active} requests")
+                    return False
+                self._cond.wait(remaining)
+        log("LIFECYCLE: drained")
+        return True
+
+    @property
+    def draining(self) -> bool:
+        return self._draining
+
+    @property
+    def handing_over(self) -> bool:
+        return self._handover
+
+    def stats(self) -> Dict[str, Any]:
+        with self._cond:
+            return {"active_requests": self._active, "draining": self._draining}
+
+
+LIFECYCLE = ServerLifecycle()
+
+
+class RegisHTTPServer(ThreadingHTTPServer):
+    """ThreadingHTTPServer, który zlicza obsługiwane połączenia w LIFECYCLE."""
+
+    # Wątek na żądanie - długie streamy nie blokują pozostałych klientów
+    daemon_threads = True
+
+    def process_request(self, request, client_address) -> None:
+        LIFECYCLE.begin()
+        try:
+            super().process_request(request, client_address)
+        except Exception:
+            LIFECYCLE.end()
+            raise
+
+    def process_request_thread(self, request, client_address) -> None:
+        try:
+            super().process_request_thread(request, client_address)
+        finally:
+            LIFECYCLE.end()
+
+
+def _create_server(sock: socket.socket) -> ThreadingHTTPServer:
+    """Opakowuje gotowe gniazdo w RegisHTTPServer (bez ponownego bind)."""
+    server = RegisHTTPServer(sock.getsockname()[:2], RegisAPIHandler, bind_and_activate=False)
+    server.socket.close()
+    server.socket = sock
+    host, port = sock.getsockname()[:2]
+    server.server_name = socket.getfqdn(host)
+    server.server_port = port
+    return server
+
+
+def _inherited_listen_socket() -> Optional[socket.socket]:
+    """Zwraca gniazdo przekazane przez poprzedni proces przy przeładowaniu."""
+    fd = os.environ.pop(LISTEN_FD_ENV, None)
+    if fd is None:
+        return None
+    log(f"LIFECYCLE: taking over listening socket fd={fd}")
+    return socket.socket(fileno=int(fd))
+
+
+def _notify_ready() -> None:
+    """Informuje poprzedni proces, że nowy już obsługuje połączenia."""
+    fd = os.environ.pop(READY_FD_ENV, None)
+    if fd is None:
+        return
+    try:
+        os.write(int(fd), b"1")
+        os.close(int(fd))
+    except OSError as e:
+        log(f"LIFECYCLE: ready notification failed: {e}")
+
+
+def _drain_accept_queue(server: ThreadingHTTPServer) -> None:
+    """Obsługuje połączenia, które już czekają w kolejce accept zamykanego gniazda."""
+    server.socket.setblocking(False)
+    while True:
+        try:
+            request, client_address = server.get_request()
+        except OSError:
+            break
+        server.process_request(request, client_address)
+
+
+def reload_supported() -> bool:
+    return hasattr(signal, "SIGUSR2") and platform.system() != "Windows"
+
+
+def request_reload() -> None:
+    """Zleca przeładowanie bez przestoju (SIGUSR2 do supervisora lub do siebie)."""
+    os.kill(SUPERVISOR_PID or os.getpid(), signal.SIGUSR2)
+
+
+def request_graceful_shutdown() -> None:
+    """Zleca łagodne zamknięcie: bez nowych połączeń, z drenowaniem aktywnych."""
+    if SUPERVISOR_PID:
+        os.kill(SUPERVISOR_PID, signal.SIGTERM)
+    else:
+        LIFECYCLE.request_stop()
+
+
+def spawn_successor(listen_sock: Optional[socket.socket], timeout: float = RELOAD_READY_TIMEOUT) -> bool:
+    """
+    Uruchamia nowy proces serwera (świeży kod i konfiguracja) i czeka na jego gotowość.
+
+    Gniazdo nasłuchujące jest przekazywane przez dziedziczony deskryptor, więc
+    połączenia nie są odrzucane w trakcie przełączenia. Dla SO_REUSEPORT
+    (listen_sock=None) nowy proces dokłada własne gniazda do grupy portu.
+    """
+    read_fd, write_fd = os.pipe()
+    env = dict(os.environ)
+    env[READY_FD_ENV] = str(write_fd)
+    pass_fds = [write_fd]
+    if listen_sock is not None:
+        env[LISTEN_FD_ENV] = str(listen_sock.fileno())
+        pass_fds.append(listen_sock.fileno())
+
+    try:
+        process = subprocess.Popen([sys.executable] + sys.argv, env=env, pass_fds=pass_fds)
+    except OSError as e:
+        log(f"LIFECYCLE: failed to start successor: {e}")
+        os.close(read_fd)
+        return False
+    finally:
+        os.close(write_fd)
+
+    try:
+        readable, _, _ = select.select([read_fd], [], [], timeout)
+        ready = bool(readable) and os.read(read_fd, 1) == b"1"
+    finally:
+        os.close(read_fd)
+
+    if not ready:
+        log(f"LIFECYCLE: successor {process.pid} not ready after {timeout:.0f}s, keeping current process")
+        process.terminate()
+        return False
+
+    log(f"LIFECYCLE: successor {process.pid} is ready, handing over")
+    return True
+
+
+def _serve_until_stopped(server: ThreadingHTTPServer, own_socket: bool = False) -> None:
+    """
+    serve_forever(), a po zatrzymaniu - drenowanie kolejki accept i aktywnych żądań.
+
+    Kolejkę accept pomijamy tylko wtedy, gdy gniazdo przejmuje następca
+    (przeładowanie); własnego gniazda (SO_REUSEPORT) nikt nie przejmie.
+    """
+    LIFECYCLE.attach(server)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        log("Server stopped by user")
+    finally:
+        if own_socket or not LIFECYCLE.handing_over:
+            _drain_accept_queue(server)
+        LIFECYCLE.drain()
+        TRANSCRIPTS.close()
+        shutdown_tissaia_pool()
+        server.server_close()
+
+
+def _await_workers_ready(read_fd: int, workers: int, timeout: float,
+                         stopping: Callable[[], bool]) -> bool:
+    """Czeka, aż `workers` procesów zapisze bajt gotowości do pipe."""
+    deadline = time.monotonic() + timeout
+    reported = 0
+    while reported < workers and not stopping():
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return False
+        # Krótkie odcinki - sygnał stop nie czeka na pełny timeout
+        readable, _, _ = select.select([read_fd], [], [], min(remaining, 0.5))
+        if readable:
+            data = os.read(read_fd, workers - reported)
+            if not data:
+                return False  # Wszystkie końce zapisu zamknięte - reszta workerów padła
+            reported += len(data)
+    return reported >= workers
+
+
+def _serve_prefork_worker(host: str, port: int, listen_sock: Optional[socket.socket], workers: int,
+                          ready_fd: Optional[int] = None) -> None:
+    """
+    Główna pętla procesu-workera (wywoływana w dziecku po fork).
+
+    Po utworzeniu serwera worker zapisuje bajt do ready_fd - supervisor
+    zgłasza gotowość poprzednikowi dopiero, gdy odezwą się wszystkie workery.
+    """
+    global ADMISSION, WORKER_COUNT, SUPERVISOR_PID
+
+    signal.signal(signal.SIGTERM, lambda signum, frame: LIFECYCLE.request_stop())
+    signal.signal(signal.SIGINT, lambda signum, frame: LIFECYCLE.request_stop())
+    if hasattr(signal, "SIGUSR2"):
+        # Od supervisora przy przeładowaniu: wspólne gniazdo przejmuje następca
+        signal.signal(signal.SIGUSR2, lambda signum, frame: LIFECYCLE.request_stop(handover=True))
+    if hasattr(signal, "SIGHUP"):
+        signal.signal(signal.SIGHUP, request_config_reload)
+
+    WORKER_COUNT = workers
+    SUPERVISOR_PID = os.getppid()
+    # Limity są per proces - dzielimy budżet między workery
+    ADMISSION = AdmissionController.from_config(get_config().admission, workers=workers)
+
+    own_socket = listen_sock is None
+    sock = listen_sock if listen_sock is not None else _create_listen_socket(host, port, reuse_port=True)
+    server = _create_server(sock)
+    log(f"PREFORK: worker {os.getpid()} serving on {host}:{port}")
+    _mark_startup("listening_ms")
+    if ready_fd is not None:
+        try:
+            os.write(ready_fd, b"1")
+            os.close(ready_fd)
+        except OSError as e:
+            log(f"PREFORK: worker ready notification failed: {e}")
+    _serve_until_stopped(server, own_socket=own_socket)
+
+
+def run_prefork(host: str, port: int, workers: int, reuse_port: Optional[bool] = None) -> bool:
+    """
+    Uruchamia supervisor prefork: `workers` procesów obsługuje ten sam port.
+
+    SDK są importowane w procesie-rodzicu przed fork, więc dzieci
+    współdzielą je (copy-on-write). Z SO_REUSEPORT (Linux) każdy worker ma
+    własne gniazdo i kernel rozkłada połączenia; bez niego workery dziedziczą
+    jedno gniazdo nasłuchujące. Worker, który padnie, jest uruchamiany ponownie.
+
+    SIGTERM/SIGINT zatrzymują workery z drenowaniem, SIGUSR2 uruchamia nowego
+    supervisora (przekazując gniazdo) i wygasza obecnego po jego gotowości,
+    a SIGHUP jest przekazywany workerom (przeładowanie konfiguracji).
+
+    Returns:
+        False, gdy platforma nie obsługuje fork (np. Windows) - wtedy wywołujący
+        powinien uruchomić zwykły serwer jednoprocesowy.
+    """
+    if not hasattr(os, "fork"):
+        log("PREFORK: os.fork not available on this platform, falling back to single process")
+        return False
+
+    # SDK importujemy przed fork, żeby workery współdzieliły je (copy-on-write)
+    preload_sdks()
+
+    listen_sock = _inherited_listen_socket()
+    if reuse_port is None:
+        reuse_port = (
+            listen_sock is None
+            and hasattr(socket, "SO_REUSEPORT") and platform.system() == "Linux"
+            and os.environ.get("PREFORK_REUSEPORT", "true").lower() == "true"
+        )
+
+    if reuse_port:
+        if listen_sock is not None:
+            listen_sock.close()
+            listen_sock = None
+        # Sprawdzamy od razu, czy port jest wolny - zanim wystartują workery
+        probe = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        probe.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        probe.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        try:
+            probe.bind((host, port))
+        finally:
+            probe.close()
+    elif listen_sock is None:
+        listen_sock = _create_listen_socket(host, port)
+
+    children: Dict[int, float] = {}
+    stopping = False
+    # Workery startowe zgłaszają gotowość przez pipe; podnoszone później już nie
+    ready_read, ready_write = os.pipe()
+
+    def spawn() -> None:
+        pid = os.fork()
+        if pid == 0:
+            exit_code = 0
+            try:
+                if ready_write is not None:
+                    os.close(ready_read)
+                _serve_prefork_worker(host, port, listen_sock, workers, ready_write)
+            except BaseException:
+                log(f"PREFORK: worker {os.getpid()} crashed:\n{traceback.format_exc()}")
+                exit_code = 1
+            finally:
+                # Dziecko nigdy nie wraca do kodu supervisora
+                os._exit(exit_code)
+        children[pid] = time.monotonic()
+
+    def stop(signum, frame, worker_signal: int = signal.SIGTERM) -> None:
+        nonlocal stopping
+        stopping = True
+        for pid in list(children):
+            try:
+                os.kill(pid, worker_signal)
+            except ProcessLookupError:
+                pass
+
+    def forward(signum, frame) -> None:
+        for pid in list(children):
+            try:
+                os.kill(pid, signum)
+            except ProcessLookupError:
+                pass
+
+    reloading = threading.Lock()
+
+    def reload(signum, frame) -> None:
+        if stopping or not reloading.acquire(blocking=False):
+            return
+        log("PREFORK: reload requested, starting successor")
+
+        def handover() -> None:
+            try:
+                if spawn_successor(listen_sock) and not stopping:
+                    stop(signum, None, worker_signal=signal.SIGUSR2)
+            finally:
+                reloading.release()
+        # Pętla waitpid dalej podnosi workery, które padną w trakcie startu następcy
+        threading.Thread(target=handover, name="prefork-reload", daemon=True).start()
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    if hasattr(signal, "SIGUSR2"):
+        signal.signal(signal.SIGUSR2, reload)
+    if hasattr(signal, "SIGHUP"):
+        signal.signal(signal.SIGHUP, forward)
+
+    mode = "SO_REUSEPORT" if reuse_port else "shared socket"
+    log(f"PREFORK: starting {workers} workers on {host}:{port} ({mode})")
+    for _ in range(workers):
+        spawn()
+    os.close(ready_write)
+    ready_write = None
+    if _await_workers_ready(ready_read, workers, RELOAD_READY_TIMEOUT, lambda: stopping):
+        _notify_ready()
+    else:
+        log(f"PREFORK: not all {workers} workers reported ready, not notifying predecessor")
+    os.close(ready_read)
+
+    while children:
+        try:
+            pid, status = os.waitpid(-1, 0)
+        except ChildProcessError:
+            break
+        started = children.pop(pid, None)
+        if started is None or stopping:
+            continue
+        uptime = time.monotonic() - started
+        log(f"PREFORK: worker {pid} exited (status {status}) after {uptime:.1f}s, restarting")
+        if uptime < 1.0:
+            # Ochrona przed pętlą crashy przy błędzie startu
+            time.sleep(1.0)
+        if not stopping:
+            spawn()
+
+    if listen_sock is not None:
+        listen_sock.close()
+    log("PREFORK: all workers stopped")
+    return True
+
+
+def serve(host: str, port: int, workers: int = 1) -> None:
+    """
+    Obsługuje żądania do zatrzymania (prefork, gdy workers > 1).
+
+    SIGTERM/SIGINT zatrzymują serwer z drenowaniem aktywnych żądań, SIGUSR2
+    przekazuje gniazdo nowemu procesowi i wygasza obecny (bez przestoju),
+    a SIGHUP przeładowuje konfigurację z .env.
+    """
+    if workers > 1 and run_prefork(host, port, workers):
+        return
+
+    listen_sock = _inherited_listen_socket() or _create_listen_socket(host, port)
+    server = _create_server(listen_sock)
+
+    def stop(signum, frame) -> None:
+        if LIFECYCLE.stats()["draining"]:
+            raise KeyboardInterrupt  # Drugi Ctrl+C - wyjście natychmiast
+        LIFECYCLE.request_stop()
+
+    def reload(signum, frame) -> None:
+        def handover() -> None:
+            if spawn_successor(listen_sock):
+                LIFECYCLE.request_stop(handover=True)
+        # Nie blokujemy pętli accept na czas startu następcy
+        threading.Thread(target=handover, name="lifecycle-reload", daemon=True).start()
+
+    if threading.current_thread() is threading.main_thread():
+        signal.signal(signal.SIGTERM, stop)
+        signal.signal(signal.SIGINT, stop)
+        if reload_supported():
+            signal.signal(signal.SIGUSR2, reload)
+        if hasattr(signal, "SIGHUP"):
+            signal.signal(signal.SIGHUP, request_config_reload)
+
+    log(f"Server started on {host}:{port}")
+    _mark_startup("listening_ms")
+    _notify_ready()
+    _serve_until_stopped(server)
+
+
+def run_server(port: int = 8000, host: str = "127.0.0.1", workers: Optional[int] = None) -> None:
+    """Uruchamia serwer HTTP (w trybie prefork, gdy workers > 1)."""
+    if workers is None:
+        workers = resolve_worker_count(os.environ.get("BACKEND_WORKERS"))
+
     print(f"\n{'='*60}")
     print(f"  🚀 REGIS AI STUDIO BACKEND v2.1.0")
     print(f"{'='*60}")
     print(f"  Server: http://{host}:{port}")
+    print(f"  Workers: {workers}")
     print(f"  Anthropic SDK: {'✅ Available' if ANTHROPIC_AVAILABLE else '❌ Not installed'}")
     print(f"  Google AI SDK: {'✅ Available' if GOOGLE_AI_AVAILABLE else '❌ Not installed'}")
     print(f"  OpenAI SDK (Grok): {'✅ Available' if OPENAI_AVAILABLE else '❌ Not installed'}")
@@ -928,16 +5689,18 @@ def run_server(port: int = 8000, host: str = "127.0.0.1") -> None:
         print("   Create .env file with ANTHROPIC_API_KEY, GOOGLE_API_KEY, or XAI_API_KEY")
         print()
 
-    server = HTTPServer((host, port), RegisAPIHandler)
-    log(f"Server started on {host}:{port}")
+    serve(host, port, workers)
+    print("\n[INFO] Server stopped.")
 
-    try:
-        server.serve_forever()
-    except KeyboardInterrupt:
-        log("Server stopped by user")
-        print("\n[INFO] Server stopped.")
+
+_mark_startup("module_ready_ms")
 
 
 if __name__ == "__main__":
+    if "--startup-report" in sys.argv:
+        # Zimny start: import modułu + import wszystkich dostępnych SDK
+        preload_sdks()
+        print(json.dumps(startup_report(), indent=2))
+        sys.exit(0)
     port = int(os.environ.get("BACKEND_PORT", 8000))
     run_server(port=port)
@@ -3,7 +3,6 @@ import sys
 import time
 import subprocess
 import traceback
-from http.server import HTTPServer
 
 def debug_log(msg):
     try:
@@ -18,28 +17,29 @@ def run_server():
     sys.path.append(os.path.dirname(os.path.abspath(__file__)))
     try:
         debug_log("Próba importu index.handler...")
-        from index import handler
+        from index import handler, serve, resolve_worker_count
         debug_log("Import sukces!")
     except ImportError as e:
         debug_log(f"BŁĄD IMPORTU: {e}")
         # Fallback
         sys.path.append(os.path.join(os.getcwd(), 'api'))
-        from index import handler
+        from index import handler, serve, resolve_worker_count
 
     port = int(os.environ.get('PORT', 8000))
-    host = '127.0.0.1'
+    host = os.environ.get('HOST', '127.0.0.1')
+    workers = resolve_worker_count(os.environ.get('BACKEND_WORKERS'))
     
-    print(f"Starting Python backend on http://{host}:{port}")
-    debug_log(f"Start serwera na {host}:{port}")
+    print(f"Starting Python backend on http://{host}:{port} (workers: {workers})")
+    debug_log(f"Start serwera na {host}:{port}, workery: {workers}")
 
     if not os.environ.get('GOOGLE_API_KEY'):
         print("[WARN] GOOGLE_API_KEY is not set in environment variables.")
         debug_log("Ostrzeżenie: Brak klucza API")
 
     try:
-        server = HTTPServer((host, port), handler)
-        debug_log("HTTPServer utworzony. Wchodzę w serve_forever()...")
-        server.serve_forever()
+        debug_log("Wchodzę w serve() (SIGTERM = drenowanie, SIGUSR2 = przeładowanie)...")
+        serve(host, port, workers)
+        debug_log("Serwer zatrzymany.")
     except KeyboardInterrupt:
         debug_log("Zatrzymano przez użytkownika (KeyboardInterrupt).")
     except Exception as e:
@@ -0,0 +1,358 @@
+"""
+Mikrobenchmarki gorących ścieżek RegisAPIHandler (in-process, fałszywe gniazda).
+
+    python tests/bench_backend.py                  # uruchom i wypisz wyniki
+    python tests/bench_backend.py --save           # zapisz wyniki jako baseline
+    python tests/bench_backend.py --compare        # porównaj z baseline, exit 1 przy regresji
+    python tests/bench_backend.py --compare --threshold 0.4 -k fs_list
+
+Baseline (tests/bench_baseline.json) jest lokalny i nie trafia do repo - wyniki
+z jednej maszyny nic nie mówią o innej. Typowy przebieg, na tej samej maszynie:
+
+    git stash && npm run bench:backend:save && git stash pop   # baseline z kodu bez zmian
+    npm run bench:backend                                       # porównanie ze zmianą
+
+Plik jest ignorowany przez git, więc przetrwa zmianę gałęzi. Bez baseline
+--compare tylko wypisuje wyniki, podpowiada --save i kończy się kodem 0. Porównujemy
+najlepszy czas z serii (min), bo jest najmniej wrażliwy na szum innych procesów.
+Na czas pomiaru logowanie do pliku jest wyłączone (bez I/O dysku w wynikach).
+"""
+import argparse
+import dataclasses
+import io
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+from typing import Any, Callable, Dict, List, Optional, Tuple
+from unittest.mock import patch
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '../api'))
+
+import index
+
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'bench_baseline.json')
+DEFAULT_THRESHOLD = float(os.environ.get('BENCH_THRESHOLD', '0.5'))
+# Minimalny czas jednej serii - krótsze pomiary są zbyt zaszumione
+MIN_REPEAT_SECONDS = 0.2
+REPEATS = 9
+
+
+class FakeSocket:
+    """Gniazdo dla BaseHTTPRequestHandler: żądanie z bufora, odpowiedź tylko liczona."""
+
+    def __init__(self, request: bytes) -> None:
+        self.request = request
+        self.sent = 0
+
+    def makefile(self, mode: str, buffering: int = -1) -> io.BytesIO:
+        return io.BytesIO(self.request)
+
+    def sendall(self, data: bytes) -> None:
+        self.sent += len(data)
+
+    def settimeout(self, timeout: Optional[float]) -> None:
+        pass
+
+    def close(self) -> None:
+        pass
+
+
+class NullWriter:
+    """wfile, który tylko liczy bajty (bez kosztu kopiowania do BytesIO)."""
+
+    def __init__(self) -> None:
+        self.written = 0
+
+    def write(self, data: bytes) -> int:
+        self.written += len(data)
+        return len(data)
+
+    def flush(self) -> None:
+        pass
+
+
+def http_request(method: str, path: str, body: bytes = b'') -> bytes:
+    head = f'{method} {path} HTTP/1.1\r\nHost: bench\r\nContent-Type: application/json\r\n'
+    head += f'Content-Length: {len(body)}\r\n\r\n'
+    return head.encode('ascii') + body
+
+
+def drive(raw_request: bytes) -> int:
+    """Pełny cykl handlera: parsowanie żądania, do_GET/do_POST, zapis odpowiedzi."""
+    sock = FakeSocket(raw_request)
+    index.handler(sock, ('127.0.0.1', 0), None)
+    return sock.sent
+
+
+def bare_handler() -> index.RegisAPIHandler:
+    """Handler bez połączenia - do mierzenia pojedynczych metod (_send_json, _send_sse)."""
+    h = index.handler.__new__(index.handler)
+    h.wfile = NullWriter()
+    h.request_version = 'HTTP/1.1'
+    h.requestline = 'GET /bench HTTP/1.1'
+    h.command = 'GET'
+    h.client_address = ('127.0.0.1', 0)
+    h.headers = {}
+    return h
+
+
+def chat_history(messages: int, chars: int = 500) -> List[Dict[str, str]]:
+    text = ('Zażółć gęślą jaźń. The quick brown fox jumps over the lazy dog. ' * (chars // 60 + 1))[:chars]
+    return [{'role': 'user' if i % 2 == 0 else 'assistant', 'content': f'{i}: {text}'} for i in range(messages)]
+
+
+# =============================================================================
+# Benchmarki - każdy zwraca (funkcja jednej operacji, sprzątanie)
+# =============================================================================
+
+def bench_send_json_large() -> Tuple[Callable[[], Any], Callable[[], None]]:
+    """_send_json z odpowiedzią ~1 MB (lista wiadomości jak w /api/history)."""
+    h = bare_handler()
+    payload = {'items': chat_history(2000), 'next_cursor': None}
+    return lambda: h._send_json(200, payload), lambda: None
+
+
+def bench_send_sse_token() -> Tuple[Callable[[], Any], Callable[[], None]]:
+    """Jeden token przez _send_sse (json.dumps + zapis + flush) - koszt na token streamu."""
+    h = bare_handler()
+    return lambda: h._send_sse(json.dumps({'text': ' token'})), lambda: None
+
+
+def _fs_list_bench(entries: int) -> Tuple[Callable[[], Any], Callable[[], None]]:
+    directory = tempfile.mkdtemp(prefix=f'regis-bench-{entries}-')
+    for i in range(entries):
+        with open(os.path.join(directory, f'file_{i:06d}.txt'), 'wb'):
+            pass
+    request = http_request('POST', '/api', json.dumps({'action': 'fs_list', 'cwd': directory}).encode())
+    return lambda: drive(request), lambda: shutil.rmtree(directory, ignore_errors=True)
+
+
+def bench_fs_list_10k() -> Tuple[Callable[[], Any], Callable[[], None]]:
+    """POST /api {action: fs_list} dla katalogu z 10 000 plików."""
+    return _fs_list_bench(10_000)
+
+
+def bench_fs_list_100k() -> Tuple[Callable[[], Any], Callable[[], None]]:
+    """POST /api {action: fs_list} dla katalogu ze 100 000 plików."""
+    return _fs_list_bench(100_000)
+
+
+def bench_post_large_history() -> Tuple[Callable[[], Any], Callable[[], None]]:
+    """do_POST z historią 2000 wiadomości (~1 MB): odczyt body, json.loads i walidacja.
+
+    Nieznany provider kończy żądanie po walidacji (400) - bez ruchu sieciowego.
+    """
+    body = json.dumps({'provider': 'bench-none', 'messages': chat_history(2000)}).encode()
+    request = http_request('POST', '/api/chat', body)
+    return lambda: drive(request), lambda: None
+
+
+def bench_log() -> Tuple[Callable[[], Any], Callable[[], None]]:
+    """log() z włączonym ENABLE_LOGGING do pliku tymczasowego."""
+    directory = tempfile.mkdtemp(prefix='regis-bench-log-')
+    patches = [
+        patch.object(index, 'LOG_FILE', os.path.join(directory, 'server_log.txt')),
+        patch.object(index, 'CONFIG', dataclasses.replace(index.CONFIG, enable_logging=True)),
+    ]
+    for p in patches:
+        p.start()
+
+    def cleanup() -> None:
+        for p in reversed(patches):
+            p.stop()
+        shutil.rmtree(directory, ignore_errors=True)
+
+    return lambda: index.log('GET /api/health'), cleanup
+
+
+def bench_retry_with_backoff() -> Tuple[Callable[[], Any], Callable[[], None]]:
+    """Narzut retry_with_backoff na udanym wywołaniu (ścieżka każdego żądania bez streamu)."""
+    return lambda: index.retry_with_backoff(lambda: 42, initial_delay=0.0), lambda: None
+
+
+def bench_retry_with_backoff_one_retry() -> Tuple[Callable[[], Any], Callable[[], None]]:
+    """retry_with_backoff z jednym błędem 'timeout' i zerowym opóźnieniem."""
+    def make_call() -> Callable[[], int]:
+        attempts = {'n': 0}
+
+        def call() -> int:
+            attempts['n'] += 1
+            if attempts['n'] == 1:
+                raise TimeoutError('timeout')
+            return 42
+        return call
+
+    return lambda: index.retry_with_backoff(make_call(), initial_delay=0.0), lambda: None
+
+
+BENCHMARKS: Dict[str, Callable[[], Tuple[Callable[[], Any], Callable[[], None]]]] = {
+    'send_json_large': bench_send_json_large,
+    'send_sse_token': bench_send_sse_token,
+    'fs_list_10k': bench_fs_list_10k,
+    'fs_list_100k': bench_fs_list_100k,
+    'post_large_history': bench_post_large_history,
+    'log': bench_log,
+    'retry_with_backoff': bench_retry_with_backoff,
+    'retry_with_backoff_one_retry': bench_retry_with_backoff_one_retry,
+}
+
+
+# =============================================================================
+# Pomiar, baseline i porównanie
+# =============================================================================
+
+def measure(operation: Callable[[], Any], repeats: int = REPEATS,
+            min_seconds: float = MIN_REPEAT_SECONDS) -> Dict[str, Any]:
+    """
+    Mierzy czas jednej operacji w mikrosekundach (jak timeit.autorange + repeat).
+
+    Returns:
+        {"min_us", "median_us", "number", "repeats"}
+    """
+    operation()  # Rozgrzewka (importy, cache)
+    number = 1
+    while True:
+        started = time.perf_counter()
+        for _ in range(number):
+            operation()
+        elapsed = time.perf_counter() - started
+        if elapsed >= min_seconds:
+            break
+        number *= 10 if elapsed < min_seconds / 10 else 2
+
+    timings = [elapsed / number]
+    for _ in range(repeats - 1):
+        started = time.perf_counter()
+        for _ in range(number):
+            operation()
+        timings.append((time.perf_counter() - started) / number)
+    timings.sort()
+    return {
+        'min_us': round(timings[0] * 1e6, 3),
+        'median_us': round(timings[len(timings) // 2] * 1e6, 3),
+        'number': number,
+        'repeats': repeats,
+    }
+
+
+def run_benchmarks(names: List[str], repeats: int = REPEATS, min_seconds: float = MIN_REPEAT_SECONDS,
+                   verbose: bool = True) -> Dict[str, Dict[str, Any]]:
+    results = {}
+    log_dir = tempfile.mkdtemp(prefix='regis-bench-logs-')
+    quiet = [
+        # Handler loguje każde żądanie - bez tego mierzymy dopisywanie do ./logs
+        patch.object(index, 'CONFIG', dataclasses.replace(index.CONFIG, enable_logging=False)),
+        patch.object(index, 'LOG_FILE', os.path.join(log_dir, 'server_log.txt')),
+        patch.object(index, 'AI_COMMAND_LOG', os.path.join(log_dir, 'ai-commands.log')),
+    ]
+    for p in quiet:
+        p.start()
+    try:
+        for name in names:
+            operation, cleanup = BENCHMARKS[name]()
+            try:
+                results[name] = measure(operation, repeats, min_seconds)
+            finally:
+                cleanup()
+            if verbose:
+                print(f'{name:32s} {results[name]["min_us"]:>14.3f} us  '
+                      f'(median {results[name]["median_us"]:.3f} us)', flush=True)
+    finally:
+        for p in reversed(quiet):
+            p.stop()
+        shutil.rmtree(log_dir, ignore_errors=True)
+    return results
+
+
+def environment() -> Dict[str, Any]:
+    return {
+        'python': platform.python_version(),
+        'implementation': platform.python_implementation(),
+        'platform': platform.platform(),
+        'machine': platform.machine(),
+        'cpu_count': os.cpu_count(),
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+    }
+
+
+def compare(results: Dict[str, Dict[str, Any]], baseline: Dict[str, Dict[str, Any]],
+            threshold: float = DEFAULT_THRESHOLD) -> List[Dict[str, Any]]:
+    """
+    Porównuje wyniki z baseline (po min_us).
+
+    Returns:
+        [{"name", "baseline_us", "current_us", "ratio", "regressed"}] dla benchmarków obecnych w obu
+    """
+    rows = []
+    for name, current in results.items():
+        if name not in baseline:
+            continue
+        base_us = baseline[name]['min_us']
+        ratio = current['min_us'] / base_us if base_us else float('inf')
+        rows.append({
+            'name': name,
+            'baseline_us': base_us,
+            'current_us': current['min_us'],
+            'ratio': round(ratio, 3),
+            'regressed': ratio > 1 + threshold,
+        })
+    return rows
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description='RegisAPIHandler microbenchmarks')
+    parser.add_argument('-k', '--filter', help='run only benchmarks whose name contains this text')
+    parser.add_argument('--save', action='store_true', help='store results as the new baseline')
+    parser.add_argument('--compare', action='store_true', help='fail when a result regresses past the threshold')
+    parser.add_argument('--threshold', type=float, default=DEFAULT_THRESHOLD,
+                        help=f'allowed slowdown vs baseline (default {DEFAULT_THRESHOLD:.2f} = +{DEFAULT_THRESHOLD:.0%})')
+    parser.add_argument('--baseline', default=BASELINE_PATH, help='baseline JSON path')
+    parser.add_argument('--repeats', type=int, default=REPEATS)
+    args = parser.parse_args(argv)
+
+    names = [name for name in BENCHMARKS if not args.filter or args.filter in name]
+    if not names:
+        print(f'No benchmarks match {args.filter!r}. Available: {", ".join(BENCHMARKS)}')
+        return 2
+
+    results = run_benchmarks(names, args.repeats)
+
+    if args.save:
+        stored: Dict[str, Any] = {'environment': environment(), 'results': {}}
+        if os.path.exists(args.baseline):
+            with open(args.baseline, encoding='utf-8') as f:
+                stored['results'] = json.load(f).get('results', {})
+        stored['results'].update(results)
+        with open(args.baseline, 'w', encoding='utf-8') as f:
+            json.dump(stored, f, indent=2, sort_keys=True)
+            f.write('\n')
+        print(f'Baseline saved to {args.baseline}')
+
+    if args.compare:
+        if not os.path.exists(args.baseline):
+            print(f'\nNo baseline at {args.baseline} - comparison skipped. Record one on this machine '
+                  f'from the unchanged code (npm run bench:backend:save), then rerun --compare.')
+            return 0
+        with open(args.baseline, encoding='utf-8') as f:
+            baseline = json.load(f)
+        rows = compare(results, baseline.get('results', {}), args.threshold)
+        print(f'\nComparison vs baseline ({baseline.get("environment", {}).get("platform", "unknown")}), '
+              f'threshold +{args.threshold:.0%}:')
+        for row in rows:
+            status = 'REGRESSED' if row['regressed'] else 'ok'
+            print(f'{row["name"]:32s} {row["baseline_us"]:>14.3f} -> {row["current_us"]:>14.3f} us  '
+                  f'x{row["ratio"]:.2f}  {status}')
+        missing = [name for name in results if name not in baseline.get('results', {})]
+        if missing:
+            print(f'Not in baseline (skipped): {", ".join(missing)}')
+        if any(row['regressed'] for row in rows):
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
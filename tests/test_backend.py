@@ -0,0 +1,1358 @@
+import unittest
+from unittest.mock import MagicMock, patch
+import contextlib
+import dataclasses
+import io
+import os
+import sys
+import time
+import json
+import socket
+import tempfile
+import threading
+import types
+import urllib.error
+import urllib.parse
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+# Add the directory containing index.py to the system path
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '../api'))
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+os.environ.setdefault('ENABLE_LOGGING', 'false')
+
+import index
+import bench_backend
+
+
+class TestContextWindow(unittest.TestCase):
+
+    def test_context_limit_uses_longest_prefix(self):
+        self.assertEqual(index.get_context_limit('claude-sonnet-4-20250514'), 200_000)
+        self.assertEqual(index.get_context_limit('gemini-1.5-pro-latest'), 2_097_152)
+        self.assertEqual(index.get_context_limit('gemini-2.5-flash'), 1_048_576)
+        self.assertEqual(index.get_context_limit('unknown-model'), index.DEFAULT_CONTEXT_LIMIT)
+
+    def test_estimate_weights_non_ascii_higher(self):
+        self.assertEqual(index.estimate_tokens(''), 0)
+        self.assertGreater(index.estimate_tokens('żółć' * 10), index.estimate_tokens('zolc' * 10))
+
+    def test_fitting_history_is_untouched(self):
+        messages = [{'role': 'user', 'content': 'hi', 'pinned': True}]
+        trimmed, system, max_tokens, info = index.fit_messages_to_context(
+            messages, 'sys', 'claude-sonnet-4-20250514', 4096
+        )
+        self.assertEqual(trimmed, [{'role': 'user', 'content': 'hi'}])
+        self.assertEqual(system, 'sys')
+        self.assertEqual(max_tokens, 4096)
+        self.assertEqual(info['dropped_messages'], 0)
+
+    def test_oldest_turns_dropped_pinned_kept(self):
+        old = 'o' * 500_000  # ~125k tokens
+        recent = 'r' * 500_000
+        messages = [
+            {'role': 'user', 'content': 'remember this', 'pinned': True},
+            {'role': 'assistant', 'content': old},
+            {'role': 'user', 'content': recent},
+            {'role': 'assistant', 'content': 'ok'},
+            {'role': 'user', 'content': 'latest question'},
+        ]
+        trimmed, system, max_tokens, info = index.fit_messages_to_context(
+            messages, 'sys', 'claude-sonnet-4-20250514', 4096
+        )
+        contents = [m['content'][:1] for m in trimmed]
+        self.assertEqual(contents, ['r', 'r', 'o', 'l'])
+        self.assertEqual(trimmed[0]['content'], 'remember this')
+        self.assertEqual(info['dropped_messages'], 1)
+        self.assertIn('omitted', system)
+        self.assertLessEqual(info['estimated_input_tokens'] + max_tokens, info['context_limit'])
+
+    def test_trimmed_history_starts_with_user(self):
+        big = 'x' * 400_000
+        messages = [
+            {'role': 'user', 'content': big},
+            {'role': 'assistant', 'content': big},
+            {'role': 'user', 'content': 'q'},
+        ]
+        trimmed, _, _, _ = index.fit_messages_to_context(messages, '', 'claude-3-haiku', 4096)
+        self.assertEqual(trimmed, [{'role': 'user', 'content': 'q'}])
+
+    def test_oversized_last_message_raises(self):
+        messages = [{'role': 'user', 'content': 'x' * 1_000_000}]
+        with self.assertRaises(index.ContextLengthError):
+            index.fit_messages_to_context(messages, '', 'claude-sonnet-4-20250514', 4096)
+
+    def test_max_tokens_shrinks_when_input_is_close_to_limit(self):
+        messages = [{'role': 'user', 'content': 'x' * (199_000 * 4)}]
+        _, _, max_tokens, _ = index.fit_messages_to_context(
+            messages, '', 'claude-sonnet-4-20250514', 4096
+        )
+        self.assertLess(max_tokens, 4096)
+        self.assertGreaterEqual(max_tokens, index.MIN_OUTPUT_TOKENS)
+
+    def test_list_form_system_is_estimated_and_keeps_its_shape(self):
+        system = [{'type': 'text', 'text': 'abcd' * 100}]
+        self.assertEqual(index.estimate_system_tokens(system), index.estimate_tokens('abcd' * 100))
+        big = 'x' * 400_000
+        messages = [
+            {'role': 'user', 'content': big},
+            {'role': 'assistant', 'content': big},
+            {'role': 'user', 'content': 'q'},
+        ]
+        _, trimmed_system, _, info = index.fit_messages_to_context(messages, system, 'claude-3-haiku', 4096)
+        self.assertEqual(info['dropped_messages'], 2)
+        self.assertEqual(trimmed_system[0], system[0])
+        self.assertIn('omitted', trimmed_system[-1]['text'])
+
+    def test_invalid_system_types_are_reported(self):
+        self.assertIsNone(index.validate_system_prompt('sys'))
+        self.assertIsNone(index.validate_system_prompt([{'type': 'text', 'text': 'sys'}]))
+        for bad in (42, {'text': 'sys'}, ['sys'], [{'type': 'text'}]):
+            self.assertIn('system', index.validate_system_prompt(bad))
+
+
+
+def _fake_streamer(chunks, delay=0.0, error=None):
+    def streamer(model, system, messages, max_tokens):
+        time.sleep(delay)
+        if error:
+            raise error
+        for chunk in chunks:
+            yield chunk
+    return streamer
+
+
+class TestChatGateway(unittest.TestCase):
+
+    ROUTES = [
+        {'provider': 'claude', 'model': 'claude-sonnet-4-20250514'},
+        {'provider': 'gemini', 'model': 'gemini-2.5-flash'},
+    ]
+    MESSAGES = [{'role': 'user', 'content': 'hi'}]
+
+    def run_gateway(self, streamers, hedge_after=5.0):
+        with patch.dict(index.PROVIDER_STREAMERS, streamers), \
+                patch.object(index, 'provider_available', return_value=True):
+            return list(index.hedged_chat_stream(self.ROUTES, 'sys', self.MESSAGES, 100, hedge_after))
+
+    def test_primary_streams_when_fast(self):
+        events = self.run_gateway({
+            'claude': _fake_streamer(['a', 'b']),
+            'gemini': _fake_streamer(['x']),
+        })
+        self.assertEqual(events[0]['provider'], 'claude')
+        self.assertEqual([e['text'] for e in events[1:]], ['a', 'b'])
+
+    def test_failover_when_primary_errors(self):
+        events = self.run_gateway({
+            'claude': _fake_streamer([], error=RuntimeError('overloaded')),
+            'gemini': _fake_streamer(['g']),
+        })
+        self.assertEqual(events[0]['provider'], 'gemini')
+        self.assertEqual(events[1], {'text': 'g'})
+
+    def test_hedge_wins_when_primary_is_slow(self):
+        start = time.monotonic()
+        events = self.run_gateway({
+            'claude': _fake_streamer(['slow'], delay=1.0),
+            'gemini': _fake_streamer(['fast']),
+        }, hedge_after=0.05)
+        self.assertEqual(events[0]['provider'], 'gemini')
+        self.assertEqual(events[1], {'text': 'fast'})
+        self.assertLess(time.monotonic() - start, 0.9)
+
+    def test_idle_timeout_applies_without_hedging(self):
+        config = dataclasses.replace(index.get_config(), stream_idle_timeout=0.2)
+        with patch.object(index, 'get_config', return_value=config):
+            started = time.monotonic()
+            events = self.run_gateway({
+                'claude': _fake_streamer(['slow'], delay=2.0),
+                'gemini': _fake_streamer(['g']),
+            }, hedge_after=None)
+            self.assertEqual(events[0]['provider'], 'gemini')
+            self.assertLess(time.monotonic() - started, 1.5)
+            with patch.dict(index.PROVIDER_STREAMERS, {'claude': _fake_streamer(['slow'], delay=2.0)}), \
+                    patch.object(index, 'provider_available', return_value=True):
+                with self.assertRaises(index.AllProvidersFailedError):
+                    list(index.hedged_chat_stream(self.ROUTES[:1], 'sys', self.MESSAGES, 100, None))
+
+    def test_all_failed_raises(self):
+        with self.assertRaises(index.AllProvidersFailedError) as ctx:
+            self.run_gateway({
+                'claude': _fake_streamer([], error=RuntimeError('down')),
+                'gemini': _fake_streamer([], error=RuntimeError('down too')),
+            })
+        self.assertEqual(set(ctx.exception.errors), {'claude', 'gemini'})
+
+    def test_stalled_loser_upstream_is_closed_by_coordinator(self):
+        closed = threading.Event()
+
+        class Upstream:
+            def close(self):
+                closed.set()
+
+        def stalled(model, system, messages, max_tokens):
+            index.track_upstream(Upstream())
+            closed.wait(5)  # odczyt upstream, który nigdy nie odda chunka
+            yield from ()
+
+        admission = index.AdmissionController(client_rpm=0, client_tpm=0, provider_limits={
+            'claude': {'max_concurrency': 1}, 'gemini': {'max_concurrency': 1},
+        })
+        with patch.object(index, 'ADMISSION', admission):
+            started = time.monotonic()
+            events = self.run_gateway({'claude': stalled, 'gemini': _fake_streamer(['g'])}, hedge_after=0.05)
+            self.assertEqual(events[0]['provider'], 'gemini')
+            self.assertTrue(closed.wait(1))
+            self.assertLess(time.monotonic() - started, 1)
+            deadline = time.monotonic() + 1
+            while admission.stats()['providers']['claude']['in_flight'] and time.monotonic() < deadline:
+                time.sleep(0.01)
+            self.assertEqual(admission.stats()['providers']['claude']['in_flight'], 0)
+
+    def test_http_chat_settles_client_tokens_to_actual_usage(self):
+        admission = index.AdmissionController(client_rpm=0, client_tpm=100_000,
+                                              provider_limits={'claude': {'max_concurrency': 8}})
+        server = index.ThreadingHTTPServer(('127.0.0.1', 0), index.handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        body = json.dumps({'provider': 'claude', 'fallback': False, 'stream': False, 'max_tokens': 50_000,
+                           'messages': self.MESSAGES}).encode()
+        with patch.dict(index.PROVIDER_STREAMERS, {'claude': _fake_streamer(['a', 'b'])}), \
+                patch.object(index, 'provider_available', return_value=True), \
+                patch.object(index, 'ADMISSION', admission):
+            request = urllib.request.Request(f'http://127.0.0.1:{server.server_port}/api/chat', data=body)
+            with urllib.request.urlopen(request, timeout=5) as response:
+                self.assertEqual(json.loads(response.read())['content'], 'ab')
+        bucket = admission._clients['127.0.0.1']['tpm']
+        deadline = time.monotonic() + 2
+        while bucket.available() < 99_000 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertGreater(bucket.available(), 99_000)
+
+    def test_http_chat_rejects_non_text_system(self):
+        server = index.ThreadingHTTPServer(('127.0.0.1', 0), index.handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        body = json.dumps({'provider': 'claude', 'system': {'text': 'sys'}, 'messages': self.MESSAGES}).encode()
+        request = urllib.request.Request(f'http://127.0.0.1:{server.server_port}/api/chat', data=body)
+        with self.assertRaises(urllib.error.HTTPError) as ctx:
+            urllib.request.urlopen(request, timeout=5)
+        self.assertEqual(ctx.exception.code, 400)
+        self.assertEqual(json.loads(ctx.exception.read())['type'], 'invalid_request')
+
+
+
+class TestSingleFlight(unittest.TestCase):
+
+    def test_concurrent_identical_calls_share_one_execution(self):
+        flight = index.SingleFlight()
+        started = threading.Event()
+        release = threading.Event()
+        executions = []
+
+        def upstream():
+            executions.append(1)
+            started.set()
+            release.wait(1)
+            return {'models': ['a']}
+
+        results = []
+        leader = threading.Thread(target=lambda: results.append(flight.do('k', upstream)))
+        leader.start()
+        started.wait(1)
+        followers = [threading.Thread(target=lambda: results.append(flight.do('k', upstream))) for _ in range(4)]
+        for t in followers:
+            t.start()
+        while flight.stats()['collapsed'] < 4:
+            time.sleep(0.001)
+        release.set()
+        for t in [leader] + followers:
+            t.join(1)
+
+        self.assertEqual(len(executions), 1)
+        self.assertEqual(results, [{'models': ['a']}] * 5)
+        self.assertEqual(flight.stats(), {'calls': 5, 'executed': 1, 'collapsed': 4, 'in_flight': 0})
+
+    def test_errors_propagate_and_key_is_released(self):
+        flight = index.SingleFlight()
+        with self.assertRaises(RuntimeError):
+            flight.do('k', lambda: (_ for _ in ()).throw(RuntimeError('boom')))
+        self.assertEqual(flight.do('k', lambda: 42), 42)
+
+    def test_key_normalizes_body_order(self):
+        self.assertEqual(
+            index.single_flight_key('POST /x', {'b': 1, 'a': 2}),
+            index.single_flight_key('POST /x', {'a': 2, 'b': 1}),
+        )
+
+
+
+class TestBatch(unittest.TestCase):
+
+    def test_items_inherit_defaults_and_flag_invalid_entries(self):
+        items = index.normalize_batch_items({
+            'model': 'claude-3-haiku-20240307',
+            'requests': [
+                {'messages': [{'role': 'user', 'content': 'a'}]},
+                {'custom_id': 'bad id!', 'messages': [{'role': 'user', 'content': 'b'}]},
+                {'messages': []},
+            ],
+        })
+        self.assertEqual(items[0]['model'], 'claude-3-haiku-20240307')
+        self.assertEqual(items[0]['custom_id'], 'item-0')
+        self.assertNotIn('error', items[0])
+        self.assertIn('custom_id', items[1]['error'])
+        self.assertIn('messages', items[2]['error'])
+
+    def test_item_system_must_be_text(self):
+        items = index.normalize_batch_items({
+            'system': [{'type': 'text', 'text': 'shared'}],
+            'requests': [
+                {'messages': [{'role': 'user', 'content': 'a'}]},
+                {'system': 7, 'messages': [{'role': 'user', 'content': 'b'}]},
+            ],
+        })
+        self.assertNotIn('error', items[0])
+        self.assertIn('system', items[1]['error'])
+
+    def test_empty_batch_is_rejected(self):
+        with self.assertRaises(ValueError):
+            index.normalize_batch_items({'requests': []})
+
+    def test_results_respect_parallelism_and_report_errors(self):
+        items = index.normalize_batch_items({
+            'requests': [{'messages': [{'role': 'user', 'content': str(i)}]} for i in range(8)]
+        })
+        lock = threading.Lock()
+        active = [0]
+        peak = [0]
+
+        def worker(item):
+            with lock:
+                active[0] += 1
+                peak[0] = max(peak[0], active[0])
+            time.sleep(0.02)
+            with lock:
+                active[0] -= 1
+            if item['index'] == 3:
+                raise RuntimeError('bad item')
+            return {'content': item['messages'][0]['content']}
+
+        results = list(index.iter_batch_results(items, worker, parallelism=2))
+        self.assertEqual(len(results), 8)
+        self.assertLessEqual(peak[0], 2)
+        by_index = {r['index']: r for r in results}
+        self.assertEqual(by_index[3]['status'], 'errored')
+        self.assertEqual(by_index[5], {**by_index[5], 'status': 'succeeded', 'content': '5'})
+
+
+    def test_results_error_after_headers_is_last_ndjson_line(self):
+        class APIError(Exception):
+            pass
+
+        class NotFoundError(APIError):
+            pass
+
+        def results(batch_id):
+            yield types.SimpleNamespace(custom_id='a', result=types.SimpleNamespace(type='expired'))
+            raise APIError('connection reset')
+
+        batches = types.SimpleNamespace(
+            retrieve=lambda batch_id: types.SimpleNamespace(processing_status='ended'), results=results)
+        sdk = types.SimpleNamespace(
+            APIError=APIError, NotFoundError=NotFoundError,
+            Anthropic=lambda api_key: types.SimpleNamespace(messages=types.SimpleNamespace(batches=batches)))
+        h = index.handler.__new__(index.handler)
+        h.wfile = io.BytesIO()
+        h.send_response = MagicMock()
+        h.send_header = MagicMock()
+        h.end_headers = MagicMock()
+        with patch.object(index, 'anthropic', sdk), patch.object(index, 'ANTHROPIC_AVAILABLE', True), \
+                patch.object(index, 'get_config', return_value=MagicMock(claude_key='sk-ant-test-key')):
+            h._handle_claude_batch_status('msgbatch_1')
+        h.send_response.assert_called_once_with(200)
+        lines = [json.loads(line) for line in h.wfile.getvalue().splitlines()]
+        self.assertEqual(lines[0], {'custom_id': 'a', 'status': 'expired'})
+        self.assertEqual(lines[-1]['type'], 'api_error')
+        self.assertTrue(h.close_connection)
+
+    def test_online_batch_settles_client_tokens_to_actual_usage(self):
+        admission = index.AdmissionController(client_rpm=0, client_tpm=100_000,
+                                              provider_limits={'claude': {'max_concurrency': 8}})
+        response = types.SimpleNamespace(
+            content=[types.SimpleNamespace(text='ok')], model='claude-test',
+            usage=types.SimpleNamespace(input_tokens=10, output_tokens=5))
+        messages = types.SimpleNamespace(create=lambda **kwargs: response)
+        sdk = types.SimpleNamespace(Anthropic=lambda api_key: types.SimpleNamespace(messages=messages))
+        h = index.handler.__new__(index.handler)
+        h.client_address = ('10.0.0.1', 0)
+        h.wfile = io.BytesIO()
+        h.send_response = MagicMock()
+        h.send_header = MagicMock()
+        h.end_headers = MagicMock()
+        data = {'requests': [{'max_tokens': 20_000, 'messages': [{'role': 'user', 'content': str(i)}]}
+                             for i in range(4)]}
+        with patch.object(index, 'anthropic', sdk), patch.object(index, 'ANTHROPIC_AVAILABLE', True), \
+                patch.object(index, 'ADMISSION', admission), \
+                patch.object(index, 'get_config', return_value=MagicMock(claude_key='sk-ant-test-key')):
+            h._handle_claude_batch(data)
+        lines = [json.loads(line) for line in h.wfile.getvalue().splitlines()]
+        self.assertEqual(lines[-1]['succeeded'], 4)
+        bucket = admission._clients['10.0.0.1']['tpm']
+        self.assertAlmostEqual(bucket.available(), 100_000 - 4 * 15, delta=50)
+
+
+class TestAdmissionControl(unittest.TestCase):
+
+    def make_controller(self, **limits):
+        provider = {'rpm': 0, 'tpm': 0, 'max_concurrency': 8}
+        provider.update(limits.pop('provider', {}))
+        return index.AdmissionController(provider_limits={'claude': provider}, **limits)
+
+    def test_bucket_reports_precise_wait_and_refunds(self):
+        bucket = index.TokenBucket(60)  # 1 token / s
+        self.assertEqual(bucket.reserve(60), 0.0)
+        self.assertAlmostEqual(bucket.reserve(2), 2.0, delta=0.05)
+        bucket.refund(2)
+        self.assertAlmostEqual(bucket.available(), 0.0, delta=0.05)
+
+    def test_zero_capacity_means_unlimited(self):
+        bucket = index.TokenBucket(0)
+        self.assertEqual(bucket.reserve(10**9), 0.0)
+
+    def test_client_over_limit_gets_retry_after(self):
+        admission = self.make_controller(client_rpm=2, client_tpm=0, max_wait=0.0)
+        admission.admit('1.2.3.4', 'claude').release()
+        admission.admit('1.2.3.4', 'claude').release()
+        with self.assertRaises(index.AdmissionRejected) as ctx:
+            admission.admit('1.2.3.4', 'claude')
+        self.assertEqual(ctx.exception.reason, 'client_rpm')
+        self.assertAlmostEqual(ctx.exception.retry_after, 30.0, delta=0.5)
+        # Inny klient ma własny bucket
+        admission.admit('5.6.7.8', 'claude').release()
+
+    def test_concurrency_limit_and_health_stats(self):
+        admission = self.make_controller(client_rpm=0, client_tpm=0, max_wait=0.05,
+                                         provider={'max_concurrency': 1})
+        permit = admission.admit(None, 'claude')
+        self.assertEqual(admission.stats()['providers']['claude']['in_flight'], 1)
+        with self.assertRaises(index.AdmissionRejected) as ctx:
+            admission.admit(None, 'claude')
+        self.assertEqual(ctx.exception.reason, 'provider_concurrency')
+        permit.release()
+        admission.admit(None, 'claude').release()
+        stats = admission.stats()['providers']['claude']
+        self.assertEqual((stats['in_flight'], stats['admitted'], stats['rejected']), (0, 2, 1))
+
+    def test_bulk_backlog_does_not_fill_interactive_queue(self):
+        admission = self.make_controller(client_rpm=0, client_tpm=0, queue_size=1, max_wait=2.0,
+                                         provider={'max_concurrency': 1})
+        permit = admission.admit(None, 'claude')
+        bulk = threading.Thread(target=lambda: admission.admit(None, 'claude', priority='bulk').release())
+        bulk.start()
+        time.sleep(0.05)
+        with self.assertRaises(index.AdmissionRejected) as ctx:
+            admission.admit(None, 'claude', max_wait=0.0, priority='bulk')
+        self.assertEqual(ctx.exception.reason, 'queue_full')
+        threading.Timer(0.1, permit.release).start()
+        admission.admit(None, 'claude', priority='interactive').release()
+        bulk.join(2)
+        self.assertEqual(admission.stats()['providers']['claude']['waiting_by_class']['bulk'], 0)
+
+    def test_provider_rate_wait_follows_priority(self):
+        admission = self.make_controller(client_rpm=0, client_tpm=0, max_wait=5.0,
+                                         provider={'rpm': 60, 'max_concurrency': 1})
+        for _ in range(60):
+            admission.admit(None, 'claude').release()
+        permit = admission.admit(None, 'claude', max_wait=2.0)  # czeka ~1 s na RPM
+        order = []
+
+        def run(name, priority):
+            admission.admit(None, 'claude', priority=priority).release()
+            order.append(name)
+
+        threads = [threading.Thread(target=run, args=('bulk', 'bulk'))]
+        threads[0].start()
+        time.sleep(0.05)
+        threads.append(threading.Thread(target=run, args=('chat', 'interactive')))
+        threads[1].start()
+        time.sleep(0.05)
+        permit.release()
+        for t in threads:
+            t.join(5)
+        self.assertEqual(order, ['chat', 'bulk'])
+
+    def test_upstream_429_is_not_retried_inside_permit(self):
+        class UpstreamError(Exception):
+            def __init__(self, status, headers=None):
+                super().__init__(f'Error code: {status}')
+                self.status_code = status
+                self.response = type('Response', (), {'headers': headers or {}})()
+
+        calls = []
+
+        def call(error):
+            calls.append(1)
+            raise error
+
+        with self.assertRaises(index.AdmissionRejected) as ctx:
+            index.retry_with_backoff(lambda: call(UpstreamError(429, {'retry-after': '7'})), initial_delay=0.0)
+        self.assertEqual((len(calls), ctx.exception.retry_after), (1, 7.0))
+        self.assertEqual(ctx.exception.reason, 'upstream_rate_limit')
+        with self.assertRaises(UpstreamError):
+            index.retry_with_backoff(lambda: call(UpstreamError(400)), initial_delay=0.0)
+        self.assertEqual(len(calls), 2)
+        with self.assertRaises(UpstreamError):
+            index.retry_with_backoff(lambda: call(UpstreamError(503)), max_retries=2, initial_delay=0.0)
+        self.assertEqual(len(calls), 5)
+
+    def test_settle_returns_unused_tokens(self):
+        admission = self.make_controller(client_rpm=0, client_tpm=1000, max_wait=0.0)
+        admission.admit('c', None, tokens=1000).settle(100)
+        admission.admit('c', None, tokens=800).release()
+
+
+class TestPriorityScheduler(unittest.TestCase):
+
+    def grant_order(self, scheduler, waiters):
+        order = []
+        threads = []
+        for name, priority in waiters:
+            def wait(name=name, priority=priority):
+                if scheduler.acquire(priority, timeout=2):
+                    order.append(name)
+                    scheduler.release()
+            t = threading.Thread(target=wait)
+            t.start()
+            threads.append(t)
+            time.sleep(0.02)  # deterministic enqueue order
+        return order, threads
+
+    def test_interactive_overtakes_queued_background_work(self):
+        scheduler = index.PriorityScheduler(1, aging_seconds=5.0)
+        self.assertTrue(scheduler.acquire('interactive'))
+        order, threads = self.grant_order(scheduler, [
+            ('bulk', 'bulk'), ('background', 'background'), ('chat', 'interactive'),
+        ])
+        scheduler.release()
+        for t in threads:
+            t.join(2)
+        self.assertEqual(order, ['chat', 'background', 'bulk'])
+
+    def test_aging_prevents_starvation(self):
+        scheduler = index.PriorityScheduler(1, aging_seconds=0.001)
+        self.assertTrue(scheduler.acquire('interactive'))
+        order, threads = self.grant_order(scheduler, [('bulk', 'bulk'), ('chat', 'interactive')])
+        scheduler.release()
+        for t in threads:
+            t.join(2)
+        self.assertEqual(order, ['bulk', 'chat'])
+
+    def test_timed_out_waiter_does_not_consume_slot(self):
+        scheduler = index.PriorityScheduler(1)
+        self.assertTrue(scheduler.acquire('interactive'))
+        self.assertFalse(scheduler.acquire('bulk', timeout=0.01))
+        scheduler.release()
+        self.assertTrue(scheduler.acquire('bulk', timeout=0.01))
+
+    def test_queue_wait_is_reported_per_class(self):
+        admission = index.AdmissionController(
+            client_rpm=0, client_tpm=0, provider_limits={'claude': {'max_concurrency': 1}}
+        )
+        admission.admit(None, 'claude', priority='bulk').release()
+        queue_wait = admission.stats()['queue_wait']
+        self.assertEqual(queue_wait['bulk']['admitted'], 1)
+        self.assertEqual(queue_wait['interactive']['admitted'], 0)
+
+
+
+class TestPrefork(unittest.TestCase):
+
+    def test_worker_count_resolution(self):
+        self.assertEqual(index.resolve_worker_count(None), 1)
+        self.assertEqual(index.resolve_worker_count('3'), 3)
+        self.assertEqual(index.resolve_worker_count('bogus'), 1)
+        self.assertGreaterEqual(index.resolve_worker_count('auto'), 1)
+
+    def test_limits_are_split_between_workers(self):
+        config = index.build_config({'RATE_LIMIT_CLIENT_RPM': '120', 'PROVIDER_MAX_CONCURRENCY': '8'})
+        admission = index.AdmissionController.from_config(config.admission, workers=4)
+        self.assertEqual(admission.client_rpm, 30)
+        self.assertEqual(admission.stats()['providers']['claude']['max_concurrency'], 2)
+
+    def test_server_wraps_existing_socket(self):
+        sock = index._create_listen_socket('127.0.0.1', 0)
+        server = index._create_server(sock)
+        try:
+            self.assertIs(server.socket, sock)
+            self.assertEqual(server.server_port, sock.getsockname()[1])
+        finally:
+            server.server_close()
+
+
+class TestLifecycle(unittest.TestCase):
+
+    def test_drain_waits_for_in_flight_requests(self):
+        lifecycle = index.ServerLifecycle()
+        lifecycle.begin()
+        threading.Timer(0.05, lifecycle.end).start()
+        self.assertTrue(lifecycle.drain(timeout=2))
+        self.assertEqual(lifecycle.stats(), {'active_requests': 0, 'draining': True})
+
+    def test_drain_gives_up_after_timeout(self):
+        lifecycle = index.ServerLifecycle()
+        lifecycle.begin()
+        self.assertFalse(lifecycle.drain(timeout=0.01))
+        self.assertEqual(lifecycle.stats()['active_requests'], 1)
+
+    @patch.object(index, 'LIFECYCLE', index.ServerLifecycle())
+    def test_server_tracks_requests_and_stops(self):
+        server = index._create_server(index._create_listen_socket('127.0.0.1', 0))
+        thread = threading.Thread(target=index._serve_until_stopped, args=(server,))
+        thread.start()
+        try:
+            port = server.server_port
+            with urllib.request.urlopen(f'http://127.0.0.1:{port}/api/health', timeout=5) as response:
+                self.assertEqual(response.status, 200)
+                self.assertIn('lifecycle', json.loads(response.read()))
+        finally:
+            index.LIFECYCLE.request_stop()
+            thread.join(timeout=5)
+        self.assertFalse(thread.is_alive())
+        self.assertEqual(index.LIFECYCLE.stats()['active_requests'], 0)
+
+    def _serve_with_queued_request(self, handover):
+        server = index._create_server(index._create_listen_socket('127.0.0.1', 0))
+        client = socket.create_connection(('127.0.0.1', server.server_port), timeout=5)
+        self.addCleanup(client.close)
+        client.sendall(b'GET /api/health HTTP/1.1\r\nHost: x\r\nConnection: close\r\n\r\n')
+        # Pętla accept już zatrzymana - połączenie czeka tylko w kolejce accept
+        server.serve_forever = lambda: None
+        with patch.object(index, 'LIFECYCLE', index.ServerLifecycle()):
+            index.LIFECYCLE.request_stop(handover=handover)
+            index._serve_until_stopped(server)
+        try:
+            return client.recv(4096)
+        except ConnectionResetError:
+            return b''
+
+    def test_plain_stop_serves_queued_connections(self):
+        self.assertTrue(self._serve_with_queued_request(handover=False).startswith(b'HTTP/1.'))
+
+    def test_handover_leaves_queued_connections_to_successor(self):
+        self.assertEqual(self._serve_with_queued_request(handover=True), b'')
+
+    def test_supervisor_waits_for_every_worker_to_report_ready(self):
+        read_fd, write_fd = os.pipe()
+        self.addCleanup(os.close, read_fd)
+        os.write(write_fd, b'1')
+        self.assertFalse(index._await_workers_ready(read_fd, 2, 0.1, lambda: False))
+        os.write(write_fd, b'1')
+        os.close(write_fd)
+        self.assertTrue(index._await_workers_ready(read_fd, 1, 1, lambda: False))
+        self.assertFalse(index._await_workers_ready(read_fd, 1, 1, lambda: False))
+
+
+class TestLazySDK(unittest.TestCase):
+
+    def test_sdk_is_imported_on_first_attribute_access(self):
+        sys.modules.pop('colorsys', None)
+        sdk = index.LazySDK('colorsys')
+        self.assertFalse(sdk.loaded)
+        self.assertNotIn('colorsys', sys.modules)
+        self.assertEqual(sdk.rgb_to_hsv(0, 0, 0), (0.0, 0.0, 0.0))
+        self.assertTrue(sdk.loaded)
+        self.assertIn('colorsys', index.startup_report()['imports_ms'])
+
+    def test_availability_check_does_not_import(self):
+        self.assertTrue(index.module_available('json'))
+        self.assertFalse(index.module_available('no_such_sdk_module'))
+        self.assertFalse(index.module_available('no_such_sdk_package.sub'))
+
+    def test_module_import_does_not_load_provider_sdks(self):
+        for sdk in (index.anthropic, index.genai, index.openai):
+            self.assertFalse(sdk.loaded)
+        self.assertIsNotNone(index.startup_report()['module_ready_ms'])
+
+
+class TestConfigSnapshot(unittest.TestCase):
+
+    def setUp(self):
+        self._saved = (index.CONFIG, index.ENV_FILE, index._CONFIG_NEXT_CHECK)
+
+    def tearDown(self):
+        index.CONFIG, index.ENV_FILE, index._CONFIG_NEXT_CHECK = self._saved
+        index._CONFIG_RELOAD_REQUESTED = False
+
+    def test_snapshot_is_validated_once_and_frozen(self):
+        config = index.build_config({'ANTHROPIC_API_KEY': ' short ', 'SAFE_MODE': 'TRUE', 'COMMAND_TIMEOUT': 'x'})
+        self.assertEqual(config.claude_key, 'short')
+        self.assertTrue(config.safe_mode)
+        self.assertEqual(config.command_timeout, 300)
+        self.assertEqual(len(config.warnings), 2)
+        with self.assertRaises(Exception):
+            config.safe_mode = False
+
+    def test_env_file_change_swaps_snapshot(self):
+        with tempfile.NamedTemporaryFile('w', suffix='.env', delete=False) as f:
+            f.write('SAFE_MODE=false\n')
+        self.addCleanup(os.unlink, f.name)
+        index.ENV_FILE = f.name
+        index.CONFIG = index.build_config({}, env_mtime=index._env_file_mtime())
+        index._CONFIG_NEXT_CHECK = 0.0
+        before = index.get_config()
+        self.assertIs(index.get_config(), before)
+
+        os.utime(f.name, (time.time() + 10, time.time() + 10))
+        index._CONFIG_NEXT_CHECK = 0.0
+        with patch.dict(os.environ, {'XAI_API_KEY': 'xai-test-key-123'}):
+            after = index.get_config()
+        self.assertEqual(after.version, before.version + 1)
+        self.assertEqual(after.grok_key, 'xai-test-key-123')
+        self.assertIsNone(before.grok_key)
+
+    def test_key_removed_from_env_file_is_dropped_on_reload(self):
+        def parse(path):
+            with open(path, encoding='utf-8') as f:
+                return dict(line.strip().split('=', 1) for line in f if '=' in line)
+
+        with tempfile.NamedTemporaryFile('w', suffix='.env', delete=False) as f:
+            f.write('XAI_API_KEY=xai-revoked-key-123\n')
+        self.addCleanup(os.unlink, f.name)
+        index.ENV_FILE = f.name
+        env = {k: v for k, v in os.environ.items() if k != 'XAI_API_KEY'}
+        with patch.object(index, 'DOTENV_AVAILABLE', True), \
+                patch.object(index, 'dotenv_values', parse, create=True), \
+                patch.object(index, '_PROCESS_ENV', {}), \
+                patch.object(index, '_DOTENV_KEYS', frozenset()), \
+                patch.dict(os.environ, env, clear=True):
+            self.assertEqual(index.reload_config().grok_key, 'xai-revoked-key-123')
+            with open(f.name, 'w') as fh:
+                fh.write('SAFE_MODE=true\n')
+            config = index.reload_config()
+            self.assertIsNone(config.grok_key)
+            self.assertTrue(config.safe_mode)
+            self.assertNotIn('XAI_API_KEY', os.environ)
+
+    def test_sighup_request_forces_reload(self):
+        index.ENV_FILE = None
+        index.CONFIG = index.build_config({})
+        index._CONFIG_NEXT_CHECK = time.monotonic() + 60
+        version = index.get_config().version
+        index.request_config_reload()
+        self.assertEqual(index.get_config().version, version + 1)
+        self.assertFalse(index._CONFIG_RELOAD_REQUESTED)
+
+    def test_gateway_and_admission_settings_reload(self):
+        index.ENV_FILE = None
+        index.CONFIG = index.build_config({})
+        self.assertEqual(index.CONFIG.hedge_after, 2.5)
+        env = {'HEDGE_AFTER_MS': '500', 'STREAM_IDLE_TIMEOUT': 'x', 'CHAT_FALLBACK_ORDER': 'grok,bogus,claude',
+               'RATE_LIMIT_CLIENT_RPM': '7', 'DRAIN_TIMEOUT': '5'}
+        with patch.dict(os.environ, env), patch.object(index, 'ADMISSION', index.ADMISSION):
+            before = index.ADMISSION
+            config = index.reload_config()
+            self.assertIsNot(index.ADMISSION, before)
+            self.assertEqual(index.ADMISSION.client_rpm, 7)
+            rebuilt = index.ADMISSION
+            index.reload_config()
+            self.assertIs(index.ADMISSION, rebuilt)
+        self.assertEqual(config.hedge_after, 0.5)
+        self.assertEqual(config.stream_idle_timeout, 120)
+        self.assertEqual(config.chat_fallback_order, ('grok', 'claude'))
+        self.assertEqual(config.drain_timeout, 5)
+        self.assertIn('STREAM_IDLE_TIMEOUT must be a number, using 120', config.warnings)
+
+
+class TestTranscriptStore(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.store = index.TranscriptStore(os.path.join(self.tmp.name, 'transcripts.db'), batch_size=10)
+
+    def tearDown(self):
+        self.store.close()
+        self.tmp.cleanup()
+
+    def test_batched_writes_are_searchable(self):
+        self.store.record('user', 'How do I configure the kernel socket buffers?', conversation_id='c1')
+        self.store.record('assistant', 'Tune net.core.rmem_max.', conversation_id='c1',
+                          provider='claude', model='claude-sonnet-4-20250514', input_tokens=12,
+                          output_tokens=6, latency_ms=420)
+        self.store.record('user', 'Unrelated "quoted" question', conversation_id='c2')
+        self.store.flush()
+
+        hits = self.store.search(query='kernel socket')['items']
+        self.assertEqual([h['conversation_id'] for h in hits], ['c1'])
+        self.assertEqual(self.store.search(query='"quoted')['items'][0]['conversation_id'], 'c2')
+
+        assistant = self.store.search(conversation_id='c1', role='assistant')['items'][0]
+        self.assertEqual(assistant['provider'], 'claude')
+        self.assertEqual(assistant['latency_ms'], 420)
+        self.assertEqual(self.store.stats()['written'], 3)
+
+    def test_cursor_pagination_is_newest_first(self):
+        for i in range(25):
+            self.store.record('user', f'message {i}')
+        self.store.flush()
+
+        first = self.store.search(limit=10)
+        second = self.store.search(limit=10, before=first['next_cursor'])
+        last = self.store.search(limit=10, before=second['next_cursor'])
+        self.assertEqual(first['items'][0]['content'], 'message 24')
+        self.assertEqual(second['items'][0]['content'], 'message 14')
+        self.assertEqual(len(last['items']), 5)
+        self.assertIsNone(last['next_cursor'])
+
+    def test_fts_query_quotes_user_input(self):
+        self.assertEqual(index.fts_query('foo bar*'), '"foo" "bar"*')
+        self.assertEqual(index.fts_query('say "hi" OR'), '"say" """hi""" "OR"')
+
+
+class TestLogReader(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp.name, 'server_log.txt')
+        with open(self.path, 'wb') as f:
+            for i in range(100):
+                level = 'ERROR' if i % 10 == 0 else 'INFO'
+                f.write(f'[ts] {level} line {i}\n'.encode())
+            f.write(b'[ts] partial')
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_tail_skips_partial_line_and_pages_backwards(self):
+        first = index.read_log_tail(self.path, limit=5)
+        self.assertEqual([l['text'] for l in first['lines']][-1], '[ts] INFO line 99')
+        self.assertEqual(first['end_offset'], first['size'] - len(b'[ts] partial'))
+
+        second = index.read_log_tail(self.path, limit=5, before=first['next_cursor'])
+        self.assertEqual(second['lines'][-1]['text'], '[ts] INFO line 94')
+        everything = index.read_log_tail(self.path, limit=1000)
+        self.assertEqual(len(everything['lines']), 100)
+        self.assertIsNone(everything['next_cursor'])
+
+    def test_level_and_substring_filters(self):
+        errors = index.read_log_tail(self.path, limit=3, line_filter=index.LogLineFilter('error'))
+        self.assertEqual([l['text'] for l in errors['lines']],
+                         ['[ts] ERROR line 70', '[ts] ERROR line 80', '[ts] ERROR line 90'])
+        older = index.read_log_tail(self.path, limit=3, before=errors['next_cursor'],
+                                    line_filter=index.LogLineFilter('error'))
+        self.assertEqual(older['lines'][-1]['text'], '[ts] ERROR line 60')
+
+        hits = index.read_log_tail(self.path, line_filter=index.LogLineFilter(None, 'LINE 4'))
+        self.assertEqual(len(hits['lines']), 11)
+
+    def test_forward_reads_only_appended_complete_lines(self):
+        end = index.read_log_tail(self.path, limit=1)['end_offset']
+        self.assertEqual(index.read_log_forward(self.path, end)['lines'], [])
+        with open(self.path, 'ab') as f:
+            f.write(b' done\n[ts] ERROR new\n')
+        appended = index.read_log_forward(self.path, end)
+        self.assertEqual([l['text'] for l in appended['lines']], ['[ts] partial done', '[ts] ERROR new'])
+        self.assertEqual(appended['next_offset'], appended['size'])
+        self.assertEqual(index.read_log_forward(self.path, appended['size'] + 100)['next_offset'], appended['size'])
+
+
+class TestTissaiaFrames(unittest.TestCase):
+
+    def test_frames_round_trip_without_base64(self):
+        blobs = [b'\x89PNG first', b'', b'\xff\xd8 second']
+        header = {'items': [{'id': i, 'size': len(b)} for i, b in enumerate(blobs)], 'options': {'format': 'png'}}
+        decoded_header, views = index.decode_frames(index.encode_frames(header, blobs))
+        self.assertEqual(decoded_header, header)
+        self.assertEqual([bytes(v) for v in views], blobs)
+
+    def test_malformed_frames_are_rejected(self):
+        frame = index.encode_frames({'items': [{'id': 'a', 'size': 10}]}, [b'short'])
+        with self.assertRaises(index.FrameError):
+            index.decode_frames(frame)
+        with self.assertRaises(index.FrameError):
+            index.decode_frames(index.encode_frames({'items': []}, [b'extra']))
+        with self.assertRaises(index.FrameError):
+            index.decode_frames(b'\x00\x00')
+
+    def test_malformed_batch_header_is_a_frame_error(self):
+        for header in ({'items': [], 'options': ['png']}, {'items': [], 'options': 'png'}, {'items': ['a']}, {}):
+            with self.assertRaises(index.FrameError):
+                index.validate_tissaia_batch('enhance', header)
+        index.validate_tissaia_batch('enhance', {'items': [{'id': 'a', 'size': 1}], 'options': None})
+
+
+@unittest.skipUnless(index.NUMPY_AVAILABLE and index.PIL_AVAILABLE, 'NumPy and Pillow required')
+class TestTissaiaEngine(unittest.TestCase):
+
+    def _scan(self, width=200, height=100, fmt='PNG'):
+        from PIL import Image
+        import io
+        pixels = index.numpy.zeros((height, width, 3), dtype=index.numpy.uint8)
+        pixels[:, width // 2:] = (200, 100, 50)
+        buffer = io.BytesIO()
+        Image.fromarray(pixels).save(buffer, format=fmt)
+        return buffer.getvalue()
+
+    def test_pixel_boxes_match_browser_hygiene_margin(self):
+        boxes = [{'x': 0.1, 'y': 0.1, 'width': 0.5, 'height': 0.5}, {'x': 0.9, 'y': 0.9, 'width': 0.5, 'height': 0.5}]
+        rects = index.tissaia_pixel_boxes(boxes, 200, 100, margin=0.02)
+        # x = 0.08 * 200, width = 0.54 * 200; druga ramka przycięta do krawędzi obrazu
+        self.assertEqual(rects[0].tolist(), [16, 8, 108, 54])
+        self.assertEqual(rects[1].tolist(), [176, 88, 24, 12])
+
+    def test_enhance_stretches_levels(self):
+        np = index.numpy
+        flat = np.full((10, 10, 3), 100, dtype=np.uint8)
+        flat[0, 0] = 50
+        flat[9, 9] = 150
+        out = index.tissaia_enhance(flat, autolevels=0.0, sharpen=0.5)
+        self.assertEqual(out.dtype, np.uint8)
+        self.assertEqual(int(out.min()), 0)
+        self.assertEqual(int(out.max()), 255)
+
+    def test_crop_batch_returns_binary_shards_and_per_item_errors(self):
+        scan = self._scan()
+        header = {
+            'items': [
+                {'id': 'scan-1', 'size': len(scan), 'boxes': [{'x': 0.5, 'y': 0, 'width': 0.5, 'height': 1, 'label': 'right'}]},
+                {'id': 'broken', 'size': 3, 'boxes': [{'x': 0, 'y': 0, 'width': 1, 'height': 1}]},
+            ],
+            'options': {'hygiene_margin': 0, 'enhance': False},
+        }
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            response, blobs = index.run_tissaia_batch('crop', header, [memoryview(scan), memoryview(b'bad')], executor)
+        ok, failed = response['results']
+        self.assertEqual((ok['id'], ok['label'], ok['box'], ok['mime']), ('scan-1', 'right', [100, 0, 100, 100], 'image/png'))
+        self.assertEqual(failed['status'], 'error')
+        self.assertEqual(len(blobs), 1)
+        self.assertEqual(index._tissaia_decode(blobs[0])[0, 0].tolist(), [200, 100, 50])
+
+
+class TestFileServing(unittest.TestCase):
+
+    def test_sniff_prefers_magic_bytes_over_extension(self):
+        self.assertEqual(index.sniff_content_type('photo.txt', b'\x89PNG\r\n\x1a\n....'), 'image/png')
+        self.assertEqual(index.sniff_content_type('data.json', b'{"a": 1}'), 'application/json; charset=utf-8')
+        self.assertEqual(index.sniff_content_type('noext', 'zażółć'.encode('utf-8')[:-1]), 'text/plain; charset=utf-8')
+        self.assertEqual(index.sniff_content_type('noext', b'\x00\x01\x02'), 'application/octet-stream')
+
+    def test_parse_byte_range(self):
+        self.assertEqual(index.parse_byte_range('bytes=0-99', 1000), (0, 99))
+        self.assertEqual(index.parse_byte_range('bytes=900-', 1000), (900, 999))
+        self.assertEqual(index.parse_byte_range('bytes=-100', 1000), (900, 999))
+        self.assertEqual(index.parse_byte_range('bytes=990-5000', 1000), (990, 999))
+        self.assertIsNone(index.parse_byte_range('bytes=0-1,5-9', 1000))
+        self.assertIsNone(index.parse_byte_range('items=0-1', 1000))
+        for header in ('bytes=1000-', 'bytes=-0', 'bytes=5-1'):
+            with self.assertRaises(ValueError):
+                index.parse_byte_range(header, 1000)
+
+    def test_etag_matches_lists_and_weak_tags(self):
+        self.assertTrue(index.etag_matches('"a", W/"b"', '"b"'))
+        self.assertTrue(index.etag_matches('*', '"b"'))
+        self.assertFalse(index.etag_matches('"c"', '"b"'))
+        self.assertFalse(index.etag_matches(None, '"b"'))
+
+    def test_fs_read_serves_ranges_and_not_modified(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            with open(os.path.join(tmp, 'big.log'), 'wb') as f:
+                f.write(b''.join(b'line %05d\n' % i for i in range(10000)))
+            server = index.ThreadingHTTPServer(('127.0.0.1', 0), index.handler)
+            threading.Thread(target=server.serve_forever, daemon=True).start()
+            url = f'http://127.0.0.1:{server.server_port}/api/fs/read?path=big.log&cwd={urllib.parse.quote(tmp)}'
+            try:
+                request = urllib.request.Request(url, headers={'Range': 'bytes=11-21'})
+                with urllib.request.urlopen(request, timeout=5) as response:
+                    self.assertEqual(response.status, 206)
+                    self.assertEqual(response.read(), b'line 00001\n')
+                    self.assertEqual(response.headers['Content-Range'], 'bytes 11-21/110000')
+                    self.assertTrue(response.headers['Content-Type'].startswith('text/'))
+                    etag = response.headers['ETag']
+
+                request = urllib.request.Request(url, headers={'If-None-Match': etag})
+                with self.assertRaises(urllib.error.HTTPError) as ctx:
+                    urllib.request.urlopen(request, timeout=5)
+                self.assertEqual(ctx.exception.code, 304)
+
+                request = urllib.request.Request(url, headers={'Range': 'bytes=200000-'})
+                with self.assertRaises(urllib.error.HTTPError) as ctx:
+                    urllib.request.urlopen(request, timeout=5)
+                self.assertEqual(ctx.exception.code, 416)
+                self.assertEqual(ctx.exception.headers['Content-Range'], 'bytes */110000')
+            finally:
+                server.shutdown()
+                server.server_close()
+
+
+class TestConditionalGet(unittest.TestCase):
+
+    def setUp(self):
+        self.server = index.ThreadingHTTPServer(('127.0.0.1', 0), index.handler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.base = f'http://127.0.0.1:{self.server.server_port}'
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def _request(self, path, data=None, headers=None):
+        body = json.dumps(data).encode() if data is not None else None
+        request = urllib.request.Request(self.base + path, data=body, headers=headers or {})
+        try:
+            with urllib.request.urlopen(request, timeout=5) as response:
+                return response.status, response.headers, response.read()
+        except urllib.error.HTTPError as e:
+            return e.code, e.headers, e.read()
+
+    def test_config_revalidates_with_304(self):
+        status, headers, body = self._request('/api/config')
+        self.assertEqual(status, 200)
+        self.assertEqual(headers['Cache-Control'], 'no-cache')
+        status, headers2, body = self._request('/api/config', headers={'If-None-Match': headers['ETag']})
+        self.assertEqual((status, body), (304, b''))
+        self.assertEqual(headers2['ETag'], headers['ETag'])
+
+    def test_health_etag_ignores_timestamp(self):
+        _, first, _ = self._request('/api/health')
+        _, second, _ = self._request('/api/health')
+        self.assertEqual(first['ETag'], second['ETag'])
+        status, _, _ = self._request('/api/health', headers={'If-None-Match': second['ETag']})
+        self.assertEqual(status, 304)
+
+    def test_fs_list_etag_changes_with_directory(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            payload = {'action': 'fs_list', 'cwd': tmp}
+            status, headers, _ = self._request('/api', payload)
+            self.assertEqual(status, 200)
+            status, _, _ = self._request('/api', dict(payload, etag=headers['ETag']))
+            self.assertEqual(status, 304)
+            with open(os.path.join(tmp, 'new.txt'), 'w') as f:
+                f.write('x')
+            status, changed, body = self._request('/api', dict(payload, etag=headers['ETag']))
+            self.assertEqual(status, 200)
+            self.assertNotEqual(changed['ETag'], headers['ETag'])
+            self.assertIn('new.txt', [item['name'] for item in json.loads(body)['files']])
+
+
+def _endless_streamer(closed):
+    def streamer(model, system, messages, max_tokens):
+        try:
+            while True:
+                time.sleep(0.01)
+                yield 'tok '
+        finally:
+            closed.set()
+    return streamer
+
+
+class TestStreamCancellation(unittest.TestCase):
+
+    MESSAGES = [{'role': 'user', 'content': 'hi'}]
+
+    def setUp(self):
+        self.closed = threading.Event()
+        self.registry = index.StreamRegistry(watch_interval=0.05)
+        self.patches = [
+            patch.dict(index.PROVIDER_STREAMERS, {'claude': _endless_streamer(self.closed)}),
+            patch.object(index, 'provider_available', return_value=True),
+            patch.object(index, 'STREAMS', self.registry),
+        ]
+        for p in self.patches:
+            p.start()
+        self.server = index.ThreadingHTTPServer(('127.0.0.1', 0), index.handler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        for p in reversed(self.patches):
+            p.stop()
+
+    def _open_stream(self, request_id):
+        body = json.dumps({'messages': self.MESSAGES, 'provider': 'claude', 'fallback': False,
+                           'request_id': request_id}).encode()
+        sock = socket.create_connection(('127.0.0.1', self.server.server_port), timeout=5)
+        sock.sendall(b'POST /api/chat HTTP/1.1\r\nHost: x\r\nContent-Type: application/json\r\n'
+                     b'Content-Length: %d\r\n\r\n%s' % (len(body), body))
+        received = b''
+        while b'tok' not in received:
+            received += sock.recv(4096)
+        return sock, received
+
+    def test_gateway_stops_upstream_when_client_disconnects(self):
+        sock, received = self._open_stream('disconnect-1')
+        self.assertIn(b'X-Request-ID: disconnect-1', received)
+        sock.close()
+        self.assertTrue(self.closed.wait(2), 'upstream stream was not closed')
+        deadline = time.monotonic() + 2
+        while self.registry.stats()['active'] and time.monotonic() < deadline:
+            time.sleep(0.01)
+        stats = self.registry.stats()
+        self.assertEqual(stats['reasons'], {'client_disconnected': 1})
+        self.assertGreater(stats['tokens_saved'], 0)
+
+    def test_cancel_endpoint_ends_stream_for_connected_client(self):
+        sock, received = self._open_stream('cancel-1')
+        request = urllib.request.Request(
+            f'http://127.0.0.1:{self.server.server_port}/api/chat/cancel',
+            data=json.dumps({'request_id': 'cancel-1'}).encode(),
+        )
+        with urllib.request.urlopen(request, timeout=5) as response:
+            self.assertEqual(json.loads(response.read())['status'], 'cancelled')
+        while b'[DONE]' not in received:
+            chunk = sock.recv(4096)
+            self.assertTrue(chunk, 'connection closed before [DONE]')
+            received += chunk
+        sock.close()
+        self.assertIn(b'"cancelled": true', received)
+        self.assertTrue(self.closed.wait(2))
+
+    def test_cancel_closes_claude_chat_upstream_blocked_in_read(self):
+        closed = self.closed
+
+        class BlockedStream:
+            def __enter__(self):
+                return self
+
+            def __exit__(self, *exc_info):
+                self.close()
+
+            def close(self):
+                closed.set()
+
+            @property
+            def text_stream(self):
+                yield 'tok'
+                closed.wait(5)  # Odczyt wisi, dopóki ktoś nie zamknie odpowiedzi
+                raise RuntimeError('stream closed')
+
+        messages = types.SimpleNamespace(stream=lambda **kwargs: BlockedStream())
+        sdk = types.SimpleNamespace(Anthropic=lambda api_key: types.SimpleNamespace(messages=messages),
+                                    APIError=RuntimeError)
+        config = dataclasses.replace(index.get_config(), claude_key='sk-ant-test-key')
+        body = json.dumps({'messages': self.MESSAGES, 'request_id': 'claude-1'}).encode()
+        with patch.object(index, 'anthropic', sdk), patch.object(index, 'ANTHROPIC_AVAILABLE', True), \
+                patch.object(index, 'get_config', return_value=config):
+            sock = socket.create_connection(('127.0.0.1', self.server.server_port), timeout=5)
+            sock.sendall(b'POST /api/claude/chat HTTP/1.1\r\nHost: x\r\nContent-Type: application/json\r\n'
+                         b'Content-Length: %d\r\n\r\n%s' % (len(body), body))
+            received = b''
+            while b'tok' not in received:
+                received += sock.recv(4096)
+            started = time.monotonic()
+            self.assertEqual(self.registry.cancel('claude-1'), 'cancelled')
+            while b'[DONE]' not in received:
+                chunk = sock.recv(4096)
+                self.assertTrue(chunk, 'connection closed before [DONE]')
+                received += chunk
+            sock.close()
+        self.assertLess(time.monotonic() - started, 2)
+        self.assertIn(b'"cancelled": true', received)
+
+    def test_cancel_unknown_request_is_not_found(self):
+        self.assertEqual(self.registry.cancel('missing'), 'not_found')
+
+    def test_prefork_marker_only_cancels_streams_started_before_it(self):
+        cancel_dir = tempfile.mkdtemp()
+        registry = index.StreamRegistry(watch_interval=0.02, cancel_dir=cancel_dir)
+        with patch.object(index, 'WORKER_COUNT', 2):
+            self.assertEqual(registry.cancel('retry-1'), 'broadcast')
+            marker = os.path.join(cancel_dir, 'retry-1')
+            os.utime(marker, (time.time() - 5, time.time() - 5))
+            retry = registry.register('retry-1', 100)
+            time.sleep(0.1)
+            self.assertFalse(retry.cancelled)
+            registry.finish(retry, 10)
+            self.assertFalse(os.path.exists(marker))
+
+            live = registry.register('live-1', 100)
+            open(os.path.join(cancel_dir, 'live-1'), 'w').close()  # znacznik od innego workera
+            self.assertTrue(live.event.wait(1))
+            self.assertEqual(live.reason, 'cancel_request')
+            registry.finish(live, 10)
+            self.assertEqual(os.listdir(cancel_dir), [])
+
+    def test_client_disconnected_detects_closed_peer(self):
+        left, right = socket.socketpair()
+        try:
+            self.assertFalse(index.client_disconnected(left))
+            right.close()
+            self.assertTrue(index.client_disconnected(left))
+        finally:
+            left.close()
+
+
+def _ws_connect(port):
+    sock = socket.create_connection(('127.0.0.1', port), timeout=10)
+    sock.sendall(b'GET /api/ws HTTP/1.1\r\nHost: x\r\nUpgrade: websocket\r\nConnection: Upgrade\r\n'
+                 b'Sec-WebSocket-Key: dGhlIHNhbXBsZSBub25jZQ==\r\nSec-WebSocket-Version: 13\r\n\r\n')
+    response = b''
+    while b'\r\n\r\n' not in response:
+        response += sock.recv(1)
+    return sock, response
+
+
+def _ws_send(sock, message, opcode=index.WS_OP_TEXT):
+    payload = json.dumps(message).encode() if isinstance(message, dict) else message
+    mask = os.urandom(4)
+    sock.sendall(index.ws_frame_header(opcode, len(payload), mask) + index.ws_unmask(payload, mask))
+
+
+def _ws_recv(sock):
+    def exact(n):
+        data = b''
+        while len(data) < n:
+            chunk = sock.recv(n - len(data))
+            if not chunk:
+                raise EOFError
+            data += chunk
+        return data
+    head = exact(2)
+    length = head[1] & 0x7F
+    if length == 126:
+        length = int.from_bytes(exact(2), 'big')
+    elif length == 127:
+        length = int.from_bytes(exact(8), 'big')
+    payload = exact(length)
+    opcode = head[0] & 0x0F
+    return opcode, json.loads(payload) if opcode == index.WS_OP_TEXT else payload
+
+
+class TestWebSocket(unittest.TestCase):
+
+    def setUp(self):
+        self.server = index.ThreadingHTTPServer(('127.0.0.1', 0), index.handler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.sock, self.handshake = _ws_connect(self.server.server_port)
+        self.pending = {}
+
+    def tearDown(self):
+        self.sock.close()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def _next(self, stream_id):
+        # Strumienie są przeplatane - wiadomości innych id czekają w buforze
+        while not self.pending.get(stream_id):
+            _, message = _ws_recv(self.sock)
+            self.pending.setdefault(message.get('id'), []).append(message)
+        return self.pending[stream_id].pop(0)
+
+    def _until(self, stream_id, events=('done', 'error', 'cancelled')):
+        received = [self._next(stream_id)]
+        while received[-1]['event'] not in events:
+            received.append(self._next(stream_id))
+        return received
+
+    def test_handshake_and_masking(self):
+        self.assertIn(b'101 Switching Protocols', self.handshake)
+        self.assertIn(b's3pPLMBiTxaQ9kYGzzhZRbK+xOo=', self.handshake)
+        self.assertEqual(index.ws_unmask(index.ws_unmask(b'hello world', b'abcd'), b'abcd'), b'hello world')
+
+    def test_streams_are_multiplexed_with_flow_control(self):
+        streamer = _fake_streamer(['a', 'b', 'c', 'd'])
+        with patch.dict(index.PROVIDER_STREAMERS, {'claude': streamer}), \
+                patch.object(index, 'provider_available', return_value=True):
+            _ws_send(self.sock, {'type': 'chat', 'id': 'c1', 'credit': 2, 'provider': 'claude',
+                                 'fallback': False, 'messages': [{'role': 'user', 'content': 'hi'}]})
+            _ws_send(self.sock, {'type': 'health', 'id': 'h1'})
+            health = self._until('h1')
+            self.assertEqual([m['event'] for m in health], ['health', 'done'])
+
+            # Okno 2 wiadomości: meta + pierwszy token, reszta czeka na kredyt
+            first = [self._next('c1'), self._next('c1')]
+            self.assertEqual([m['event'] for m in first], ['meta', 'text'])
+            self.assertEqual(self.pending.get('c1'), [])
+            self.sock.settimeout(0.3)
+            with self.assertRaises(socket.timeout):
+                _ws_recv(self.sock)
+            self.sock.settimeout(10)
+            _ws_send(self.sock, {'type': 'credit', 'id': 'c1', 'n': 10})
+            rest = self._until('c1')
+        self.assertEqual(''.join(m.get('text', '') for m in first + rest), 'abcd')
+        self.assertEqual(rest[-1]['event'], 'done')
+
+    def test_chat_settles_client_tokens_to_actual_usage(self):
+        admission = index.AdmissionController(client_rpm=0, client_tpm=100_000,
+                                              provider_limits={'claude': {'max_concurrency': 8}})
+        with patch.dict(index.PROVIDER_STREAMERS, {'claude': _fake_streamer(['a', 'b'])}), \
+                patch.object(index, 'provider_available', return_value=True), \
+                patch.object(index, 'ADMISSION', admission):
+            _ws_send(self.sock, {'type': 'chat', 'id': 'c2', 'provider': 'claude', 'fallback': False,
+                                 'max_tokens': 50_000, 'messages': [{'role': 'user', 'content': 'hi'}]})
+            self.assertEqual(self._until('c2')[-1]['event'], 'done')
+            bucket = admission._clients['127.0.0.1']['tpm']
+            deadline = time.monotonic() + 2
+            while bucket.available() < 99_000 and time.monotonic() < deadline:
+                time.sleep(0.01)
+            self.assertGreater(bucket.available(), 99_000)
+
+    @unittest.skipIf(sys.platform == 'win32', 'uses POSIX shell commands')
+    def test_command_output_and_cancel(self):
+        _ws_send(self.sock, {'type': 'command', 'id': 'k1', 'command': 'echo one; echo two'})
+        messages = self._until('k1')
+        self.assertEqual(''.join(m.get('data', '') for m in messages), 'one\ntwo\n')
+        self.assertEqual(messages[-1], {'id': 'k1', 'event': 'done', 'code': 0})
+
+        _ws_send(self.sock, {'type': 'command', 'id': 'k2', 'command': 'sleep 30'})
+        self.assertEqual(self._next('k2')['event'], 'meta')
+        started = time.monotonic()
+        _ws_send(self.sock, {'type': 'cancel', 'id': 'k2'})
+        self.assertEqual(self._until('k2')[-1]['event'], 'cancelled')
+        self.assertLess(time.monotonic() - started, 5)
+
+    def test_errors_are_reported_per_stream(self):
+        _ws_send(self.sock, {'type': 'bogus', 'id': 'x1'})
+        self.assertEqual(self._next('x1')['type'], 'invalid_request')
+        _ws_send(self.sock, {'type': 'logs', 'id': 'l1', 'source': 'nope'})
+        self.assertEqual(self._until('l1')[-1]['type'], 'invalid_request')
+        _ws_send(self.sock, {'type': 'ping', 'id': 'p1'})
+        self.assertEqual(self._next('p1'), {'id': 'p1', 'event': 'pong'})
+        _ws_send(self.sock, (1000).to_bytes(2, 'big'), opcode=index.WS_OP_CLOSE)
+        self.assertEqual(_ws_recv(self.sock)[0], index.WS_OP_CLOSE)
+
+
+class TestBenchHarness(unittest.TestCase):
+
+    def test_compare_flags_only_slowdowns_past_threshold(self):
+        baseline = {'a': {'min_us': 100.0}, 'b': {'min_us': 100.0}, 'c': {'min_us': 100.0}}
+        results = {'a': {'min_us': 124.0}, 'b': {'min_us': 130.0}, 'c': {'min_us': 50.0}, 'new': {'min_us': 1.0}}
+        rows = {row['name']: row for row in bench_backend.compare(results, baseline, threshold=0.25)}
+        self.assertEqual(set(rows), {'a', 'b', 'c'})
+        self.assertFalse(rows['a']['regressed'])
+        self.assertTrue(rows['b']['regressed'])
+        self.assertFalse(rows['c']['regressed'])
+
+    def test_benchmarks_drive_handler_in_process(self):
+        operation, cleanup = bench_backend.bench_post_large_history()
+        try:
+            self.assertGreater(operation(), 0)
+        finally:
+            cleanup()
+        stats = bench_backend.measure(lambda: None, repeats=2, min_seconds=0.001)
+        self.assertEqual(stats['repeats'], 2)
+        self.assertLessEqual(stats['min_us'], stats['median_us'])
+
+    def test_handler_benchmarks_do_not_write_logs(self):
+        log_file = os.path.join(tempfile.mkdtemp(), 'server_log.txt')
+        with patch.object(index, 'CONFIG', index.build_config({'ENABLE_LOGGING': 'true'})), \
+                patch.object(index, 'LOG_FILE', log_file):
+            bench_backend.run_benchmarks(['post_large_history'], repeats=1, min_seconds=0.001, verbose=False)
+            self.assertTrue(index.CONFIG.enable_logging)
+        self.assertFalse(os.path.exists(log_file))
+
+    def test_compare_without_baseline_is_a_soft_skip(self):
+        missing = os.path.join(tempfile.mkdtemp(), 'bench_baseline.json')
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            code = bench_backend.main(['--compare', '--baseline', missing, '-k', 'send_sse', '--repeats', '1'])
+        self.assertEqual(code, 0)
+        self.assertIn('comparison skipped', output.getvalue())
+        self.assertIn('bench:backend:save', output.getvalue())
+
+
+if __name__ == '__main__':
+    unittest.main()
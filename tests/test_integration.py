@@ -16,15 +16,11 @@ class TestBackendIntegration(unittest.TestCase):
         # We simulate the Vercel environment where the handler is instantiated
         pass
 
-    @patch('os.environ.get')
-    def test_api_endpoint_structure(self, mock_env_get):
+    def test_api_endpoint_structure(self):
         """
         Tests the API endpoint structure and response format.
         This simulates a request from the frontend to the backend.
         """
-        # Mock API Key presence
-        mock_env_get.return_value = 'TEST_API_KEY'
-
         # Capture output
         mock_wfile = BytesIO()
 
@@ -35,7 +31,8 @@ class TestBackendIntegration(unittest.TestCase):
         h.send_header = MagicMock()
         h.end_headers = MagicMock()
 
-        h.path = '/'
+        h.path = '/api'
+        h.headers = {}
         # Act: Simulate GET request
         h.do_GET()
 
@@ -49,20 +46,21 @@ class TestBackendIntegration(unittest.TestCase):
 
         # Check keys expected by frontend or external consumers
         self.assertIn('status', data)
-        self.assertIn('backend', data)
-        self.assertIn('react_version_target', data)
+        self.assertIn('mode', data)
+        self.assertIn('version', data)
+        self.assertIn('anthropic_sdk', data)
 
         # Verify values align with project requirements
         self.assertEqual(data['status'], 'Alive')
-        self.assertEqual(data['backend'], 'Python Serverless')
 
-    @patch('os.environ.get')
-    def test_api_security_check(self, mock_env_get):
+    @patch('index.ANTHROPIC_AVAILABLE', True)
+    @patch('index.get_config')
+    def test_api_security_check(self, mock_get_config):
         """
         Tests that the backend enforces security (API Key check).
         """
         # Mock missing API Key
-        mock_env_get.return_value = None
+        mock_get_config.return_value = MagicMock(claude_key=None)
 
         mock_wfile = BytesIO()
 
@@ -72,13 +70,14 @@ class TestBackendIntegration(unittest.TestCase):
         h.send_header = MagicMock()
         h.end_headers = MagicMock()
 
-        h.path = '/'
+        h.path = '/api/claude/chat'
+        h.headers = {}
         # Act
-        h.do_GET()
+        h._handle_claude_chat({'messages': [{'role': 'user', 'content': 'Hi'}]})
 
         # Assert
-        h.send_response.assert_called_with(500)
-        self.assertIn('Missing Configuration', mock_wfile.getvalue().decode())
+        h.send_response.assert_called_with(401)
+        self.assertIn('missing_api_key', mock_wfile.getvalue().decode())
 
 if __name__ == '__main__':
     unittest.main()